@@ -1,24 +1,475 @@
 import os
 import imaplib
 import email as email_lib
+import email.feedparser
 import email.header
-from typing import List, Optional
+import email.message
+import html as html_lib
+from typing import Dict, Iterable, List, Optional, Set, Tuple
 import logging
-from datetime import datetime, timedelta
+import math
+from datetime import datetime, timedelta, timezone
 import re
+import json
+import queue
+import random
+import secrets
+import binascii
+import codecs
+import quopri
+import asyncio
+import bisect
+import hashlib
+import hmac
+import multiprocessing
+import select
+import signal
+import socket
+import ssl
+import sys
+import tempfile
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager, contextmanager
+from logging.handlers import QueueHandler, QueueListener
 from email.utils import parsedate_to_datetime
 
 import psycopg2
 from psycopg2.extras import RealDictCursor
-from fastapi import FastAPI, HTTPException
+from psycopg2.pool import ThreadedConnectionPool
+from fastapi import BackgroundTasks, FastAPI, Header, HTTPException
+from fastapi.concurrency import run_in_threadpool
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import PlainTextResponse
 from pydantic import BaseModel
 
-# Configura logging
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 IMAP_HOST = "imap.mail.me.com"
 IMAP_PORT = 993
+IMAP_TIMEOUT = float(os.getenv("IMAP_TIMEOUT", "60"))
+
+
+def _env_flag(name: str, default: str = "false") -> bool:
+    return os.getenv(name, default).strip().lower() in ("1", "true", "yes", "on")
+
+
+# ------- LOGGING -------
+
+# LOG_FORMAT=json saca una línea JSON por evento; LOG_SAMPLE_RATE es la fracción
+# de peticiones correctas cuyo resumen se registra (los errores siempre);
+# LOG_QUEUE_ENABLED escribe desde un hilo aparte (QueueListener).
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").strip().upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text").strip().lower()
+LOG_SAMPLE_RATE = float(os.getenv("LOG_SAMPLE_RATE", "1"))
+LOG_QUEUE_ENABLED = _env_flag("LOG_QUEUE_ENABLED", "true")
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            "ts": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        fields = getattr(record, "fields", None)
+        if fields:
+            data.update(fields)
+        if record.exc_info:
+            data["exc"] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+class DeferredQueueHandler(QueueHandler):
+    """
+    QueueHandler que no formatea en el hilo que loguea: el mensaje (y los
+    %s) se construyen en el hilo del QueueListener.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+class _EventFields:
+    """
+    Campos de un evento como "k=v k=v", formateados solo si se emite.
+    """
+
+    __slots__ = ("fields",)
+
+    def __init__(self, fields: dict):
+        self.fields = fields
+
+    def __str__(self) -> str:
+        return " ".join(f"{key}={value}" for key, value in self.fields.items())
+
+
+_log_listener: Optional[QueueListener] = None
+
+
+def configure_logging() -> None:
+    global _log_listener
+    handler = logging.StreamHandler()
+    handler.setFormatter(JsonFormatter() if LOG_FORMAT == "json" else logging.Formatter(logging.BASIC_FORMAT))
+    root = logging.getLogger()
+    root.setLevel(LOG_LEVEL)
+    if LOG_QUEUE_ENABLED:
+        log_queue: queue.SimpleQueue = queue.SimpleQueue()
+        _log_listener = QueueListener(log_queue, handler, respect_handler_level=True)
+        _log_listener.start()
+        handler = DeferredQueueHandler(log_queue)
+    root.handlers = [handler]
+
+
+def stop_logging() -> None:
+    global _log_listener
+    if _log_listener is not None:
+        _log_listener.stop()
+        _log_listener = None
+
+
+def log_event(event: str, level: int = logging.INFO, sample: bool = True, **fields) -> None:
+    """
+    Un evento resumen (p. ej. uno por petición) con sus campos. Con sample=True
+    solo se registra una fracción LOG_SAMPLE_RATE de ellos.
+    """
+    if not logger.isEnabledFor(level):
+        return
+    if sample and LOG_SAMPLE_RATE < 1 and random.random() >= LOG_SAMPLE_RATE:
+        return
+    logger.log(level, "📊 %s %s", event, _EventFields(fields), extra={"fields": {"event": event, **fields}})
+
+
+configure_logging()
+
+
+# ------- MÉTRICAS -------
+
+def _label_str(labels: Tuple[Tuple[str, str], ...], le: Optional[str] = None) -> str:
+    parts = []
+    for key, value in labels:
+        escaped = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        parts.append('%s="%s"' % (key, escaped))
+    if le is not None:
+        parts.append('le="%s"' % le)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class Counter:
+    def __init__(self, name: str, documentation: str):
+        self.name = name
+        self.documentation = documentation
+        self._lock = threading.Lock()
+        self._values: Dict[Tuple[Tuple[str, str], ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self, const_labels: Tuple[Tuple[str, str], ...] = ()) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_label_str(const_labels + key)} {value}")
+        return lines
+
+
+class Histogram:
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self, name: str, documentation: str, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(sorted(buckets))
+        self._lock = threading.Lock()
+        # labels -> ([conteo por bucket], suma, total)
+        self._values: Dict[Tuple[Tuple[str, str], ...], list] = {}
+
+    def observe(self, value: float, **labels) -> None:
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][i] += 1
+                    break
+            entry[1] += value
+            entry[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def render(self, const_labels: Tuple[Tuple[str, str], ...] = ()) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, (counts, total_sum, count) in sorted(self._values.items()):
+                key = const_labels + key
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, counts):
+                    cumulative += bucket_count
+                    lines.append(f"{self.name}_bucket{_label_str(key, str(bound))} {cumulative}")
+                lines.append(f"{self.name}_bucket{_label_str(key, '+Inf')} {count}")
+                lines.append(f"{self.name}_sum{_label_str(key)} {total_sum}")
+                lines.append(f"{self.name}_count{_label_str(key)} {count}")
+        return lines
+
+
+class Gauge:
+    def __init__(self, name: str, documentation: str):
+        self.name = name
+        self.documentation = documentation
+        self._lock = threading.Lock()
+        self._values: Dict[Tuple[Tuple[str, str], ...], float] = {}
+
+    def set(self, value: float, **labels) -> None:
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = value
+
+    def render(self, const_labels: Tuple[Tuple[str, str], ...] = ()) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} gauge"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_label_str(const_labels + key)} {value}")
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics: list = []
+
+    def counter(self, name: str, documentation: str) -> Counter:
+        metric = Counter(name, documentation)
+        self._metrics.append(metric)
+        return metric
+
+    def gauge(self, name: str, documentation: str) -> Gauge:
+        metric = Gauge(name, documentation)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name: str, documentation: str, buckets: Tuple[float, ...] = Histogram.DEFAULT_BUCKETS) -> Histogram:
+        metric = Histogram(name, documentation, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def render(self, **const_labels) -> str:
+        """
+        Formato de texto de Prometheus (0.0.4). const_labels se añaden a todas
+        las series (p. ej. worker="0").
+        """
+        labels = tuple(sorted(const_labels.items()))
+        lines: List[str] = []
+        for metric in self._metrics:
+            lines.extend(metric.render(labels))
+        return "\n".join(lines) + "\n"
+
+
+def merge_metrics_text(texts: List[str]) -> str:
+    """
+    Une varias salidas de MetricsRegistry.render (una por worker, con su label
+    worker) dejando un solo HELP/TYPE por métrica y sus series juntas debajo.
+    """
+    families: "OrderedDict[str, Tuple[List[str], List[str]]]" = OrderedDict()
+    current = None
+    for text in texts:
+        for line in text.splitlines():
+            if line.startswith("# HELP ") or line.startswith("# TYPE "):
+                name = line.split(" ", 3)[2]
+                family = families.setdefault(name, ([], []))
+                if not any(h.startswith(line[:7]) for h in family[0]):
+                    family[0].append(line)
+                current = family
+            elif line and current is not None:
+                current[1].append(line)
+    lines: List[str] = []
+    for headers, samples in families.values():
+        lines.extend(headers)
+        lines.extend(samples)
+    return "\n".join(lines) + "\n"
+
+
+metrics = MetricsRegistry()
+REQUEST_SECONDS = metrics.histogram("webhook_request_seconds", "Duración de las peticiones por endpoint y status")
+PHASE_SECONDS = metrics.histogram("webhook_phase_seconds", "Duración de cada fase (get_account, connect, login, select, search, header_fetch, body_fetch, mime_parse, extract, store, expunge...)")
+MESSAGES_SCANNED = metrics.counter("imap_messages_scanned_total", "Mensajes revisados por carpeta")
+HITS = metrics.counter("imap_hits_total", "Códigos/URLs encontrados por carpeta y tipo")
+SCAN_DEPTH_AT_HIT = metrics.histogram("imap_scan_depth_at_hit", "Posición (1 = más reciente) del mensaje encontrado dentro de la ventana revisada", buckets=(1, 2, 3, 5, 8, 10, 15, 20, 30, 50))
+ERRORS = metrics.counter("webhook_errors_total", "Errores por tipo y lugar")
+QUEUE_WAIT_SECONDS = metrics.histogram("imap_queue_wait_seconds", "Espera en la cola del planificador IMAP hasta tener turno")
+LOGIN_BREAKER_REJECTED = metrics.counter("imap_login_breaker_rejected_total", "Conexiones no intentadas porque el circuit breaker de la cuenta está abierto")
+ACCOUNT_INDEX_SIZE = metrics.gauge("account_index_entries", "Emails (MAIL_MADRE y ALIAS) en el índice en memoria de icloud_accounts")
+ACCOUNT_INDEX_BYTES = metrics.gauge("account_index_bytes", "Memoria aproximada del índice de icloud_accounts")
+ACCOUNT_INDEX_LOAD_SECONDS = metrics.gauge("account_index_load_seconds", "Duración de la última carga completa del índice de icloud_accounts")
+QUEUE_REJECTED = metrics.counter("imap_queue_rejected_total", "Peticiones rechazadas con 429 por cola llena (por cuenta o global)")
+
+
+# Pool de sesiones IMAP autenticadas (una lista por MAIL_MADRE).
+# IMAP_POOL_MAX_PER_ACCOUNT es el tope de conexiones abiertas por cuenta entre
+# el pool síncrono, el asyncio y los watchers de IDLE juntos: con
+# IMAP_WATCHER_ENABLED cada carpeta vigilada ocupa un hueco todo el tiempo,
+# así que debe ser al menos len(IMAP_WATCH_FOLDERS) + 1.
+IMAP_POOL_MAX_PER_ACCOUNT = int(os.getenv("IMAP_POOL_MAX_PER_ACCOUNT", "2"))
+IMAP_POOL_IDLE_TIMEOUT = float(os.getenv("IMAP_POOL_IDLE_TIMEOUT", "300"))
+IMAP_POOL_NOOP_AFTER = float(os.getenv("IMAP_POOL_NOOP_AFTER", "30"))
+IMAP_POOL_ACQUIRE_TIMEOUT = float(os.getenv("IMAP_POOL_ACQUIRE_TIMEOUT", "30"))
+
+# Circuit breaker de login por MAIL_MADRE: tras LOGIN_BREAKER_THRESHOLD fallos
+# seguidos (conexión o LOGIN) no se intenta durante LOGIN_BREAKER_COOLDOWN segundos
+# (se dobla en cada fallo hasta LOGIN_BREAKER_MAX_COOLDOWN); después un solo intento
+# de prueba. Un PASSWORD nuevo en icloud_accounts lo cierra al momento.
+LOGIN_BREAKER_ENABLED = _env_flag("LOGIN_BREAKER_ENABLED", "true")
+LOGIN_BREAKER_THRESHOLD = int(os.getenv("LOGIN_BREAKER_THRESHOLD", "3"))
+LOGIN_BREAKER_COOLDOWN = float(os.getenv("LOGIN_BREAKER_COOLDOWN", "60"))
+LOGIN_BREAKER_MAX_COOLDOWN = float(os.getenv("LOGIN_BREAKER_MAX_COOLDOWN", "900"))
+
+# Planificador del trabajo IMAP de /webhook: tope de escaneos simultáneos por
+# MAIL_MADRE y en total (por debajo del threadpool), cola justa entre cuentas
+# y 429 + Retry-After cuando la cola de una cuenta o la global se llena
+IMAP_SCHED_ENABLED = _env_flag("IMAP_SCHED_ENABLED", "true")
+IMAP_SCHED_PER_ACCOUNT = int(os.getenv("IMAP_SCHED_PER_ACCOUNT", str(IMAP_POOL_MAX_PER_ACCOUNT)))
+IMAP_SCHED_GLOBAL = int(os.getenv("IMAP_SCHED_GLOBAL", "32"))
+IMAP_SCHED_MAX_QUEUE = int(os.getenv("IMAP_SCHED_MAX_QUEUE", "20"))
+IMAP_SCHED_MAX_QUEUE_TOTAL = int(os.getenv("IMAP_SCHED_MAX_QUEUE_TOTAL", "500"))
+
+# Cliente IMAP asyncio en /webhook (IMAP_ASYNC_ENABLED=false vuelve a imaplib en el threadpool)
+IMAP_ASYNC_ENABLED = _env_flag("IMAP_ASYNC_ENABLED", "true")
+IMAP_TLS_VERIFY = _env_flag("IMAP_TLS_VERIFY", "true")
+
+# Headers que necesitamos para clasificar (se piden en un solo UID FETCH por carpeta)
+HEADER_FETCH_ITEMS = "(FLAGS BODY.PEEK[HEADER.FIELDS (SUBJECT FROM DATE TO DELIVERED-TO X-ORIGINAL-TO)])"
+
+# Filtros SEARCH en el servidor por tipo de email: por defecto los de cada regla
+# (email_rules); IMAP_SEARCH_FILTERS permite sobrescribirlos con un JSON.
+# IMAP_SEARCH_MODE=all vuelve al SEARCH ALL.
+EMAIL_TYPE_SEARCH: Dict[str, Dict[str, str]] = json.loads(os.getenv("IMAP_SEARCH_FILTERS", "{}"))
+IMAP_SEARCH_MODE = os.getenv("IMAP_SEARCH_MODE", "server").strip().lower()
+# El destinatario se filtra con un OR sobre los mismos headers que mira el cliente
+# (el alias puede venir solo en Delivered-To o X-Original-To). Vacío = sin filtro.
+IMAP_SEARCH_RECIPIENT_HEADERS = [
+    h.strip() for h in os.getenv("IMAP_SEARCH_RECIPIENT_HEADERS", "DELIVERED-TO,TO,X-ORIGINAL-TO").split(",") if h.strip()
+]
+
+# Descarga del body: "partial" (BODYSTRUCTURE + solo la parte de texto) o "full" (BODY[])
+IMAP_BODY_FETCH_MODE = os.getenv("IMAP_BODY_FETCH_MODE", "partial").strip().lower()
+IMAP_BODY_MAX_BYTES = int(os.getenv("IMAP_BODY_MAX_BYTES", "65536"))
+
+# Mensaje completo (modo "full" o cuando falla el parcial): parseo en streaming
+# que para en cuanto tiene la parte de texto que pide la regla. Se descargan como
+# mucho IMAP_FULL_MAX_BYTES del mensaje (0 = entero) y de cada parte de texto se
+# guardan como mucho MIME_BODY_MAX_BYTES. IMAP_MIME_STREAMING=false vuelve a
+# message_from_bytes.
+IMAP_MIME_STREAMING = _env_flag("IMAP_MIME_STREAMING", "true")
+IMAP_FULL_MAX_BYTES = int(os.getenv("IMAP_FULL_MAX_BYTES", str(4 * 1024 * 1024)))
+MIME_BODY_MAX_BYTES = int(os.getenv("MIME_BODY_MAX_BYTES", "262144"))
+MIME_FEED_CHUNK = int(os.getenv("MIME_FEED_CHUNK", "65536"))
+
+# URL de activación (RUGBY): en cada regla se miran primero los valores href
+# (con las entidades bien desescapadas) y luego el texto entero.
+# ACTIVATION_URL_FROM_HREF=false deja solo el recorrido del texto.
+ACTIVATION_URL_FROM_HREF = _env_flag("ACTIVATION_URL_FROM_HREF", "true")
+
+# Cursor incremental por (cuenta, carpeta): solo se piden los UIDs nuevos
+IMAP_CURSOR_ENABLED = _env_flag("IMAP_CURSOR_ENABLED", "true")
+
+# STATUS (UIDNEXT UNSEEN MESSAGES) antes de escanear: se saltan las carpetas sin
+# no leídos o sin cambios desde el último escaneo completo de la cuenta
+IMAP_FOLDER_STATUS_ENABLED = _env_flag("IMAP_FOLDER_STATUS_ENABLED", "true")
+# INBOX y Junk en paralelo con el cliente asyncio, cada una en su sesión del pool
+# (cuenta para IMAP_POOL_MAX_PER_ACCOUNT); el primer hit que llega al límite cancela el resto
+IMAP_PARALLEL_FOLDERS = _env_flag("IMAP_PARALLEL_FOLDERS")
+
+# Ventana de búsqueda del webhook
+WEBHOOK_MINUTES = 10
+WEBHOOK_MAX_EMAILS_TO_CHECK = 15
+
+# Un solo escaneo en curso por cuenta madre; los webhooks concurrentes de sus
+# alias esperan ese escaneo y se reparten los resultados por destinatario
+WEBHOOK_COALESCE_ENABLED = _env_flag("WEBHOOK_COALESCE_ENABLED", "true")
+
+# Long-poll de /webhook (wait_seconds): tope de espera y cada cuánto se
+# pide lo nuevo al servidor (cursor) si no hay watcher IDLE para la cuenta
+WEBHOOK_MAX_WAIT_SECONDS = float(os.getenv("WEBHOOK_MAX_WAIT_SECONDS", "120"))
+WEBHOOK_WAIT_POLL_INTERVAL = float(os.getenv("WEBHOOK_WAIT_POLL_INTERVAL", "3"))
+
+# Máximo de emails por llamada a /webhook/batch
+WEBHOOK_BATCH_MAX = int(os.getenv("WEBHOOK_BATCH_MAX", "500"))
+
+# \Seen diferido: los códigos entregados se marcan como leídos en segundo plano,
+# en lote por carpeta (un UID STORE por set de UIDs), con reintentos y un journal
+# en disco para que ningún mensaje se entregue dos veces (SEEN_JOURNAL_PATH vacío = sin journal)
+SEEN_COMMIT_ENABLED = _env_flag("SEEN_COMMIT_ENABLED", "true")
+SEEN_COMMIT_DELAY = float(os.getenv("SEEN_COMMIT_DELAY", "0.5"))
+SEEN_COMMIT_MAX_BACKOFF = float(os.getenv("SEEN_COMMIT_MAX_BACKOFF", "300"))
+SEEN_JOURNAL_PATH = os.getenv("SEEN_JOURNAL_PATH", "seen_pending.jsonl")
+
+# Multi-proceso (python app.py): WEB_WORKERS procesos comparten el puerto
+# (SO_REUSEPORT) y cada MAIL_MADRE es de un solo worker por hash consistente;
+# lo que llega a otro worker se le reenvía por su socket Unix. /metrics junta
+# las de todos los workers (label worker) pidiéndolas por esos mismos sockets.
+# Los reenvíos llevan X-Worker-Forwarded con WORKER_FORWARD_SECRET, que genera
+# serve() al arrancar y pasa a sus workers: sin él la cabecera no cuenta.
+HOST = os.getenv("HOST", "0.0.0.0")
+PORT = int(os.getenv("PORT", "8000"))
+WEB_WORKERS = max(1, int(os.getenv("WEB_WORKERS", "1")))
+WORKER_INDEX = int(os.getenv("WORKER_INDEX", "0"))
+WORKER_SOCKET_DIR = os.getenv("WORKER_SOCKET_DIR", tempfile.gettempdir())
+WORKER_FORWARD_TIMEOUT = float(os.getenv("WORKER_FORWARD_TIMEOUT", "300"))
+WORKER_FORWARD_SECRET = os.getenv("WORKER_FORWARD_SECRET", "")
+if WEB_WORKERS > 1 and SEEN_JOURNAL_PATH:
+    SEEN_JOURNAL_PATH = f"{SEEN_JOURNAL_PATH}.{WORKER_INDEX}"
+
+
+# Registro durable de los códigos entregados (tabla extracted_codes) con caché en
+# memoria: un reintento del mismo alias dentro de CODE_REPLAY_WINDOW segundos
+# recibe la misma respuesta sin tocar IMAP (CODE_REPLAY_WINDOW=0 lo desactiva).
+# La respuesta repetida lleva replayed=true; no se repite si el watcher ya tiene un
+# código más nuevo sin entregar para el alias. La tabla la crea la migración
+# migrations/001_extracted_codes.sql: al arrancar solo se comprueba que existe.
+CODE_LOG_ENABLED = _env_flag("CODE_LOG_ENABLED", "true")
+CODE_REPLAY_WINDOW = float(os.getenv("CODE_REPLAY_WINDOW", "120"))
+CODE_REPLAY_CACHE_SIZE = int(os.getenv("CODE_REPLAY_CACHE_SIZE", "10000"))
+# Un alias sin nada en extracted_codes no se vuelve a consultar en Postgres durante
+# CODE_LOG_MISS_TTL segundos (lo normal mientras el cliente sondea antes de que
+# llegue el código). Lo entregado por esta instancia se ve al momento igualmente.
+CODE_LOG_MISS_TTL = float(os.getenv("CODE_LOG_MISS_TTL", "15"))
+
+# Watcher IDLE: pre-extrae códigos en segundo plano
+IMAP_WATCHER_ENABLED = _env_flag("IMAP_WATCHER_ENABLED")
+IMAP_WATCH_FOLDERS = [f.strip() for f in os.getenv("IMAP_WATCH_FOLDERS", "INBOX,Junk").split(",") if f.strip()]
+IMAP_IDLE_TIMEOUT = float(os.getenv("IMAP_IDLE_TIMEOUT", "1500"))  # < 29 min (RFC 2177)
+IMAP_WATCH_REFRESH = float(os.getenv("IMAP_WATCH_REFRESH", "300"))
+CODE_STORE_TTL = float(os.getenv("CODE_STORE_TTL", "600"))
+
+# Pool de conexiones a Postgres y caché de get_account
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "1"))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "10"))
+ACCOUNT_CACHE_SIZE = int(os.getenv("ACCOUNT_CACHE_SIZE", "10000"))
+ACCOUNT_CACHE_TTL = float(os.getenv("ACCOUNT_CACHE_TTL", "300"))
+ACCOUNT_CACHE_NEGATIVE_TTL = float(os.getenv("ACCOUNT_CACHE_NEGATIVE_TTL", "30"))
+ACCOUNTS_NOTIFY_CHANNEL = os.getenv("ACCOUNTS_NOTIFY_CHANNEL", "icloud_accounts_changed")
+ACCOUNTS_LISTEN_ENABLED = _env_flag("ACCOUNTS_LISTEN_ENABLED", "true")
+ACCOUNTS_INSTALL_NOTIFY_TRIGGER = _env_flag("ACCOUNTS_INSTALL_NOTIFY_TRIGGER")
+
+# Índice en memoria de todo icloud_accounts (email en minúsculas -> credenciales),
+# cargado al arrancar. Se actualiza con los NOTIFY del listener y, si la tabla
+# tiene columna de última modificación, pidiendo cada ACCOUNT_INDEX_REFRESH_INTERVAL
+# las filas cambiadas. Cada ACCOUNT_INDEX_FULL_RELOAD segundos se recarga entero.
+ACCOUNT_INDEX_ENABLED = _env_flag("ACCOUNT_INDEX_ENABLED")
+ACCOUNT_INDEX_REFRESH_INTERVAL = float(os.getenv("ACCOUNT_INDEX_REFRESH_INTERVAL", "30"))
+ACCOUNT_INDEX_FULL_RELOAD = float(os.getenv("ACCOUNT_INDEX_FULL_RELOAD", "3600"))
+ACCOUNT_INDEX_UPDATED_COLUMN = os.getenv("ACCOUNT_INDEX_UPDATED_COLUMN", "").strip()
+ACCOUNT_INDEX_FETCH_SIZE = int(os.getenv("ACCOUNT_INDEX_FETCH_SIZE", "10000"))
 
 DATABASE_URL = os.getenv("DATABASE_URL")
 if not DATABASE_URL:
@@ -31,6 +482,7 @@ app = FastAPI()
 
 class WebhookInput(BaseModel):
     email: str  # correo que te llega por el webhook (MAIL_MADRE o ALIAS)
+    wait_seconds: float = 0  # long-poll: esperar hasta que llegue el código (máx. WEBHOOK_MAX_WAIT_SECONDS)
 
 
 class Message(BaseModel):
@@ -47,21 +499,490 @@ class Message(BaseModel):
 class WebhookResponse(BaseModel):
     email: str
     messages: List[Message]
+    # True: es la última entrega repetida (reintento dentro de CODE_REPLAY_WINDOW).
+    # Puede ser un código anterior a uno pedido después y que todavía no se ha leído.
+    replayed: bool = False
+
+
+class WebhookBatchInput(BaseModel):
+    emails: List[str]
+
+
+class WebhookBatchResult(BaseModel):
+    email: str
+    status: str  # found | pending | not_found | error
+    messages: List[Message] = []
+    detail: Optional[str] = None
+    replayed: bool = False  # como en WebhookResponse
+
+
+class WebhookBatchResponse(BaseModel):
+    results: List[WebhookBatchResult]
+
+
+class MailHit:
+    """
+    Mensaje FIFA/RUGBY ya extraído, con la carpeta y el UID de donde salió
+    (necesarios para marcarlo como leído más tarde).
+    """
+
+    def __init__(self, folder: str, uid: str, recipient: str, message: Message):
+        self.folder = folder
+        self.uid = uid
+        self.recipient = recipient
+        self.message = message
+        self.found_at = time.monotonic()
+
+    def sort_key(self) -> Tuple[float, float]:
+        """
+        Orden de "más reciente": fecha del correo y, si no se puede leer, cuándo se encontró.
+        """
+        try:
+            sent_at = parsedate_to_datetime(self.message.date).timestamp()
+        except Exception:
+            sent_at = 0.0
+        return (sent_at, self.found_at)
 
 
 # ------- HELPERS DB -------
 
+_db_pool: Optional[ThreadedConnectionPool] = None
+_db_pool_lock = threading.Lock()
+
+
 def get_connection():
     return psycopg2.connect(DATABASE_URL, cursor_factory=RealDictCursor)
 
 
+def _get_db_pool() -> ThreadedConnectionPool:
+    global _db_pool
+    if _db_pool is None:
+        with _db_pool_lock:
+            if _db_pool is None:
+                _db_pool = ThreadedConnectionPool(
+                    DB_POOL_MIN, DB_POOL_MAX, DATABASE_URL, cursor_factory=RealDictCursor
+                )
+    return _db_pool
+
+
+@contextmanager
+def db_connection():
+    """
+    Presta una conexión del pool de Postgres. Si la conexión se rompe,
+    se cierra en vez de devolverla al pool.
+    """
+    pool = _get_db_pool()
+    conn = pool.getconn()
+    broken = False
+    try:
+        yield conn
+        conn.rollback()  # no dejar transacciones abiertas en el pool
+    except (psycopg2.OperationalError, psycopg2.InterfaceError):
+        broken = True
+        raise
+    finally:
+        pool.putconn(conn, close=broken or bool(conn.closed))
+
+
+def close_db_pool() -> None:
+    global _db_pool
+    with _db_pool_lock:
+        if _db_pool is not None:
+            _db_pool.closeall()
+            _db_pool = None
+
+
+class AccountCache:
+    """
+    Caché LRU en memoria de email -> credenciales (get_account).
+    También guarda los emails que no existen (404) durante un TTL más corto.
+    """
+
+    _MISSING = object()
+
+    def __init__(self, max_size: int, ttl: float, negative_ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, Tuple[float, Optional[dict]]]" = OrderedDict()
+
+    def get(self, email_in: str):
+        """
+        Devuelve la fila cacheada, None si se sabe que no existe,
+        o AccountCache._MISSING si no está en caché.
+        """
+        with self._lock:
+            entry = self._entries.get(email_in)
+            if entry is None:
+                return self._MISSING
+            expires_at, row = entry
+            if expires_at < time.monotonic():
+                del self._entries[email_in]
+                return self._MISSING
+            self._entries.move_to_end(email_in)
+            return row
+
+    def put(self, email_in: str, row: Optional[dict]) -> None:
+        if self.max_size <= 0:
+            return
+        ttl = self.ttl if row is not None else self.negative_ttl
+        with self._lock:
+            self._entries[email_in] = (time.monotonic() + ttl, row)
+            self._entries.move_to_end(email_in)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, emails: Set[str]) -> None:
+        """
+        Borra las entradas de esos emails (como alias o como MAIL_MADRE).
+        Con un set vacío se vacía toda la caché.
+        """
+        with self._lock:
+            if not emails:
+                self._entries.clear()
+                return
+            for key in list(self._entries):
+                row = self._entries[key][1]
+                if key.lower() in emails or (row is not None and row["icloud_user"].lower() in emails):
+                    del self._entries[key]
+
+
+account_cache = AccountCache(ACCOUNT_CACHE_SIZE, ACCOUNT_CACHE_TTL, ACCOUNT_CACHE_NEGATIVE_TTL)
+
+
+# Trigger opcional que avisa por NOTIFY de los cambios en icloud_accounts.
+# El payload son los emails afectados separados por comas.
+ACCOUNTS_NOTIFY_TRIGGER_SQL = f"""
+CREATE OR REPLACE FUNCTION icloud_accounts_notify() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        PERFORM pg_notify('{ACCOUNTS_NOTIFY_CHANNEL}', concat_ws(',', OLD."MAIL_MADRE", OLD."ALIAS"));
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        PERFORM pg_notify('{ACCOUNTS_NOTIFY_CHANNEL}', concat_ws(',', NEW."MAIL_MADRE", NEW."ALIAS"));
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS icloud_accounts_notify ON "icloud_accounts";
+CREATE TRIGGER icloud_accounts_notify
+    AFTER INSERT OR UPDATE OR DELETE ON "icloud_accounts"
+    FOR EACH ROW EXECUTE FUNCTION icloud_accounts_notify();
+"""
+
+
+def install_accounts_notify_trigger() -> None:
+    with db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(ACCOUNTS_NOTIFY_TRIGGER_SQL)
+        conn.commit()
+    logger.info("✅ Trigger NOTIFY instalado en icloud_accounts")
+
+
+class AccountChangeListener(threading.Thread):
+    """
+    Escucha LISTEN/NOTIFY de icloud_accounts en una conexión dedicada y avisa
+    a los suscriptores con el set de emails cambiados (vacío = todo).
+    Si se pierde la conexión se avisa con un set vacío, porque pudimos perder avisos.
+    """
+
+    def __init__(self, channel: str):
+        super().__init__(name="accounts-listener", daemon=True)
+        self.channel = channel
+        self._subscribers: List = []
+        self._stop_event = threading.Event()
+
+    def subscribe(self, callback) -> None:
+        self._subscribers.append(callback)
+
+    def _notify(self, emails: Set[str]) -> None:
+        for callback in self._subscribers:
+            try:
+                callback(emails)
+            except Exception as e:
+                logger.warning("⚠️ Error procesando cambio de icloud_accounts: %s", e)
+
+    def stop(self) -> None:
+        self._stop_event.set()
+
+    def run(self) -> None:
+        backoff = 1.0
+        while not self._stop_event.is_set():
+            conn = None
+            try:
+                conn = psycopg2.connect(DATABASE_URL)
+                conn.autocommit = True
+                with conn.cursor() as cur:
+                    cur.execute(f'LISTEN "{self.channel}"')
+                logger.info("👂 Escuchando cambios de icloud_accounts (%s)", self.channel)
+                backoff = 1.0
+                while not self._stop_event.is_set():
+                    if not select.select([conn], [], [], 5.0)[0]:
+                        continue
+                    conn.poll()
+                    changed: Set[str] = set()
+                    everything = False
+                    while conn.notifies:
+                        payload = conn.notifies.pop(0).payload
+                        emails = {e.strip().lower() for e in payload.split(",") if e.strip()}
+                        if not emails:
+                            everything = True
+                        changed |= emails
+                    self._notify(set() if everything else changed)
+            except Exception as e:
+                if self._stop_event.is_set():
+                    break
+                logger.warning("⚠️ LISTEN caído: %s (reintento en %.0fs)", e, backoff)
+                self._notify(set())
+                self._stop_event.wait(backoff)
+                backoff = min(backoff * 2, 60.0)
+            finally:
+                if conn is not None:
+                    conn.close()
+
+
+accounts_listener = AccountChangeListener(ACCOUNTS_NOTIFY_CHANNEL)
+accounts_listener.subscribe(account_cache.invalidate)
+
+
+class AccountIndex(threading.Thread):
+    """
+    Todo icloud_accounts en un dict: email (MAIL_MADRE o ALIAS, en minúsculas)
+    -> (MAIL_MADRE, PASSWORD). Los alias de una misma cuenta comparten la tupla,
+    así que el coste por alias es la clave y una entrada del dict.
+
+    La carga completa va por un cursor de servidor (sin traer la tabla entera
+    de golpe). Después el hilo aplica los cambios: los emails avisados por NOTIFY
+    se quitan al momento (get_account cae a Postgres mientras tanto) y se vuelven
+    a leer; con ACCOUNT_INDEX_UPDATED_COLUMN también se piden las filas
+    modificadas desde la última vuelta. Los borrados sin NOTIFY se ven en la
+    siguiente recarga completa.
+    """
+
+    def __init__(self):
+        super().__init__(name="account-index", daemon=True)
+        self._lock = threading.Lock()
+        self._entries: Dict[str, Tuple[str, str]] = {}
+        self._pending: Set[str] = set()
+        self._reload_all = False
+        self._loaded_at = 0.0
+        self._updated_since = None
+        self._wake = threading.Event()
+        self._stop_event = threading.Event()
+        self.ready = False
+
+    def get(self, email_in: str) -> Optional[dict]:
+        """
+        Credenciales del email, o None si no está en el índice.
+        """
+        entry = self._entries.get(email_in.strip().lower())
+        if entry is None:
+            return None
+        return {"icloud_user": entry[0], "icloud_app_password": entry[1]}
+
+    @staticmethod
+    def _add(entries: Dict[str, Tuple[str, str]], shared: Dict[Tuple[str, str], Tuple[str, str]], row, overwrite: bool) -> None:
+        mail_madre, alias, password = row[0], row[1], row[2]
+        if not mail_madre:
+            return
+        value = shared.get((mail_madre, password))
+        if value is None:
+            value = shared[(mail_madre, password)] = (sys.intern(mail_madre), password)
+        for email_in in (alias, mail_madre):
+            if not email_in:
+                continue
+            key = email_in.strip().lower()
+            if overwrite:
+                entries[key] = value
+            else:
+                entries.setdefault(key, value)
+
+    def _columns(self) -> str:
+        columns = '"MAIL_MADRE", "ALIAS", "PASSWORD"'
+        if ACCOUNT_INDEX_UPDATED_COLUMN:
+            columns += f', "{ACCOUNT_INDEX_UPDATED_COLUMN}"'
+        return columns
+
+    def _track_updated(self, row) -> None:
+        if ACCOUNT_INDEX_UPDATED_COLUMN and row[3] is not None:
+            if self._updated_since is None or row[3] > self._updated_since:
+                self._updated_since = row[3]
+
+    def load(self) -> None:
+        """
+        Carga completa; el dict nuevo sustituye al anterior de una vez.
+        """
+        started = time.perf_counter()
+        entries: Dict[str, Tuple[str, str]] = {}
+        shared: Dict[Tuple[str, str], Tuple[str, str]] = {}
+        with db_connection() as conn:
+            with conn.cursor(name="account_index", cursor_factory=psycopg2.extensions.cursor) as cur:
+                cur.itersize = ACCOUNT_INDEX_FETCH_SIZE
+                cur.execute(f'SELECT {self._columns()} FROM "icloud_accounts"')
+                for row in cur:
+                    self._add(entries, shared, row, overwrite=False)
+                    self._track_updated(row)
+        elapsed = time.perf_counter() - started
+        with self._lock:
+            self._entries = entries
+            self._loaded_at = time.monotonic()
+            self.ready = True
+        footprint = self.footprint()
+        ACCOUNT_INDEX_SIZE.set(len(entries))
+        ACCOUNT_INDEX_BYTES.set(footprint)
+        ACCOUNT_INDEX_LOAD_SECONDS.set(round(elapsed, 3))
+        logger.info(
+            "📇 Índice de cuentas cargado: %s emails, %s cuentas madre, %.1f MB en %.2fs",
+            len(entries), len({value[0] for value in shared.values()}), footprint / 1e6, elapsed,
+        )
+
+    def footprint(self) -> int:
+        """
+        Bytes aproximados del dict, sus claves y las tuplas/strings compartidos.
+        """
+        entries = self._entries
+        seen: Set[int] = set()
+        total = sys.getsizeof(entries)
+        for key, value in list(entries.items()):
+            total += sys.getsizeof(key)
+            if id(value) in seen:
+                continue
+            seen.add(id(value))
+            total += sys.getsizeof(value)
+            for item in value:
+                if id(item) not in seen:
+                    seen.add(id(item))
+                    total += sys.getsizeof(item)
+        return total
+
+    def _refresh_emails(self, emails: Set[str]) -> None:
+        with db_connection() as conn:
+            with conn.cursor(cursor_factory=psycopg2.extensions.cursor) as cur:
+                cur.execute(
+                    f"""
+                    SELECT {self._columns()}
+                    FROM "icloud_accounts"
+                    WHERE lower("MAIL_MADRE") = ANY(%s)
+                       OR lower("ALIAS")      = ANY(%s)
+                    """,
+                    (list(emails), list(emails)),
+                )
+                rows = cur.fetchall()
+        fresh: Dict[str, Tuple[str, str]] = {}
+        shared: Dict[Tuple[str, str], Tuple[str, str]] = {}
+        for row in rows:
+            self._add(fresh, shared, row, overwrite=False)
+        with self._lock:
+            for email_in in emails:
+                self._entries.pop(email_in, None)
+            self._entries.update(fresh)
+        logger.debug("📇 Índice de cuentas: %s emails releídos (%s filas)", len(emails), len(rows))
+
+    def _refresh_updated(self) -> None:
+        if self._updated_since is None:
+            return
+        with db_connection() as conn:
+            with conn.cursor(cursor_factory=psycopg2.extensions.cursor) as cur:
+                cur.execute(
+                    f'SELECT {self._columns()} FROM "icloud_accounts" WHERE "{ACCOUNT_INDEX_UPDATED_COLUMN}" > %s',
+                    (self._updated_since,),
+                )
+                rows = cur.fetchall()
+        if not rows:
+            return
+        shared: Dict[Tuple[str, str], Tuple[str, str]] = {}
+        with self._lock:
+            for row in rows:
+                self._add(self._entries, shared, row, overwrite=True)
+                self._track_updated(row)
+        logger.debug("📇 Índice de cuentas: %s filas modificadas", len(rows))
+
+    def on_accounts_changed(self, emails: Set[str]) -> None:
+        """
+        Suscriptor de accounts_listener. Set vacío = recarga completa (mientras
+        tanto se sigue sirviendo el índice que hay).
+        """
+        if not self.ready and not self.is_alive():
+            return
+        with self._lock:
+            if not emails:
+                self._reload_all = True
+            else:
+                for email_in in emails:
+                    self._entries.pop(email_in, None)
+                self._pending |= emails
+        self._wake.set()
+
+    def stop(self) -> None:
+        self._stop_event.set()
+        self._wake.set()
+
+    def run(self) -> None:
+        while not self._stop_event.is_set():
+            self._wake.wait(ACCOUNT_INDEX_REFRESH_INTERVAL)
+            self._wake.clear()
+            if self._stop_event.is_set():
+                break
+            with self._lock:
+                pending, self._pending = self._pending, set()
+                reload_all, self._reload_all = self._reload_all, False
+            try:
+                if reload_all or not self.ready or time.monotonic() - self._loaded_at >= ACCOUNT_INDEX_FULL_RELOAD:
+                    self.load()
+                else:
+                    if pending:
+                        self._refresh_emails(pending)
+                    if ACCOUNT_INDEX_UPDATED_COLUMN:
+                        self._refresh_updated()
+                    ACCOUNT_INDEX_SIZE.set(len(self._entries))
+            except Exception as e:
+                logger.warning("⚠️ Error actualizando el índice de cuentas: %s", e)
+                with self._lock:
+                    self._pending |= pending
+                    self._reload_all = self._reload_all or reload_all
+                self._stop_event.wait(5.0)
+
+
+account_index = AccountIndex()
+accounts_listener.subscribe(account_index.on_accounts_changed)
+
+
+def get_parent_accounts() -> List[dict]:
+    """
+    Devuelve una fila por MAIL_MADRE con su password (para el watcher).
+    """
+    with db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                SELECT DISTINCT ON ("MAIL_MADRE")
+                    "MAIL_MADRE" AS icloud_user,
+                    "PASSWORD"   AS icloud_app_password
+                FROM "icloud_accounts"
+                ORDER BY "MAIL_MADRE"
+                """
+            )
+            return cur.fetchall()
+
+
 def get_account(email_in: str) -> Optional[dict]:
     """
     Busca en icloud_accounts una fila donde MAIL_MADRE = email
     o ALIAS = email. Devuelve usuario y password de iCloud.
+    Primero mira el índice precargado (ACCOUNT_INDEX_ENABLED) y la caché en
+    memoria (incluye los emails que no existen).
     """
-    conn = get_connection()
-    try:
+    if account_index.ready:
+        row = account_index.get(email_in)
+        if row is not None:
+            return row
+    cached = account_cache.get(email_in)
+    if cached is not AccountCache._MISSING:
+        return cached
+
+    with db_connection() as conn:
         with conn.cursor() as cur:
             cur.execute(
                 """
@@ -76,471 +997,3553 @@ def get_account(email_in: str) -> Optional[dict]:
                 (email_in, email_in),
             )
             row = cur.fetchone()
-            return row
-    finally:
-        conn.close()
 
+    account_cache.put(email_in, row)
+    return row
 
-# ------- HELPERS IMAP (iCloud) -------
 
-def decode_header_part(value: Optional[str]) -> str:
+def get_accounts(emails: List[str]) -> Dict[str, Optional[dict]]:
     """
-    Decodifica cualquier encabezado MIME (Subject, From, etc.)
+    Versión por lotes de get_account: lo que no está en caché se resuelve
+    con una sola query (MAIL_MADRE/ALIAS = ANY). Devuelve email -> fila o None.
     """
-    if not value:
-        return ""
-    try:
-        decoded_parts = email_lib.header.decode_header(value)
-        decoded_str = ""
-        for part, enc in decoded_parts:
-            if isinstance(part, bytes):
-                decoded_str += part.decode(enc or "utf-8", errors="ignore")
-            elif isinstance(part, str):
-                decoded_str += part
-            else:
-                decoded_str += str(part)
-        return decoded_str
-    except Exception as e:
-        logger.warning(f"⚠️ Error decodificando header: {e}")
-        return str(value) if value else ""
+    result: Dict[str, Optional[dict]] = {}
+    missing: List[str] = []
+    for email_in in emails:
+        indexed = account_index.get(email_in) if account_index.ready else None
+        if indexed is not None:
+            result[email_in] = indexed
+            continue
+        cached = account_cache.get(email_in)
+        if cached is AccountCache._MISSING:
+            missing.append(email_in)
+        else:
+            result[email_in] = cached
 
+    if missing:
+        with db_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    """
+                    SELECT
+                        "MAIL_MADRE" AS icloud_user,
+                        "ALIAS"      AS alias,
+                        "PASSWORD"   AS icloud_app_password
+                    FROM "icloud_accounts"
+                    WHERE "MAIL_MADRE" = ANY(%s)
+                       OR "ALIAS"      = ANY(%s)
+                    """,
+                    (missing, missing),
+                )
+                rows = cur.fetchall()
 
-def is_within_last_minutes(date_str: str, minutes: int = 10) -> bool:
-    """
-    Verifica si el email es de los últimos N minutos.
-    """
-    if not date_str:
-        return False
-    
-    try:
-        # Parsear fecha del email
-        email_date = parsedate_to_datetime(date_str)
-        
-        # Obtener tiempo actual (con timezone UTC)
-        now = datetime.now(email_date.tzinfo) if email_date.tzinfo else datetime.now()
-        
-        # Calcular diferencia
-        time_diff = now - email_date
-        
-        # Verificar si es de los últimos N minutos
-        is_recent = time_diff <= timedelta(minutes=minutes)
-        
-        logger.info(f"⏰ Email de hace {time_diff.total_seconds()/60:.1f} minutos - {'✅ Reciente' if is_recent else '❌ Antiguo'}")
-        
-        return is_recent
-    except Exception as e:
-        logger.warning(f"⚠️ Error parseando fecha '{date_str}': {e}")
-        # Si no puede parsear la fecha, asumimos que es reciente para no perder emails
-        return True
+        found: Dict[str, dict] = {}
+        for row in rows:
+            account = {"icloud_user": row["icloud_user"], "icloud_app_password": row["icloud_app_password"]}
+            for key in (row["alias"], row["icloud_user"]):
+                if key is not None:
+                    found.setdefault(key, account)
+        for email_in in missing:
+            row = found.get(email_in)
+            account_cache.put(email_in, row)
+            result[email_in] = row
 
+    return result
 
-def extract_otp_code(text: str) -> Optional[str]:
-    """
-    Extrae el código OTP de 6 dígitos del texto del email.
-    """
-    if not text:
-        return None
-    
-    patterns = [
-        r'código[:\s]+(\d{6})',
-        r'code[:\s]+(\d{6})',
-        r'verification[:\s]+(\d{6})',
-        r'\b(\d{6})\b',
-    ]
-    
-    for pattern in patterns:
-        match = re.search(pattern, text, re.IGNORECASE)
-        if match:
-            otp = match.group(1)
-            logger.info(f"🔑 OTP encontrado: {otp}")
-            return otp
-    
-    logger.warning("⚠️ No se encontró código OTP")
-    return None
 
+# ------- CÓDIGOS ENTREGADOS -------
 
-def extract_activation_url(text: str) -> Optional[str]:
+def check_code_log_table() -> bool:
     """
-    Extrae la URL de activación del email.
+    Comprueba que existe extracted_codes. La tabla la crea la migración
+    migrations/001_extracted_codes.sql; aquí no se cambia el esquema.
     """
-    if not text:
-        return None
-    
-    logger.info("🔍 Buscando URL de activación...")
-    
-    # Patrones para buscar URLs de activación (del más específico al más genérico)
-    patterns = [
-        # URL específica de tmtickets con ActivateAccount
-        r'(https://rwc2027\.tmtickets\.co\.uk/Authentication/ActivateAccount/[^\s<>"\']+)',
-        # Cualquier URL de tmtickets
-        r'(https://[^\s<>"\']*tmtickets\.co\.uk[^\s<>"\']*)',
-        # URL de rugbyworldcup con parámetros largos
-        r'(https://rwc2027\.rugbyworldcup\.com/[^\s<>"\']{20,})',
-    ]
-    
-    for pattern in patterns:
-        matches = re.findall(pattern, text, re.IGNORECASE)
-        if matches:
-            # Tomar la URL más larga (probablemente la completa con todos los parámetros)
-            url = max(matches, key=len)
-            # Limpiar la URL
-            url = url.rstrip('.,;)\'"')
-            # Decodificar HTML entities
-            url = url.replace('&amp;', '&')
-            url = url.replace('&quot;', '"')
-            url = url.replace('&#39;', "'")
-            url = url.replace('&lt;', '<')
-            url = url.replace('&gt;', '>')
-            
-            logger.info(f"🔗 URL de activación encontrada ({len(url)} chars): {url[:100]}...")
-            return url
-    
-    logger.warning("⚠️ No se encontró URL de activación con patrones específicos")
-    
-    # Último intento: buscar cualquier URL larga
-    all_urls = re.findall(r'https://[^\s<>"\']+', text)
-    if all_urls:
-        # Filtrar URLs largas que probablemente sean de activación
-        long_urls = [url for url in all_urls if len(url) > 100]
-        if long_urls:
-            url = max(long_urls, key=len)
-            url = url.rstrip('.,;)\'"')
-            url = url.replace('&amp;', '&')
-            logger.info(f"🔗 URL larga encontrada ({len(url)} chars): {url[:100]}...")
-            return url
-    
-    logger.warning("⚠️ No se encontró ninguna URL de activación")
-    return None
+    with db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT to_regclass('extracted_codes') IS NOT NULL AS present")
+            present = cur.fetchone()["present"]
+    if present:
+        logger.info("✅ Tabla extracted_codes presente")
+    else:
+        logger.error("❌ Falta la tabla extracted_codes (aplica migrations/001_extracted_codes.sql): el registro de códigos queda solo en memoria")
+    return present
 
 
-def extract_recipient_email(header_text: str) -> Optional[str]:
+class DeliveredCodeLog:
     """
-    Extrae el email del destinatario desde los headers.
+    Códigos entregados por alias: caché LRU en memoria delante de la tabla
+    extracted_codes. Se apunta antes de responder, así que si la respuesta se
+    pierde y el cliente reintenta (aquí o en otra instancia) recibe el mismo
+    código aunque el mensaje ya esté marcado como leído.
     """
-    recipient = None
-    
-    for line in header_text.split('\n'):
-        line_lower = line.lower()
-        if line_lower.startswith('delivered-to:') or line_lower.startswith('to:') or line_lower.startswith('x-original-to:'):
-            email_match = re.search(r'[\w\.-]+@[\w\.-]+\.\w+', line)
-            if email_match:
-                recipient = email_match.group(0).lower()
-                logger.info(f"📬 Destinatario encontrado: {recipient}")
-                return recipient
+
+    def __init__(self, window: float, max_size: int, persist: bool, miss_ttl: float):
+        self.window = window
+        self.max_size = max_size
+        self.persist = persist
+        self.miss_ttl = miss_ttl
+        self._lock = threading.Lock()
+        self._cache: "OrderedDict[str, Tuple[float, List[Message]]]" = OrderedDict()
+        # alias -> hasta cuándo se sabe que Postgres no tiene nada para él
+        self._misses: "OrderedDict[str, float]" = OrderedDict()
+
+    @staticmethod
+    def _key(alias: str) -> str:
+        return alias.lower().strip()
+
+    def _cache_put(self, alias: str, messages: List[Message], age: float = 0.0) -> None:
+        with self._lock:
+            self._misses.pop(self._key(alias), None)
+            self._cache[self._key(alias)] = (time.monotonic() + self.window - age, messages)
+            self._cache.move_to_end(self._key(alias))
+            while len(self._cache) > self.max_size:
+                self._cache.popitem(last=False)
+
+    def _cache_get(self, alias: str) -> Optional[List[Message]]:
+        key = self._key(alias)
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry is None:
+                return None
+            if entry[0] <= time.monotonic():
+                del self._cache[key]
+                return None
+            return entry[1]
+
+    def _recent_miss(self, alias: str) -> bool:
+        key = self._key(alias)
+        with self._lock:
+            expires_at = self._misses.get(key)
+            if expires_at is None:
+                return False
+            if expires_at <= time.monotonic():
+                del self._misses[key]
+                return False
+            return True
+
+    def _remember_misses(self, aliases: List[str]) -> None:
+        if self.miss_ttl <= 0:
+            return
+        expires_at = time.monotonic() + self.miss_ttl
+        with self._lock:
+            for alias in aliases:
+                self._misses[self._key(alias)] = expires_at
+                self._misses.move_to_end(self._key(alias))
+            while len(self._misses) > self.max_size:
+                self._misses.popitem(last=False)
+
+    def record(self, icloud_user: str, alias: str, hits: List[MailHit]) -> None:
+        self.record_many([(icloud_user, alias, hits)])
+
+    def record_many(self, deliveries: List[Tuple[str, str, List[MailHit]]]) -> None:
+        """
+        Apunta lo entregado a cada alias [(cuenta madre, alias, hits)] en un
+        solo INSERT. Un fallo de Postgres no rompe la respuesta: queda la caché local.
+        """
+        rows = []
+        for icloud_user, alias, hits in deliveries:
+            if not hits:
+                continue
+            if self.window > 0:
+                self._cache_put(alias, [hit.message for hit in hits])
+            rows.extend(
+                (
+                    self._key(alias), icloud_user, hit.message.email_type, hit.message.otp_code,
+                    hit.message.activation_url, hit.message.from_, hit.message.subject, hit.message.date,
+                    hit.message.to, hit.folder, hit.uid,
+                )
+                for hit in hits
+            )
+        if not rows or not self.persist:
+            return
+        try:
+            with PHASE_SECONDS.time(phase="code_log"):
+                with db_connection() as conn:
+                    with conn.cursor() as cur:
+                        cur.executemany(
+                            """
+                            INSERT INTO "extracted_codes"
+                                (alias, icloud_user, email_type, otp_code, activation_url,
+                                 from_header, subject, date_header, to_header, folder, uid)
+                            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+                            ON CONFLICT (icloud_user, folder, uid) DO NOTHING
+                            """,
+                            rows,
+                        )
+                    conn.commit()
+        except Exception as e:
+            logger.warning("⚠️ No se pudieron guardar %s códigos entregados: %s", len(rows), e)
+            ERRORS.inc(type=type(e).__name__, where="code_log")
+
+    def recent_many(self, aliases: List[str]) -> Dict[str, List[Message]]:
+        """
+        Lo entregado a cada alias dentro de la ventana (la última entrega).
+        Primero la caché; lo que falta y no se consultó hace poco sin
+        resultado (CODE_LOG_MISS_TTL), con una sola query.
+        """
+        result: Dict[str, List[Message]] = {}
+        if self.window <= 0:
+            return result
+        missing: List[str] = []
+        for alias in aliases:
+            cached = self._cache_get(alias)
+            if cached is not None:
+                result[alias] = cached
+            elif not self._recent_miss(alias):
+                missing.append(alias)
+        if not missing or not self.persist:
+            return result
+
+        try:
+            with PHASE_SECONDS.time(phase="code_log"):
+                with db_connection() as conn:
+                    with conn.cursor() as cur:
+                        cur.execute(
+                            """
+                            SELECT
+                                alias, email_type, otp_code, activation_url, from_header,
+                                subject, date_header, to_header, folder, extracted_at,
+                                EXTRACT(EPOCH FROM now() - extracted_at) AS age
+                            FROM "extracted_codes"
+                            WHERE alias = ANY(%s)
+                              AND extracted_at > now() - %s * INTERVAL '1 second'
+                            ORDER BY extracted_at DESC
+                            """,
+                            ([self._key(a) for a in missing], self.window),
+                        )
+                        rows = cur.fetchall()
+        except Exception as e:
+            logger.warning("⚠️ No se pudo consultar extracted_codes: %s", e)
+            ERRORS.inc(type=type(e).__name__, where="code_log")
+            return result
+
+        # Solo la última entrega de cada alias (varias filas si se entregaron juntas)
+        latest: Dict[str, list] = {}
+        for row in rows:
+            entries = latest.setdefault(row["alias"], [])
+            if not entries or entries[0]["extracted_at"] == row["extracted_at"]:
+                entries.append(row)
+        not_found: List[str] = []
+        for alias in missing:
+            entries = latest.get(self._key(alias))
+            if not entries:
+                not_found.append(alias)
+                continue
+            messages = [
+                Message(
+                    from_=row["from_header"] or "",
+                    subject=row["subject"] or "",
+                    date=row["date_header"] or "",
+                    to=row["to_header"] or "",
+                    otp_code=row["otp_code"],
+                    activation_url=row["activation_url"],
+                    email_type=row["email_type"],
+                    folder=row["folder"],
+                )
+                for row in entries
+            ]
+            self._cache_put(alias, messages, age=float(entries[0]["age"]))
+            result[alias] = messages
+        self._remember_misses(not_found)
+        return result
+
+    def recent(self, alias: str) -> List[Message]:
+        return self.recent_many([alias]).get(alias, [])
+
+
+code_log = DeliveredCodeLog(CODE_REPLAY_WINDOW, CODE_REPLAY_CACHE_SIZE, CODE_LOG_ENABLED, CODE_LOG_MISS_TTL)
+
+
+# ------- POOL DE SESIONES IMAP -------
+
+def imap_ssl_context() -> ssl.SSLContext:
+    """
+    Contexto TLS para iCloud (el mismo para imaplib y para el cliente asyncio).
+    """
+    context = ssl.create_default_context()
+    if not IMAP_TLS_VERIFY:
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+    return context
+
+
+class CircuitOpen(Exception):
+    """
+    La cuenta tiene el circuit breaker de login abierto: no se intenta conectar.
+    """
+
+    def __init__(self, icloud_user: str, retry_after: int):
+        super().__init__(f"Login de {icloud_user} en pausa tras fallos repetidos (reintentar en {retry_after}s)")
+        self.retry_after = retry_after
+
+
+class LoginCircuitBreaker:
+    """
+    Circuit breaker por MAIL_MADRE alrededor de conexión + LOGIN.
+    closed: se intenta siempre. open: tras threshold fallos seguidos, CircuitOpen
+    sin tocar la red hasta que pasa el cooldown. half-open: pasado el cooldown
+    entra un solo intento de prueba; si falla se vuelve a abrir con el doble de
+    cooldown y si va bien se cierra. Se guarda una huella del password con el
+    que falló: si llega otro (fila cambiada) el breaker se cierra.
+    """
+
+    def __init__(self, threshold: int, cooldown: float, max_cooldown: float):
+        self.threshold = max(1, threshold)
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self._lock = threading.Lock()
+        self._states: Dict[str, dict] = {}
+
+    @staticmethod
+    def _key(icloud_user: str) -> str:
+        return icloud_user.lower().strip()
+
+    @staticmethod
+    def _fingerprint(icloud_pass: str) -> str:
+        return hashlib.sha256(icloud_pass.encode()).hexdigest()[:16]
+
+    def before_connect(self, icloud_user: str, icloud_pass: str) -> None:
+        """
+        Lanza CircuitOpen si no toca intentar; si toca la prueba, la reserva.
+        """
+        if not LOGIN_BREAKER_ENABLED:
+            return
+        now = time.monotonic()
+        with self._lock:
+            state = self._states.get(self._key(icloud_user))
+            if state is None:
+                return
+            if state["fingerprint"] != self._fingerprint(icloud_pass):
+                logger.info("🔑 Password nuevo para %s: circuit breaker cerrado", icloud_user)
+                del self._states[self._key(icloud_user)]
+                return
+            if state["opened_at"] is None:
+                return
+            wait = state["opened_at"] + state["cooldown"] - now
+            # Una prueba colgada (el hilo murió sin avisar) no bloquea para siempre
+            probing = state["probe_started"] is not None and now - state["probe_started"] < 2 * IMAP_TIMEOUT
+            if wait > 0 or probing:
+                LOGIN_BREAKER_REJECTED.inc()
+                raise CircuitOpen(icloud_user, max(1, math.ceil(wait if wait > 0 else state["cooldown"])))
+            state["probe_started"] = now
+            logger.info("🔌 Probando login de %s (half-open)", icloud_user)
+
+    def record_success(self, icloud_user: str) -> None:
+        with self._lock:
+            if self._states.pop(self._key(icloud_user), None) is not None:
+                logger.info("✅ Circuit breaker de %s cerrado", icloud_user)
+
+    def record_failure(self, icloud_user: str, icloud_pass: str, where: str) -> None:
+        if not LOGIN_BREAKER_ENABLED:
+            return
+        now = time.monotonic()
+        fingerprint = self._fingerprint(icloud_pass)
+        with self._lock:
+            state = self._states.get(self._key(icloud_user))
+            if state is None or state["fingerprint"] != fingerprint:
+                state = {"fingerprint": fingerprint, "failures": 0, "opened_at": None, "cooldown": self.cooldown, "probe_started": None}
+                self._states[self._key(icloud_user)] = state
+            state["failures"] += 1
+            if state["probe_started"] is not None:
+                # Falló la prueba: otra vez abierto y con más espera
+                state["cooldown"] = min(self.max_cooldown, state["cooldown"] * 2)
+                state["opened_at"] = now
+                state["probe_started"] = None
+                logger.warning("🔌 Prueba de login de %s fallida (%s): breaker abierto %ss", icloud_user, where, state["cooldown"])
+            elif state["opened_at"] is None and state["failures"] >= self.threshold:
+                state["opened_at"] = now
+                logger.warning("🔌 %s fallos seguidos de %s en %s: breaker abierto %ss", state["failures"], where, icloud_user, state["cooldown"])
+
+    def reset(self, emails: Set[str]) -> None:
+        """
+        Suscriptor de accounts_listener: cierra los breakers de las cuentas
+        cambiadas (set vacío = todas, se pudieron perder avisos).
+        """
+        with self._lock:
+            if not emails:
+                self._states.clear()
+                return
+            for email_in in emails:
+                self._states.pop(self._key(email_in), None)
+
+
+login_breaker = LoginCircuitBreaker(LOGIN_BREAKER_THRESHOLD, LOGIN_BREAKER_COOLDOWN, LOGIN_BREAKER_MAX_COOLDOWN)
+accounts_listener.subscribe(login_breaker.reset)
+
+
+def _wake(future: "asyncio.Future") -> None:
+    if not future.done():
+        future.set_result(None)
+
+
+class IMAPConnectionBudget:
+    """
+    Tope de conexiones IMAP abiertas a la vez por MAIL_MADRE, uno solo para el
+    pool síncrono, el asyncio y los watchers de IDLE. El hueco se coge antes de
+    conectar y se devuelve con la conexión ya cerrada. Si la cuenta está al
+    tope, se pide a los pools (reclaimers) que cierren una sesión ociosa suya.
+
+    cond es también el lock de los pools: así esperar un hueco o una sesión
+    devuelta es un mismo wait, venga de donde venga.
+    """
+
+    def __init__(self, limit: int):
+        self.limit = max(1, limit)
+        self.cond = threading.Condition()
+        self._open: Dict[str, int] = {}
+        self._reclaiming: Dict[str, int] = {}
+        self._reclaimers: List = []
+        self._async_waiters: List[Tuple[asyncio.AbstractEventLoop, "asyncio.Future"]] = []
+
+    @staticmethod
+    def key(icloud_user: str) -> str:
+        return icloud_user.lower().strip()
+
+    def add_reclaimer(self, reclaim) -> None:
+        """
+        reclaim(key) se llama con cond tomado: saca una sesión ociosa de la
+        cuenta, programa su cierre (que acaba en release(key, reclaimed=True))
+        y devuelve True; False si no tiene ninguna.
+        """
+        self._reclaimers.append(reclaim)
+
+    def open_count(self, key: str) -> int:
+        with self.cond:
+            return self._open.get(key, 0)
+
+    def try_acquire_locked(self, key: str) -> bool:
+        if self._open.get(key, 0) < self.limit:
+            self._open[key] = self._open.get(key, 0) + 1
+            return True
+        # Al tope: una sesión ociosa de otro pool deja su hueco al cerrarse
+        # (una sola a la vez por cuenta para no vaciar el pool de golpe)
+        if not self._reclaiming.get(key):
+            for reclaim in self._reclaimers:
+                if reclaim(key):
+                    self._reclaiming[key] = self._reclaiming.get(key, 0) + 1
+                    break
+        return False
+
+    def acquire(self, key: str, timeout: float) -> bool:
+        """
+        Espera (bloqueando el hilo) hasta timeout a tener un hueco.
+        """
+        deadline = time.monotonic() + timeout
+        with self.cond:
+            while not self.try_acquire_locked(key):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self.cond.wait(remaining)
+        return True
+
+    def release(self, key: str, reclaimed: bool = False) -> None:
+        with self.cond:
+            self._open[key] = self._open.get(key, 0) - 1
+            if self._open[key] <= 0:
+                del self._open[key]
+            if reclaimed:
+                self._reclaiming[key] = self._reclaiming.get(key, 0) - 1
+                if self._reclaiming[key] <= 0:
+                    del self._reclaiming[key]
+            self.notify_locked()
+
+    def notify_locked(self) -> None:
+        """
+        Despierta a los que esperan (hilos y corrutinas): hay un hueco o una sesión ociosa.
+        """
+        self.cond.notify_all()
+        waiters, self._async_waiters = self._async_waiters, []
+        for loop, future in waiters:
+            loop.call_soon_threadsafe(_wake, future)
+
+    def async_waiter_locked(self) -> "asyncio.Future":
+        """
+        Future que se completa en el próximo notify_locked (para esperar desde el event loop).
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._async_waiters.append((loop, future))
+        return future
+
+
+imap_budget = IMAPConnectionBudget(IMAP_POOL_MAX_PER_ACCOUNT)
+
+
+class IdleIMAP4_SSL(imaplib.IMAP4_SSL):
+    """
+    IMAP4_SSL con IDLE (RFC 2177). imaplib no lo trae: el comando va con un tag
+    propio (no pasa por tagged_commands) y el socket y el file de lectura, que
+    un timeout deja inservibles, se gestionan aquí.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self._idle_seq = 0
+        super().__init__(*args, **kwargs)
+
+    def idle_wait(self, timeout: float) -> bool:
+        """
+        Entra en IDLE sobre la carpeta seleccionada y espera hasta que llegue
+        correo nuevo (EXISTS) o pase el timeout. Devuelve True si hubo cambios.
+        """
+        self._idle_seq += 1
+        tag = b"IDLE%d" % self._idle_seq
+        self.send(tag + b" IDLE\r\n")
+        line = self.readline()
+        if not line.startswith(b"+"):
+            raise self.error(f"IDLE rechazado: {line!r}")
+
+        changed = False
+        deadline = time.monotonic() + timeout
+        sock = self.socket()
+        previous_timeout = sock.gettimeout()  # el IMAP_TIMEOUT de la conexión
+        try:
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                sock.settimeout(remaining)
+                line = self.readline()
+                if not line:
+                    raise self.abort("Conexión cerrada durante IDLE")
+                if line.startswith(b"*") and (b"EXISTS" in line or b"RECENT" in line):
+                    changed = True
+                    break
+        except TimeoutError:
+            # El file de lectura queda inservible tras un timeout: se recrea
+            try:
+                self.file.close()
+            except OSError:
+                pass
+            self.file = sock.makefile("rb")
+        finally:
+            sock.settimeout(previous_timeout)
+
+        self.send(b"DONE\r\n")
+        while True:
+            line = self.readline()
+            if not line:
+                raise self.abort("Conexión cerrada al salir de IDLE")
+            if line.startswith(tag + b" "):
+                break
+        return changed
+
+    def interrupt(self) -> None:
+        """
+        Corta desde otro hilo un idle_wait bloqueado (shutdown() se quedaría
+        esperando el lock del file que usa ese hilo).
+        """
+        try:
+            self.socket().shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+
+class PooledIMAPSession:
+    """
+    Sesión IMAP ya autenticada que se guarda en el pool entre webhooks.
+    """
+
+    def __init__(self, imap: imaplib.IMAP4_SSL, password: str):
+        self.imap = imap
+        self.password = password
+        self.last_used = time.monotonic()
+
+
+class IMAPSessionPool:
+    """
+    Pool de sesiones IMAP autenticadas agrupadas por MAIL_MADRE.
+    Todos los alias de una misma cuenta madre reutilizan la misma conexión
+    (sin repetir el handshake TLS ni el LOGIN en cada webhook). Las conexiones
+    abiertas cuentan en budget, compartido con el otro pool y los watchers.
+    """
+
+    def __init__(self, budget: IMAPConnectionBudget, idle_timeout: float, noop_after: float, acquire_timeout: float):
+        self.budget = budget
+        self.idle_timeout = idle_timeout
+        self.noop_after = noop_after
+        self.acquire_timeout = acquire_timeout
+        self._cond = budget.cond
+        self._idle: Dict[str, List[PooledIMAPSession]] = {}
+        budget.add_reclaimer(self._reclaim_idle_locked)
+
+    @staticmethod
+    def _key(icloud_user: str) -> str:
+        return IMAPConnectionBudget.key(icloud_user)
+
+    @staticmethod
+    def _connect(icloud_user: str, icloud_pass: str) -> IdleIMAP4_SSL:
+        login_breaker.before_connect(icloud_user, icloud_pass)
+        try:
+            with PHASE_SECONDS.time(phase="connect"):
+                imap = IdleIMAP4_SSL(IMAP_HOST, IMAP_PORT, ssl_context=imap_ssl_context(), timeout=IMAP_TIMEOUT)
+        except (OSError, imaplib.IMAP4.error):
+            login_breaker.record_failure(icloud_user, icloud_pass, "connect")
+            raise
+        try:
+            with PHASE_SECONDS.time(phase="login"):
+                imap.login(icloud_user, icloud_pass)
+            logger.info("✅ Login exitoso para %s", icloud_user)
+        except imaplib.IMAP4.error as e:
+            _close_quietly(imap)
+            ERRORS.inc(type="login", where="imap")
+            login_breaker.record_failure(icloud_user, icloud_pass, "login")
+            raise Exception(f"Error autenticando en iCloud: {e}")
+        login_breaker.record_success(icloud_user)
+        try:
+            # Para que SELECT devuelva HIGHESTMODSEQ (lo usa el cursor)
+            imap.enable("CONDSTORE")
+        except imaplib.IMAP4.error:
+            pass
+        return imap
+
+    def _is_healthy(self, session: PooledIMAPSession) -> bool:
+        """
+        Solo hace NOOP si la sesión lleva un rato sin usarse.
+        """
+        if time.monotonic() - session.last_used < self.noop_after:
+            return True
+        try:
+            status, _ = session.imap.noop()
+            return status == "OK"
+        except Exception as e:
+            logger.warning("⚠️ Sesión IMAP caída (NOOP): %s", e)
+            return False
+
+    def _evict_idle_locked(self) -> None:
+        now = time.monotonic()
+        for key, sessions in self._idle.items():
+            alive = [s for s in sessions if now - s.last_used < self.idle_timeout]
+            if len(alive) != len(sessions):
+                for expired in sessions:
+                    if expired not in alive:
+                        self._close_later(key, expired)
+                self._idle[key] = alive
+
+    def _reclaim_idle_locked(self, key: str) -> bool:
+        idle = self._idle.get(key)
+        if not idle:
+            return False
+        self._close_later(key, idle.pop(0), reclaimed=True)  # la que lleva más tiempo sin usarse
+        return True
+
+    def _close_later(self, key: str, session: PooledIMAPSession, reclaimed: bool = False) -> None:
+        """
+        Cierra (LOGOUT) fuera del lock y devuelve el hueco al terminar.
+        """
+        threading.Thread(target=self._close_and_release, args=(key, session, reclaimed), name="imap-close", daemon=True).start()
+
+    def _close_and_release(self, key: str, session: PooledIMAPSession, reclaimed: bool = False) -> None:
+        _close_quietly(session.imap)
+        self.budget.release(key, reclaimed)
+
+    def _acquire(self, icloud_user: str, icloud_pass: str) -> PooledIMAPSession:
+        key = self._key(icloud_user)
+        deadline = time.monotonic() + self.acquire_timeout
+        session: Optional[PooledIMAPSession] = None
+        reserved = False
+
+        with self._cond:
+            self._evict_idle_locked()
+            while True:
+                idle = self._idle.setdefault(key, [])
+                while idle:
+                    candidate = idle.pop()
+                    if candidate.password == icloud_pass:
+                        session = candidate
+                        break
+                    # La contraseña cambió: la sesión vieja ya no sirve
+                    self._close_later(key, candidate)
+                if session is not None:
+                    break
+                if self.budget.try_acquire_locked(key):
+                    # Hueco reservado antes de conectar fuera del lock
+                    reserved = True
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+
+        if session is None and not reserved:
+            raise TimeoutError(f"No hay sesiones IMAP libres para {icloud_user}")
+
+        if session is not None:
+            if self._is_healthy(session):
+                logger.debug("♻️ Reutilizando sesión IMAP de %s", icloud_user)
+                return session
+            _close_quietly(session.imap)
+            logger.debug("🔄 Reconectando sesión IMAP de %s", icloud_user)
+
+        try:
+            return PooledIMAPSession(self._connect(icloud_user, icloud_pass), icloud_pass)
+        except Exception:
+            self._discard_slot(key)
+            raise
+
+    def _discard_slot(self, key: str) -> None:
+        self.budget.release(key)
+
+    def _release(self, icloud_user: str, session: PooledIMAPSession, broken: bool) -> None:
+        key = self._key(icloud_user)
+        if broken:
+            _close_quietly(session.imap)
+            self._discard_slot(key)
+            return
+        session.last_used = time.monotonic()
+        with self._cond:
+            self._idle.setdefault(key, []).append(session)
+            self.budget.notify_locked()
+
+    @contextmanager
+    def session(self, icloud_user: str, icloud_pass: str):
+        """
+        Presta una sesión autenticada. Si la conexión se cae durante el uso,
+        se descarta en vez de devolverla al pool.
+        """
+        pooled = self._acquire(icloud_user, icloud_pass)
+        broken = False
+        try:
+            yield pooled.imap
+        except (imaplib.IMAP4.abort, OSError):
+            broken = True
+            raise
+        finally:
+            self._release(icloud_user, pooled, broken)
+
+    def connect_dedicated(self, icloud_user: str, icloud_pass: str):
+        """
+        Conexión fuera del pool (la sesión IDLE de un watcher) que ocupa un
+        hueco de la cuenta hasta close_dedicated. TimeoutError si no lo hay.
+        """
+        key = self._key(icloud_user)
+        if not self.budget.acquire(key, self.acquire_timeout):
+            raise TimeoutError(f"No hay conexiones IMAP libres para {icloud_user}")
+        try:
+            return self._connect(icloud_user, icloud_pass)
+        except Exception:
+            self.budget.release(key)
+            raise
+
+    def close_dedicated(self, icloud_user: str, imap) -> None:
+        _close_quietly(imap)
+        self.budget.release(self._key(icloud_user))
+
+    def close_all(self) -> None:
+        with self._cond:
+            sessions = [(key, s) for key, idle in self._idle.items() for s in idle]
+            self._idle.clear()
+        for key, s in sessions:
+            _close_quietly(s.imap)
+            self.budget.release(key)
+
+
+def _close_quietly(imap) -> None:
+    try:
+        imap.logout()
+    except Exception:
+        pass
+
+
+imap_pool = IMAPSessionPool(
+    imap_budget,
+    IMAP_POOL_IDLE_TIMEOUT,
+    IMAP_POOL_NOOP_AFTER,
+    IMAP_POOL_ACQUIRE_TIMEOUT,
+)
+
+
+# ------- CLIENTE IMAP ASYNCIO -------
+
+class AsyncIMAPClient:
+    """
+    Cliente IMAP4rev1 mínimo sobre asyncio. Expone los mismos métodos que
+    imaplib para los comandos que usamos y devuelve las respuestas con el
+    mismo formato (status, data), así la lógica de búsqueda es la misma.
+    """
+
+    error = imaplib.IMAP4.error
+    abort = imaplib.IMAP4.abort
+
+    # Mismo límite de línea que imaplib (_MAXLINE); el de asyncio (64 KiB) se queda
+    # corto con un * SEARCH de miles de UIDs
+    MAX_LINE = 1000000
+
+    _tagged_re = re.compile(rb'(?P<tag>A\d+) (?P<type>[A-Z]+) ?(?P<data>.*)')
+    _untagged_status_re = re.compile(rb'\* (?P<data>\d+) (?P<type>[A-Z-]+)( (?P<data2>.*))?')
+    _untagged_re = re.compile(rb'\* (?P<type>[A-Z-]+)( (?P<data>.*))?')
+    _response_code_re = re.compile(rb'\[(?P<type>[A-Z-]+)( (?P<data>[^\]]*))?\]')
+    _literal_re = re.compile(rb'.*\{(?P<size>\d+)\}$')
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, timeout: float):
+        self._reader = reader
+        self._writer = writer
+        self._timeout = timeout
+        self._tag = 0
+        self._lock = asyncio.Lock()
+        self.untagged_responses: Dict[str, list] = {}
+
+    @classmethod
+    async def connect(cls, host: str, port: int, timeout: float = IMAP_TIMEOUT) -> "AsyncIMAPClient":
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(host, port, ssl=imap_ssl_context(), limit=cls.MAX_LINE), timeout
+        )
+        client = cls(reader, writer, timeout)
+        greeting = await client._readline()
+        if not greeting.startswith((b"* OK", b"* PREAUTH")):
+            writer.close()
+            raise cls.abort(f"Saludo IMAP inesperado: {greeting!r}")
+        return client
+
+    async def _readline(self) -> bytes:
+        try:
+            line = await asyncio.wait_for(self._reader.readline(), self._timeout)
+        except asyncio.TimeoutError:
+            raise self.abort("Timeout leyendo del servidor IMAP")
+        except (ValueError, asyncio.LimitOverrunError):
+            # El stream queda a medias: la sesión no se puede reutilizar
+            raise self.abort(f"Línea IMAP de más de {self.MAX_LINE} bytes")
+        if not line:
+            raise self.abort("socket error: EOF")
+        return line.rstrip(b"\r\n")
+
+    async def _read_literal(self, size: int) -> bytes:
+        try:
+            return await asyncio.wait_for(self._reader.readexactly(size), self._timeout)
+        except asyncio.TimeoutError:
+            raise self.abort("Timeout leyendo literal IMAP")
+        except asyncio.IncompleteReadError:
+            raise self.abort("socket error: EOF en literal")
+
+    def _append_untagged(self, typ: str, dat) -> None:
+        self.untagged_responses.setdefault(typ, []).append(dat)
+
+    async def _handle_untagged(self, line: bytes) -> None:
+        match = self._untagged_status_re.match(line)
+        if match:
+            dat = match.group("data")
+            if match.group("data2"):
+                dat = dat + b" " + match.group("data2")
+        else:
+            match = self._untagged_re.match(line)
+            if not match:
+                return
+            dat = match.group("data") or b""
+        typ = match.group("type").decode()
+        if typ == "BYE":
+            raise self.abort(dat.decode(errors="ignore"))
+
+        # Literales {n}: igual que imaplib, (prefijo, literal) y luego el resto
+        while True:
+            literal = self._literal_re.match(dat)
+            if not literal:
+                break
+            data = await self._read_literal(int(literal.group("size")))
+            self._append_untagged(typ, (dat, data))
+            dat = await self._readline()
+
+        self._append_untagged(typ, dat)
+        if typ in ("OK", "NO", "BAD"):
+            code = self._response_code_re.match(dat)
+            if code:
+                self._append_untagged(code.group("type").decode(), code.group("data"))
+
+    async def _command(self, name: str, *args) -> Tuple[str, list]:
+        async with self._lock:
+            self._tag += 1
+            tag = f"A{self._tag:04d}".encode()
+            data = tag + b" " + name.encode()
+            for arg in args:
+                if arg is None:
+                    continue
+                if isinstance(arg, str):
+                    arg = arg.encode()
+                data += b" " + arg
+            self._writer.write(data + b"\r\n")
+            await self._writer.drain()
+
+            while True:
+                line = await self._readline()
+                if line.startswith(tag + b" "):
+                    tagged = self._tagged_re.match(line)
+                    typ = tagged.group("type").decode()
+                    dat = tagged.group("data")
+                    if typ == "BAD":
+                        raise self.error(f"{name} command error: {typ} {[dat]}")
+                    return typ, [dat]
+                if line.startswith(b"*"):
+                    await self._handle_untagged(line)
+
+    def _untagged_response(self, typ: str, dat: list, name: str) -> Tuple[str, list]:
+        if typ == "NO":
+            return typ, dat
+        return typ, self.untagged_responses.pop(name, [None])
+
+    # --- API compatible con imaplib ---
+
+    async def login(self, user: str, password: str) -> Tuple[str, list]:
+        quoted = '"' + password.replace("\\", "\\\\").replace('"', '\\"') + '"'
+        typ, dat = await self._command("LOGIN", user, quoted)
+        if typ != "OK":
+            raise self.error(dat[-1])
+        return typ, dat
+
+    async def select(self, mailbox: str = "INBOX", readonly: bool = False) -> Tuple[str, list]:
+        self.untagged_responses = {}
+        typ, dat = await self._command("EXAMINE" if readonly else "SELECT", mailbox)
+        if typ != "OK":
+            return typ, dat
+        return self._untagged_response(typ, dat, "EXISTS")
+
+    async def search(self, charset: Optional[str], *criteria) -> Tuple[str, list]:
+        if charset:
+            criteria = ("CHARSET", charset) + criteria
+        typ, dat = await self._command("SEARCH", *criteria)
+        return self._untagged_response(typ, dat, "SEARCH")
+
+    async def fetch(self, message_set, message_parts: str) -> Tuple[str, list]:
+        typ, dat = await self._command("FETCH", message_set, message_parts)
+        return self._untagged_response(typ, dat, "FETCH")
+
+    async def store(self, message_set, command: str, flags: str) -> Tuple[str, list]:
+        typ, dat = await self._command("STORE", message_set, command, flags)
+        return self._untagged_response(typ, dat, "FETCH")
+
+    async def uid(self, command: str, *args) -> Tuple[str, list]:
+        command = command.upper()
+        typ, dat = await self._command("UID", command, *args)
+        name = command if command in ("SEARCH", "SORT", "THREAD") else "FETCH"
+        return self._untagged_response(typ, dat, name)
+
+    async def status(self, mailbox: str, names: str) -> Tuple[str, list]:
+        typ, dat = await self._command("STATUS", mailbox, names)
+        return self._untagged_response(typ, dat, "STATUS")
+
+    async def expunge(self) -> Tuple[str, list]:
+        typ, dat = await self._command("EXPUNGE")
+        return self._untagged_response(typ, dat, "EXPUNGE")
+
+    async def noop(self) -> Tuple[str, list]:
+        return await self._command("NOOP")
+
+    async def enable(self, capability: str) -> Tuple[str, list]:
+        typ, dat = await self._command("ENABLE", capability)
+        if typ != "OK":
+            raise self.error(f"ENABLE {capability}: {dat[-1]!r}")
+        return self._untagged_response(typ, dat, "ENABLED")
+
+    async def response(self, code: str) -> Tuple[str, list]:
+        return code, self.untagged_responses.pop(code.upper(), [None])
+
+    async def close(self) -> Tuple[str, list]:
+        return await self._command("CLOSE")
+
+    async def logout(self) -> Tuple[str, list]:
+        try:
+            typ, dat = await self._command("LOGOUT")
+        except imaplib.IMAP4.abort:
+            typ, dat = "BYE", [b""]
+        finally:
+            self._writer.close()
+        return typ, dat
+
+
+class AsyncIMAPSessionPool(IMAPSessionPool):
+    """
+    Versión asyncio de IMAPSessionPool (mismas reglas: tope por cuenta,
+    NOOP tras inactividad, expiración y descarte de sesiones rotas). El lock
+    del budget solo se toma para secciones cortas; las esperas son futures
+    que despierta budget.notify_locked.
+    """
+
+    def __init__(self, budget: IMAPConnectionBudget, idle_timeout: float, noop_after: float, acquire_timeout: float):
+        super().__init__(budget, idle_timeout, noop_after, acquire_timeout)
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def _close_later(self, key: str, session: PooledIMAPSession, reclaimed: bool = False) -> None:
+        # Las sesiones son del event loop del pool: el cierre se programa ahí (se puede llamar desde otro hilo)
+        asyncio.run_coroutine_threadsafe(self._aclose_and_release(key, session, reclaimed), self._loop)
+
+    async def _aclose_and_release(self, key: str, session: PooledIMAPSession, reclaimed: bool = False) -> None:
+        await _aclose_quietly(session.imap)
+        self.budget.release(key, reclaimed)
+
+    @staticmethod
+    async def _connect_async(icloud_user: str, icloud_pass: str) -> AsyncIMAPClient:
+        login_breaker.before_connect(icloud_user, icloud_pass)
+        try:
+            with PHASE_SECONDS.time(phase="connect"):
+                client = await AsyncIMAPClient.connect(IMAP_HOST, IMAP_PORT)
+        except (OSError, asyncio.TimeoutError, imaplib.IMAP4.error):
+            login_breaker.record_failure(icloud_user, icloud_pass, "connect")
+            raise
+        try:
+            with PHASE_SECONDS.time(phase="login"):
+                await client.login(icloud_user, icloud_pass)
+            logger.info("✅ Login exitoso para %s", icloud_user)
+        except imaplib.IMAP4.error as e:
+            await _aclose_quietly(client)
+            ERRORS.inc(type="login", where="imap")
+            login_breaker.record_failure(icloud_user, icloud_pass, "login")
+            raise Exception(f"Error autenticando en iCloud: {e}")
+        login_breaker.record_success(icloud_user)
+        try:
+            await client.enable("CONDSTORE")
+        except imaplib.IMAP4.error:
+            pass
+        return client
+
+    async def _is_healthy_async(self, session: PooledIMAPSession) -> bool:
+        if time.monotonic() - session.last_used < self.noop_after:
+            return True
+        try:
+            status, _ = await session.imap.noop()
+            return status == "OK"
+        except Exception as e:
+            logger.warning("⚠️ Sesión IMAP caída (NOOP): %s", e)
+            return False
+
+    async def _acquire_async(self, icloud_user: str, icloud_pass: str) -> PooledIMAPSession:
+        key = self._key(icloud_user)
+        deadline = time.monotonic() + self.acquire_timeout
+        session: Optional[PooledIMAPSession] = None
+        reserved = False
+        self._loop = asyncio.get_running_loop()
+
+        while True:
+            with self._cond:
+                self._evict_idle_locked()
+                idle = self._idle.setdefault(key, [])
+                while idle:
+                    candidate = idle.pop()
+                    if candidate.password == icloud_pass:
+                        session = candidate
+                        break
+                    self._close_later(key, candidate)
+                if session is not None:
+                    break
+                if self.budget.try_acquire_locked(key):
+                    reserved = True
+                    break
+                woken = self.budget.async_waiter_locked()
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                await asyncio.wait_for(woken, remaining)
+            except asyncio.TimeoutError:
+                break
+
+        if session is None and not reserved:
+            raise TimeoutError(f"No hay sesiones IMAP libres para {icloud_user}")
+
+        if session is not None:
+            if await self._is_healthy_async(session):
+                logger.debug("♻️ Reutilizando sesión IMAP de %s", icloud_user)
+                return session
+            await _aclose_quietly(session.imap)
+            logger.debug("🔄 Reconectando sesión IMAP de %s", icloud_user)
+
+        try:
+            return PooledIMAPSession(await self._connect_async(icloud_user, icloud_pass), icloud_pass)
+        except Exception:
+            self._discard_slot(key)
+            raise
+
+    async def _release_async(self, icloud_user: str, session: PooledIMAPSession, broken: bool) -> None:
+        key = self._key(icloud_user)
+        if broken:
+            await _aclose_quietly(session.imap)
+            self._discard_slot(key)
+            return
+        session.last_used = time.monotonic()
+        with self._cond:
+            self._idle.setdefault(key, []).append(session)
+            self.budget.notify_locked()
+
+    @asynccontextmanager
+    async def session(self, icloud_user: str, icloud_pass: str):
+        pooled = await self._acquire_async(icloud_user, icloud_pass)
+        broken = False
+        try:
+            yield pooled.imap
+        except (imaplib.IMAP4.abort, OSError, asyncio.CancelledError):
+            broken = True
+            raise
+        finally:
+            await self._release_async(icloud_user, pooled, broken)
+
+    async def close_all(self) -> None:
+        with self._cond:
+            sessions = [(key, s) for key, idle in self._idle.items() for s in idle]
+            self._idle.clear()
+        for key, s in sessions:
+            await _aclose_quietly(s.imap)
+            self.budget.release(key)
+
+
+async def _aclose_quietly(client: AsyncIMAPClient) -> None:
+    try:
+        await client.logout()
+    except Exception:
+        pass
+
+
+async_imap_pool = AsyncIMAPSessionPool(
+    imap_budget,
+    IMAP_POOL_IDLE_TIMEOUT,
+    IMAP_POOL_NOOP_AFTER,
+    IMAP_POOL_ACQUIRE_TIMEOUT,
+)
+
+
+# ------- HELPERS IMAP (iCloud) -------
+
+def decode_header_part(value: Optional[str]) -> str:
+    """
+    Decodifica cualquier encabezado MIME (Subject, From, etc.)
+    """
+    if not value:
+        return ""
+    try:
+        decoded_parts = email_lib.header.decode_header(value)
+        decoded_str = ""
+        for part, enc in decoded_parts:
+            if isinstance(part, bytes):
+                decoded_str += part.decode(enc or "utf-8", errors="ignore")
+            elif isinstance(part, str):
+                decoded_str += part
+            else:
+                decoded_str += str(part)
+        return decoded_str
+    except Exception as e:
+        logger.warning("⚠️ Error decodificando header: %s", e)
+        return str(value) if value else ""
+
+
+def is_within_last_minutes(date_str: str, minutes: int = 10) -> bool:
+    """
+    Verifica si el email es de los últimos N minutos.
+    """
+    if not date_str:
+        return False
+    
+    try:
+        # Parsear fecha del email
+        email_date = parsedate_to_datetime(date_str)
+        
+        # Obtener tiempo actual (con timezone UTC)
+        now = datetime.now(email_date.tzinfo) if email_date.tzinfo else datetime.now()
+        
+        # Calcular diferencia
+        time_diff = now - email_date
+        
+        # Verificar si es de los últimos N minutos
+        is_recent = time_diff <= timedelta(minutes=minutes)
+        
+        logger.debug("⏰ Email de hace %.1f minutos - %s", time_diff.total_seconds()/60, '✅ Reciente' if is_recent else '❌ Antiguo')
+        
+        return is_recent
+    except Exception as e:
+        logger.warning("⚠️ Error parseando fecha '%s': %s", date_str, e)
+        # Si no puede parsear la fecha, asumimos que es reciente para no perder emails
+        return True
+
+
+def extract_otp_code(text: str) -> Optional[str]:
+    """
+    Extrae el código OTP de 6 dígitos del texto del email.
+    """
+    if not text:
+        return None
+    
+    otp = OTP_EXTRACTOR.extract(text)
+    if otp:
+        logger.debug("🔑 OTP encontrado")
+        return otp
+    
+    logger.debug("⚠️ No se encontró código OTP")
+    return None
+
+
+def extract_activation_url(text: str) -> Optional[str]:
+    """
+    Extrae la URL de activación del email.
+    """
+    if not text:
+        return None
+    
+    logger.debug("🔍 Buscando URL de activación...")
+    
+    # Cada regla, por prioridad, se busca antes en los href y después en el
+    # texto (texto plano, URLs fuera de un href...); el fallback solo en el texto
+    # (los href se buscan tal cual y solo se desescapa la URL elegida)
+    hrefs = iter_hrefs(text, keep=_may_be_activation_url, unescape=False) if ACTIVATION_URL_FROM_HREF else ()
+    url = ACTIVATION_URL_EXTRACTOR.extract_from((text,), preferred=hrefs, preferred_clean=_clean_href_url)
+    if url:
+        logger.debug("🔗 URL de activación encontrada (%s chars)", len(url))
+        return url
+    
+    logger.debug("⚠️ No se encontró ninguna URL de activación")
+    return None
+
+
+_EMAIL_ADDRESS_RE = re.compile(r'[\w\.-]+@[\w\.-]+\.\w+')
+RECIPIENT_HEADERS = (b"delivered-to", b"to", b"x-original-to")
+
+
+class ParsedHeaders:
+    """
+    Bloque de headers parseado una sola vez a nivel de bytes: desdobla las
+    líneas de continuación (folding) e indexa los campos por nombre en
+    minúsculas. Los valores se guardan en bytes; el RFC 2047 solo se
+    decodifica (y se cachea) para los campos que se piden con decoded().
+    """
+
+    __slots__ = ("_fields", "_order", "_decoded")
+
+    def __init__(self, data: bytes):
+        self._fields: Dict[bytes, bytes] = {}
+        self._order: List[Tuple[bytes, bytes]] = []
+        self._decoded: Dict[str, str] = {}
+
+        name = None
+        value: List[bytes] = []
+        for line in data.splitlines():
+            if line[:1] in (b" ", b"\t"):
+                # Continuación del campo anterior (se quita solo el salto de línea)
+                if name is not None:
+                    value.append(line)
+                continue
+            if name is not None:
+                self._add(name, value)
+            colon = line.find(b":")
+            if colon <= 0:
+                name = None
+                continue
+            name = line[:colon].strip().lower()
+            value = [line[colon + 1:]]
+        if name is not None:
+            self._add(name, value)
+
+    def _add(self, name: bytes, value: List[bytes]) -> None:
+        joined = b"".join(value).strip()
+        self._order.append((name, joined))
+        self._fields.setdefault(name, joined)
+
+    def raw(self, name: str) -> str:
+        """
+        Valor sin decodificar (primera aparición del campo), o "" si no está.
+        """
+        return self._fields.get(name.lower().encode("ascii"), b"").decode("utf-8", errors="ignore")
+
+    def decoded(self, name: str) -> str:
+        """
+        Valor con las palabras RFC 2047 decodificadas (se hace una vez por campo).
+        """
+        key = name.lower()
+        if key not in self._decoded:
+            self._decoded[key] = decode_header_part(self.raw(key))
+        return self._decoded[key]
+
+    def recipient(self) -> Optional[str]:
+        """
+        Primera dirección en Delivered-To / To / X-Original-To, en el orden del bloque.
+        """
+        for name, value in self._order:
+            if name in RECIPIENT_HEADERS:
+                match = _EMAIL_ADDRESS_RE.search(value.decode("utf-8", errors="ignore"))
+                if match:
+                    return match.group(0).lower()
+        return None
+
+
+def parse_headers(data) -> ParsedHeaders:
+    if isinstance(data, str):
+        data = data.encode("utf-8")
+    return ParsedHeaders(data)
+
+
+def extract_recipient_email(header_text) -> Optional[str]:
+    """
+    Extrae el email del destinatario desde los headers (texto, bytes o ParsedHeaders).
+    """
+    headers = header_text if isinstance(header_text, ParsedHeaders) else parse_headers(header_text)
+    recipient = headers.recipient()
+    if recipient:
+        logger.debug("📬 Destinatario encontrado: %s", recipient)
+    return recipient
+
+
+# ------- REGLAS DE CLASIFICACIÓN Y EXTRACCIÓN -------
+
+class PatternExtractor:
+    """
+    Varios patrones con prioridad (cada uno con un único grupo de captura),
+    compilados por separado y probados en orden: un patrón solo se mira si
+    ninguno de más prioridad coincidió, y cada uno recorre el texto entero
+    por su cuenta, así una coincidencia de menos prioridad nunca tapa a otra
+    de más prioridad que esté dentro de ella (una URL envuelta en otra).
+
+    pick="first": primera aparición del patrón (re.search), para en cuanto uno coincide.
+    pick="longest": la coincidencia más larga del patrón (finditer + max).
+    Los patrones fallback solo se usan si no hubo ningún principal y la
+    coincidencia mide más de fallback_min_len.
+
+    prefix es un literal común a los patrones principales (que entonces se
+    escriben sin él): se compara con los mismos flags y el valor devuelto lo
+    lleva tal cual aparece en el texto. Su final sin letras ("://" en
+    "https://") se busca tal cual y el resto se comprueba hacia atrás: con
+    IGNORECASE re no salta a un literal con letras y recorre carácter a
+    carácter, unas 15 veces más lento en un HTML grande.
+    """
+
+    def __init__(self, patterns: List[str], pick: str = "first", clean=None, fallback: Optional[List[str]] = None,
+                 fallback_min_len: int = 0, fallback_clean=None, prefix: str = "", flags: int = re.IGNORECASE):
+        anchor = re.search(r"[^A-Za-z]*$", prefix).group(0)
+        if anchor and anchor != prefix:
+            lead = f"(?-i:{re.escape(anchor)})(?<={re.escape(prefix)})"
+            # La parte del prefix que queda antes del inicio del match
+            self._behind = len(prefix) - len(anchor)
+        else:
+            lead = re.escape(prefix)
+            self._behind = 0
+        self._primary = [re.compile(f"{lead}(?:{pattern})", flags) for pattern in patterns]
+        self._fallback = [re.compile(pattern, flags) for pattern in fallback or []]
+        for regex in self._primary + self._fallback:
+            if regex.groups != 1:
+                raise ValueError(f"El patrón debe tener un único grupo de captura: {regex.pattern}")
+        self.pick = pick
+        self.prefix = prefix
+        self.clean = clean or (lambda value: value)
+        self.fallback_min_len = fallback_min_len
+        self.fallback_clean = fallback_clean or self.clean
+
+    def extract(self, text: str) -> Optional[str]:
+        if not text:
+            return None
+        return self.extract_from((text,))
+
+    def extract_from(self, texts: Iterable[str], preferred: Iterable[str] = (), preferred_clean=None) -> Optional[str]:
+        """
+        Igual que extract sobre varios trozos, con la misma prioridad que si
+        fueran un solo texto. Los trozos de preferred (por ejemplo los href de
+        un HTML) se miran, dentro de cada patrón, antes que texts, y su valor
+        pasa por preferred_clean si se da; los fallbacks solo se buscan en texts.
+        """
+        texts = texts if isinstance(texts, (list, tuple)) else list(texts)
+        preferred = preferred if isinstance(preferred, (list, tuple)) else list(preferred)
+        for regex in self._primary:
+            value = self._pick(regex, preferred)
+            if value is not None:
+                return (preferred_clean or self.clean)(value)
+            value = self._pick(regex, texts)
+            if value is not None:
+                return self.clean(value)
+
+        fallback_values = [
+            match.group(1)
+            for regex in self._fallback
+            for text in texts
+            for match in regex.finditer(text)
+            if len(match.group(1)) > self.fallback_min_len
+        ]
+        if fallback_values:
+            return self.fallback_clean(max(fallback_values, key=len))
+        return None
+
+    def _pick(self, regex: "re.Pattern", chunks: List[str]) -> Optional[str]:
+        values = []
+        for text in chunks:
+            for match in regex.finditer(text):
+                # Con prefix el grupo empieza justo detrás: se devuelve desde el inicio del match
+                values.append(text[match.start() - self._behind:match.end(1)] if self.prefix else match.group(1))
+                if self.pick == "first":
+                    return values[0]
+        return max(values, key=len) if values else None
+
+
+def _clean_href_url(url: str) -> str:
+    # Mismo orden que _clean_activation_url: primero la puntuación final, luego las entidades
+    return unescape_entities(url.rstrip('.,;)\'"'))
+
+
+def _clean_activation_url(url: str) -> str:
+    url = url.rstrip('.,;)\'"')
+    # Decodificar HTML entities
+    for entity, char in (('&amp;', '&'), ('&quot;', '"'), ('&#39;', "'"), ('&lt;', '<'), ('&gt;', '>')):
+        url = url.replace(entity, char)
+    return url
+
+
+OTP_EXTRACTOR = PatternExtractor([
+    r'código[:\s]+(\d{6})',
+    r'code[:\s]+(\d{6})',
+    r'verification[:\s]+(\d{6})',
+    r'\b(\d{6})\b',
+])
+
+ACTIVATION_URL_PATTERNS = [
+    # URL específica de tmtickets con ActivateAccount
+    r'(rwc2027\.tmtickets\.co\.uk/Authentication/ActivateAccount/[^\s<>"\']+)',
+    # Cualquier URL de tmtickets
+    r'([^\s<>"\']*tmtickets\.co\.uk[^\s<>"\']*)',
+    # URL de rugbyworldcup con parámetros largos
+    r'(rwc2027\.rugbyworldcup\.com/[^\s<>"\']{20,})',
+]
+# Último intento: cualquier URL larga (probablemente la de activación); como
+# antes, aquí el esquema sí distingue mayúsculas
+ACTIVATION_URL_FALLBACK = [r'(?-i:(https://[^\s<>"\']+))']
+
+ACTIVATION_URL_EXTRACTOR = PatternExtractor(
+    ACTIVATION_URL_PATTERNS,
+    prefix="https://",
+    pick="longest",
+    clean=_clean_activation_url,
+    fallback=ACTIVATION_URL_FALLBACK,
+    fallback_min_len=100,
+    fallback_clean=lambda url: url.rstrip('.,;)\'"').replace('&amp;', '&'),
+)
+
+# Valor de un atributo href (entre comillas dobles, simples o sin comillas).
+# En minúsculas a propósito: con un literal fijo al principio el motor salta
+# directamente de un href al siguiente; un HREF en mayúsculas lo sigue
+# encontrando el recorrido de texto completo de extract_activation_url.
+_HREF_RE = re.compile(r'''href\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s"'>]+))''')
+
+
+# Solo entidades completas (con ;): html.unescape también cambia "&para=1" o
+# "&copy=2" de una query por ¶=1 / ©=2
+_ENTITY_RE = re.compile(r'&(?:#[0-9]+|#[xX][0-9a-fA-F]+|[A-Za-z][A-Za-z0-9]*);')
+
+
+def unescape_entities(value: str) -> str:
+    if "&" not in value:
+        return value
+    return _ENTITY_RE.sub(lambda match: html_lib.unescape(match.group(0)), value)
+
+
+def iter_hrefs(html_text: str, keep=None, unescape: bool = True):
+    """
+    Recorre el HTML una vez y va devolviendo los href, con las entidades
+    desescapadas (&amp;, &#x2F;, &quot;...) salvo unescape=False.
+    keep(valor_crudo) descarta enlaces sin llegar a desescaparlos.
+    """
+    for match in _HREF_RE.finditer(html_text):
+        value = match.group(match.lastindex)
+        if keep is not None and not keep(value):
+            continue
+        yield unescape_entities(value) if unescape else value
+
+
+def _may_be_activation_url(href: str) -> bool:
+    """
+    Filtro barato antes de pasar las reglas: solo enlaces a tmtickets o rugbyworldcup.
+    """
+    href = href.lower()
+    return "tmtickets.co.uk" in href or "rugbyworldcup.com" in href
+
+
+class EmailRule:
+    """
+    Un tipo de email: remitente/asunto que lo identifican, de qué parte del
+    body y con qué función se extrae el dato, y el campo de Message que rellena.
+    """
+
+    def __init__(self, name: str, subject: str, extract, field: str, sender: Optional[str] = None,
+                 bodies: Tuple[str, ...] = ("text/plain", "text/html"), first_body_only: bool = False,
+                 search: Optional[Dict[str, str]] = None, label: str = ""):
+        self.name = name
+        self.subject = subject  # regex buscada en el asunto (sin mayúsculas)
+        self.sender = sender  # texto que debe aparecer en el From
+        self.extract_fn = extract
+        self.field = field
+        self.bodies = bodies  # orden de preferencia de las partes de texto
+        self.first_body_only = first_body_only  # solo mirar la primera parte no vacía
+        self.search = search or {}
+        self.label = label or name
+
+    def extract(self, body_text: str, body_html: str) -> Optional[str]:
+        parts = {"text/plain": body_text, "text/html": body_html}
+        for content_type in self.bodies:
+            text = parts.get(content_type)
+            if not text:
+                continue
+            value = self.extract_fn(text)
+            if value or self.first_body_only:
+                return value
+        return None
+
+
+class EmailRuleRegistry:
+    """
+    Reglas por orden de prioridad. Todas se compilan en una sola regex sobre
+    From + separador (\\x1f) + Subject con un grupo por regla, así clasificar
+    es un solo match.
+    """
+
+    def __init__(self):
+        self._rules: List[EmailRule] = []
+        self._by_name: Dict[str, EmailRule] = {}
+        self._matcher = None
+
+    def register(self, rule: EmailRule) -> EmailRule:
+        self._rules.append(rule)
+        self._by_name[rule.name] = rule
+        if rule.search:
+            EMAIL_TYPE_SEARCH.setdefault(rule.name, rule.search)
+        alternatives = []
+        for i, r in enumerate(self._rules):
+            sender = f"[^\x1f]*{re.escape(r.sender)}" if r.sender else ""
+            alternatives.append(f"(?P<r{i}>{sender}[^\x1f]*\x1f.*?(?:{r.subject}))")
+        self._matcher = re.compile("|".join(alternatives), re.IGNORECASE | re.DOTALL)
+        return rule
+
+    def get(self, name: str) -> Optional[EmailRule]:
+        return self._by_name.get(name)
+
+    def names(self) -> List[str]:
+        return [r.name for r in self._rules]
+
+    def classify(self, from_header: str, subject: str) -> Optional[EmailRule]:
+        if self._matcher is None:
+            return None
+        key = f"{from_header.replace(chr(0x1f), ' ')}\x1f{subject.replace(chr(0x1f), ' ')}"
+        match = self._matcher.match(key)
+        if not match:
+            return None
+        return self._rules[int(match.lastgroup[1:])]
+
+
+email_rules = EmailRuleRegistry()
+
+email_rules.register(EmailRule(
+    "FIFA",
+    subject=r"fifa id",
+    extract=extract_otp_code,
+    field="otp_code",
+    first_body_only=True,
+    search={"subject": "FIFA ID"},
+    label="🎯 ¡Encontrado mensaje de FIFA!",
+))
+
+email_rules.register(EmailRule(
+    "RUGBY",
+    sender="noreplyrwc2027@rugbyworldcup.com",
+    subject=r"(?=.*activate)(?=.*rugby world cup)|ticketing account",
+    extract=extract_activation_url,
+    field="activation_url",
+    # Intentar con HTML primero, luego texto
+    bodies=("text/html", "text/plain"),
+    search={"from": "noreplyrwc2027@rugbyworldcup.com"},
+    label="🏉 ¡Encontrado mensaje de Rugby World Cup 2027!",
+))
+
+
+_FETCH_UID_RE = re.compile(rb'UID (\d+)')
+_FETCH_FLAGS_RE = re.compile(rb'FLAGS \(([^)]*)\)')
+_FETCH_START_RE = re.compile(rb'^\d+ \(')
+
+
+def parse_fetch_response(data: list) -> Dict[str, Tuple[bytes, Optional[bytes]]]:
+    """
+    Agrupa la respuesta de un UID FETCH (formato imaplib) por UID.
+    Devuelve UID -> (metadatos sin el literal, literal o None).
+    """
+    records: List[list] = []
+    for part in data:
+        if isinstance(part, tuple):
+            records.append([part[0], part[1]])
+        elif isinstance(part, bytes):
+            if _FETCH_START_RE.match(part) or not records:
+                records.append([part, None])
+            else:
+                # Lo que viene después del literal (p.ej. ' FLAGS (\Seen))')
+                records[-1][0] += b" " + part
+
+    result: Dict[str, Tuple[bytes, Optional[bytes]]] = {}
+    for meta, literal in records:
+        uid = _FETCH_UID_RE.search(meta)
+        if uid:
+            result[uid.group(1).decode()] = (meta, literal)
+    return result
+
+
+def fetch_flags(meta: bytes) -> bytes:
+    match = _FETCH_FLAGS_RE.search(meta)
+    return match.group(1) if match else b""
+
+
+_IMAP_MONTHS = ("Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep", "Oct", "Nov", "Dec")
+
+
+def imap_quote(value: str) -> str:
+    return '"' + value.replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+
+def imap_date(value: datetime) -> str:
+    """
+    Fecha IMAP DD-Mon-YYYY sin depender del locale (strftime %b sí depende).
+    """
+    return f"{value.day:02d}-{_IMAP_MONTHS[value.month - 1]}-{value.year}"
+
+
+def _or_criteria(terms: List[str]) -> str:
+    # OR de IMAP es binario: OR a (OR b c)...
+    if len(terms) == 1:
+        return terms[0]
+    return f"OR {terms[0]} {_or_criteria(terms[1:])}"
+
+
+def build_search_criteria(minutes: int, target_email: Optional[str] = None, email_types: Optional[List[str]] = None) -> str:
+    """
+    Construye el criterio de UID SEARCH para que el servidor devuelva solo
+    candidatos: UNSEEN, SINCE, (FROM/SUBJECT de cada tipo) y el destinatario.
+    SINCE va por día y con la fecha interna del servidor, así que se deja un
+    día de margen; la ventana exacta en minutos la sigue comprobando el cliente.
+    """
+    if IMAP_SEARCH_MODE == "all":
+        return "ALL"
+
+    since = datetime.now(timezone.utc) - timedelta(minutes=minutes, days=1)
+    parts = ["UNSEEN", f"SINCE {imap_date(since)}"]
+
+    type_terms = []
+    for email_type in email_types or list(EMAIL_TYPE_SEARCH):
+        filters = EMAIL_TYPE_SEARCH.get(email_type) or {}
+        terms = [f"{key.upper()} {imap_quote(value)}" for key, value in filters.items()]
+        if terms:
+            type_terms.append("(" + " ".join(terms) + ")")
+    if type_terms:
+        parts.append(_or_criteria(type_terms))
+
+    if target_email and IMAP_SEARCH_RECIPIENT_HEADERS:
+        recipient_terms = [f"(HEADER {h} {imap_quote(target_email.strip())})" for h in IMAP_SEARCH_RECIPIENT_HEADERS]
+        parts.append(_or_criteria(recipient_terms))
+
+    return " ".join(parts)
+
+
+def imap_step_phase(method: str, args: tuple) -> Optional[str]:
+    """
+    Fase (para PHASE_SECONDS) de un comando emitido por los generadores de pasos.
+    """
+    if method == "uid":
+        command = args[0].upper()
+        if command == "SEARCH":
+            return "search"
+        if command == "STORE":
+            return "store"
+        items = str(args[2]) if len(args) > 2 else ""
+        if "HEADER" in items:
+            return "header_fetch"
+        if "BODY" in items:
+            return "body_fetch"
+        return "flags_fetch"
+    if method == "response":
+        return None  # no hay I/O
+    return method
+
+
+def run_imap_steps(imap, steps):
+    """
+    Ejecuta un generador de pasos IMAP sobre una sesión imaplib (síncrona).
+    Las excepciones del comando se relanzan dentro del generador.
+    """
+    try:
+        command = next(steps)
+        while True:
+            method, args = command
+            phase = imap_step_phase(method, args)
+            started = time.perf_counter()
+            try:
+                result = getattr(imap, method)(*args)
+            except Exception as e:
+                command = steps.throw(e)
+            else:
+                if phase:
+                    PHASE_SECONDS.observe(time.perf_counter() - started, phase=phase)
+                command = steps.send(result)
+    except StopIteration as stop:
+        return stop.value
+
+
+async def run_imap_steps_async(client, steps):
+    """
+    Igual que run_imap_steps pero sobre un AsyncIMAPClient.
+    """
+    try:
+        command = next(steps)
+        while True:
+            method, args = command
+            phase = imap_step_phase(method, args)
+            started = time.perf_counter()
+            try:
+                result = await getattr(client, method)(*args)
+            except Exception as e:
+                command = steps.throw(e)
+            else:
+                if phase:
+                    PHASE_SECONDS.observe(time.perf_counter() - started, phase=phase)
+                command = steps.send(result)
+    except StopIteration as stop:
+        return stop.value
+
+
+def _first_int(data) -> Optional[int]:
+    """
+    Primer valor entero de una respuesta imaplib tipo [b'123'] (o None).
+    """
+    try:
+        return int(data[0])
+    except (TypeError, ValueError, IndexError):
+        return None
+
+
+class CursorEntry:
+    """
+    Clasificación ya hecha de un UID candidato (FIFA/RUGBY) de una carpeta.
+    """
+
+    __slots__ = ("header_bytes", "email_type", "recipient", "date_ts")
+
+    def __init__(self, header_bytes: bytes, email_type: str, recipient: str, date_ts: Optional[float]):
+        self.header_bytes = header_bytes
+        self.email_type = email_type
+        self.recipient = recipient
+        self.date_ts = date_ts
+
+
+class FolderCursor:
+    """
+    Cursor incremental de una carpeta de una cuenta madre: UIDVALIDITY, último
+    UID revisado, HIGHESTMODSEQ (CONDSTORE) y los candidatos ya clasificados.
+    Si cambia UIDVALIDITY se descarta todo y se vuelve a escanear.
+    """
+
+    MAX_ENTRIES = 1000
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.uidvalidity: Optional[int] = None
+        self.last_uid = 0
+        self.highestmodseq: Optional[int] = None
+        self.entries: Dict[str, CursorEntry] = {}
+
+    def check_uidvalidity(self, uidvalidity: Optional[int]) -> None:
+        with self._lock:
+            if uidvalidity is None or uidvalidity != self.uidvalidity:
+                if self.uidvalidity is not None:
+                    logger.info("🔄 UIDVALIDITY cambió (%s -> %s), reescaneando", self.uidvalidity, uidvalidity)
+                self.uidvalidity = uidvalidity
+                self.last_uid = 0
+                self.highestmodseq = None
+                self.entries = {}
+
+    def advance(self, uids: List[str]) -> None:
+        with self._lock:
+            if uids:
+                self.last_uid = max(self.last_uid, max(int(u) for u in uids))
+
+    def remember(self, uid: str, header_bytes: bytes, email_type: str, recipient: str, date_header: str) -> None:
+        try:
+            date_ts = parsedate_to_datetime(date_header).timestamp()
+        except Exception:
+            date_ts = None
+        with self._lock:
+            self.entries[uid] = CursorEntry(header_bytes, email_type, recipient.lower(), date_ts)
+            while len(self.entries) > self.MAX_ENTRIES:
+                self.entries.pop(min(self.entries, key=int))
+
+    def forget(self, uid: str) -> None:
+        with self._lock:
+            self.entries.pop(uid, None)
+
+    def recipient_of(self, uid: str) -> Optional[str]:
+        entry = self.entries.get(uid)
+        return entry.recipient if entry is not None else None
+
+    def candidates(self, minutes: int) -> Dict[str, CursorEntry]:
+        """
+        Candidatos todavía dentro de la ventana de minutos (los viejos se borran).
+        """
+        cutoff = time.time() - minutes * 60
+        with self._lock:
+            for uid in [u for u, e in self.entries.items() if e.date_ts is not None and e.date_ts < cutoff]:
+                del self.entries[uid]
+            return dict(self.entries)
+
+
+class FolderCursorStore:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._cursors: Dict[Tuple[str, str], FolderCursor] = {}
+
+    def get(self, icloud_user: str, folder: str) -> FolderCursor:
+        key = (icloud_user.lower().strip(), folder)
+        with self._lock:
+            cursor = self._cursors.get(key)
+            if cursor is None:
+                cursor = self._cursors[key] = FolderCursor()
+            return cursor
+
+
+folder_cursors = FolderCursorStore()
+
+
+def _refresh_cursor_steps(cursor: FolderCursor, minutes: int, highestmodseq: Optional[int]):
+    """
+    Actualiza los flags de los candidatos del cursor: con CONDSTORE solo pide
+    lo que cambió desde el último MODSEQ; si no, un UID FETCH (FLAGS) de los
+    candidatos. Los leídos o borrados salen del cursor.
+    Devuelve UID -> header_bytes de los candidatos que siguen sin leer.
+    """
+    candidates = cursor.candidates(minutes)
+    if candidates:
+        if highestmodseq is not None and cursor.highestmodseq is not None:
+            if highestmodseq != cursor.highestmodseq:
+                status, data = yield ("uid", ("FETCH", "1:*", f"(FLAGS) (CHANGEDSINCE {cursor.highestmodseq})"))
+                if status == "OK":
+                    for uid, (meta, _) in parse_fetch_response(data).items():
+                        if uid in candidates and b'\\Seen' in fetch_flags(meta):
+                            cursor.forget(uid)
+        else:
+            status, data = yield ("uid", ("FETCH", ",".join(candidates), "(FLAGS)"))
+            if status == "OK":
+                flags = parse_fetch_response(data)
+                for uid in candidates:
+                    if uid not in flags or b'\\Seen' in fetch_flags(flags[uid][0]):
+                        cursor.forget(uid)
+    cursor.highestmodseq = highestmodseq
+    return {uid: entry.header_bytes for uid, entry in cursor.candidates(minutes).items()}
+
+
+def parse_full_message(raw_msg: bytes) -> Tuple[str, str, str, str, str, str]:
+    """
+    Parsea el mensaje completo y devuelve (subject, from, to, date, text/plain, text/html).
+    """
+    msg = email_lib.message_from_bytes(raw_msg)
+
+    subject_full = decode_header_part(msg.get("Subject"))
+    from_ = decode_header_part(msg.get("From"))
+    to_ = decode_header_part(msg.get("To"))
+    date_ = msg.get("Date") or ""
+    
+    logger.debug("📧 Email parseado completo")
+
+    # Extraer body
+    body_text = ""
+    body_html = ""
+    
+    if msg.is_multipart():
+        for part in msg.walk():
+            content_type = part.get_content_type()
+            content_disposition = str(part.get("Content-Disposition", ""))
+            
+            if content_type == "text/plain" and "attachment" not in content_disposition:
+                payload = part.get_payload(decode=True)
+                if payload:
+                    try:
+                        body_text = payload.decode(errors="ignore")
+                        logger.debug("✅ Text/plain: %s chars", len(body_text))
+                    except:
+                        pass
+            
+            elif content_type == "text/html" and "attachment" not in content_disposition:
+                payload = part.get_payload(decode=True)
+                if payload:
+                    try:
+                        body_html = payload.decode(errors="ignore")
+                        logger.debug("✅ Text/html: %s chars", len(body_html))
+                    except:
+                        pass
+    else:
+        content_type = msg.get_content_type()
+        payload = msg.get_payload(decode=True)
+        if payload:
+            try:
+                if content_type == "text/plain":
+                    body_text = payload.decode(errors="ignore")
+                elif content_type == "text/html":
+                    body_html = payload.decode(errors="ignore")
+            except:
+                pass
+
+    return subject_full, from_, to_, date_, body_text, body_html
+
+
+class _StreamedBodies:
+    """
+    Recoge las partes de texto según las va cerrando el FeedParser. Cada parte
+    del árbol es un _StreamedPart: al recibir su payload se queda solo con la
+    primera text/plain y la primera text/html (recortadas a max_body_bytes,
+    0 = enteras) y tira el resto (adjuntos, imágenes...), así el árbol no
+    crece con el mensaje. truncated dice si se recortó alguna.
+    """
+
+    def __init__(self, bodies: Tuple[str, ...], max_body_bytes: int):
+        self.wanted = bodies[0] if bodies else "text/plain"
+        self.max_body_bytes = max_body_bytes
+        self.root = None
+        self.found: Dict[str, Tuple[str, str, str]] = {}
+        self.truncated = False
+
+    @property
+    def done(self) -> bool:
+        return self.wanted in self.found
+
+    def factory(self, policy=None):
+        part = _StreamedPart(policy) if policy is not None else _StreamedPart()
+        part._collector = self
+        if self.root is None:
+            self.root = part
+        return part
+
+    def offer(self, part: "_StreamedPart", payload) -> bool:
+        content_type = part.get_content_type()
+        if content_type not in ("text/plain", "text/html") or content_type in self.found:
+            return False
+        if not isinstance(payload, str) or "attachment" in str(part.get("Content-Disposition", "")):
+            return False
+        encoding = str(part.get("Content-Transfer-Encoding", "7bit")).strip().lower()
+        if self.max_body_bytes > 0 and len(payload) > self.max_body_bytes:
+            payload = payload[:self.max_body_bytes]
+            self.truncated = True
+        self.found[content_type] = (payload, encoding, part.get_content_charset() or "utf-8")
+        return True
+
+    def text(self, content_type: str) -> str:
+        if content_type not in self.found:
+            return ""
+        payload, encoding, charset = self.found[content_type]
+        # El FeedParser guarda los bytes como str con surrogateescape: se recuperan tal cual
+        data = decode_transfer_encoding(payload.encode("ascii", "surrogateescape"), encoding)
+        try:
+            return data.decode(charset, errors="ignore")
+        except LookupError:
+            return data.decode("utf-8", errors="ignore")
+
+
+class _StreamedPart(email_lib.message.Message):
+    _collector: _StreamedBodies
+
+    def set_payload(self, payload, charset=None):
+        if self._collector.offer(self, payload) or not isinstance(payload, str):
+            super().set_payload(payload, charset)
+        else:
+            super().set_payload("", charset)
+
+
+def parse_message_streaming(raw_msg, bodies: Tuple[str, ...] = ("text/plain", "text/html"),
+                            max_body_bytes: int = MIME_BODY_MAX_BYTES) -> Tuple[str, str, str, str, str, str, bool]:
+    """
+    Como parse_full_message pero con email.feedparser: el mensaje entra por
+    trozos (vistas de memoryview, sin copiar el mensaje) y se deja de parsear
+    en cuanto está cerrada la parte bodies[0] que necesita la regla.
+    El último valor indica si alguna parte de texto se recortó a max_body_bytes.
+    """
+    collector = _StreamedBodies(bodies, max_body_bytes)
+    parser = email_lib.feedparser.FeedParser(_factory=collector.factory)
+    collector.root = None  # el constructor llama una vez a la factory para probar su firma
+    view = memoryview(raw_msg)
+    fed = 0
+    try:
+        while fed < len(view) and not collector.done:
+            # Lo mismo que hace BytesFeedParser.feed, pero decodificando la vista
+            # directamente en vez de copiarla antes a bytes
+            parser.feed(codecs.decode(view[fed:fed + MIME_FEED_CHUNK], "ascii", "surrogateescape"))
+            fed += MIME_FEED_CHUNK
+        if not collector.done:
+            parser.close()
+    finally:
+        view.release()
+    logger.debug("📧 Email parseado en streaming (%s de %s bytes)", min(fed, len(raw_msg)), len(raw_msg))
+
+    msg = collector.root
+    if msg is None:
+        return "", "", "", "", "", "", False
+    return (
+        decode_header_part(msg.get("Subject")),
+        decode_header_part(msg.get("From")),
+        decode_header_part(msg.get("To")),
+        msg.get("Date") or "",
+        collector.text("text/plain"),
+        collector.text("text/html"),
+        collector.truncated,
+    )
+
+
+def raw_message_from_fetch(msg_data: list) -> Optional[bytes]:
+    """
+    Saca el mensaje de la respuesta de un FETCH (BODY.PEEK[]).
+    """
+    for part in msg_data:
+        if isinstance(part, tuple) and len(part) >= 2:
+            if isinstance(part[1], (bytes, bytearray)):
+                return part[1]
+        elif isinstance(part, (bytes, bytearray)) and len(part) > 100:
+            return part
+    return None
+
+
+def _parse_full_message_steps(uid: str, raw_msg: bytes, rule: "EmailRule"):
+    """
+    Parsea el mensaje completo descargado. En streaming, si hubo que recortar
+    (la descarga a IMAP_FULL_MAX_BYTES o una parte a MIME_BODY_MAX_BYTES) y en
+    lo recortado no está el dato, se avisa, se cuenta en ERRORS y se vuelve a
+    parsear sin límites (pidiendo antes el mensaje entero si hace falta).
+    Devuelve (subject, from, to, date, text/plain, text/html).
+    """
+    if not IMAP_MIME_STREAMING:
+        with PHASE_SECONDS.time(phase="mime_parse"):
+            return parse_full_message(raw_msg)
+
+    with PHASE_SECONDS.time(phase="mime_parse"):
+        *parsed, part_truncated = parse_message_streaming(raw_msg, rule.bodies)
+    download_truncated = 0 < IMAP_FULL_MAX_BYTES <= len(raw_msg)
+    if not (part_truncated or download_truncated) or rule.extract(parsed[4], parsed[5]):
+        return tuple(parsed)
+
+    logger.warning(
+        "✂️ UID %s: sin %s en lo recortado (%s), se parsea sin límite",
+        uid, rule.field, "descarga" if download_truncated else "parte de texto",
+    )
+    ERRORS.inc(type="mime_truncated", where="mime_parse")
+    if download_truncated:
+        status, msg_data = yield ("uid", ("FETCH", uid, "(BODY.PEEK[])"))
+        full = raw_message_from_fetch(msg_data) if status == "OK" and msg_data else None
+        if full:
+            raw_msg = full
+    with PHASE_SECONDS.time(phase="mime_parse"):
+        *parsed, _ = parse_message_streaming(raw_msg, rule.bodies, max_body_bytes=0)
+    return tuple(parsed)
+
+
+_IMAP_TOKEN_RE = re.compile(rb'\s*(?:(\()|(\))|"((?:[^"\\]|\\.)*)"|([^\s()"]+))')
+
+
+def flatten_fetch_response(data: list) -> bytes:
+    """
+    Une una respuesta FETCH de imaplib en un solo bytes, metiendo los
+    literales {n} como strings entre comillas (para parsear BODYSTRUCTURE).
+    """
+    out = b""
+    for part in data:
+        if isinstance(part, tuple):
+            prefix = re.sub(rb'\{\d+\}$', b"", part[0])
+            out += prefix + b'"' + part[1].replace(b"\\", b"\\\\").replace(b'"', b'\\"') + b'"'
+        elif isinstance(part, bytes):
+            out += part
+    return out
+
+
+def parse_imap_list(data: bytes, pos: int = 0):
+    """
+    Parsea una lista IMAP entre paréntesis desde pos. Devuelve (lista, nueva_pos).
+    Strings y átomos quedan como str, NIL como None.
+    """
+    stack: list = []
+    current: Optional[list] = None
+    while pos < len(data):
+        match = _IMAP_TOKEN_RE.match(data, pos)
+        if not match:
+            break
+        pos = match.end()
+        opening, closing, quoted, atom = match.groups()
+        if opening:
+            new_list: list = []
+            if current is not None:
+                current.append(new_list)
+                stack.append(current)
+            current = new_list
+        elif closing:
+            if not stack:
+                return current, pos
+            current = stack.pop()
+        elif quoted is not None:
+            current.append(re.sub(rb'\\(.)', rb'\1', quoted).decode("utf-8", errors="ignore"))
+        else:
+            value = atom.decode("utf-8", errors="ignore")
+            current.append(None if value.upper() == "NIL" else value)
+    return current, pos
+
+
+def find_text_parts(structure: list, prefix: str = "") -> List[Tuple[str, str, str, str, Optional[int]]]:
+    """
+    Recorre un BODYSTRUCTURE y devuelve las partes de texto que no son adjuntos
+    como (sección, text/plain|text/html, encoding, charset, tamaño en bytes o None).
+    """
+    if structure and isinstance(structure[0], list):
+        parts = []
+        index = 1
+        for child in structure:
+            if not isinstance(child, list):
+                break
+            parts.extend(find_text_parts(child, f"{prefix}{index}."))
+            index += 1
+        return parts
+
+    section = prefix.rstrip(".") or "1"
+    if len(structure) < 7 or not isinstance(structure[0], str) or structure[0].lower() != "text":
+        return []
+    subtype = (structure[1] or "").lower()
+    if subtype not in ("plain", "html"):
+        return []
+    disposition = structure[9] if len(structure) > 9 else None
+    if isinstance(disposition, list) and disposition and (disposition[0] or "").lower() == "attachment":
+        return []
+    params = structure[2] if isinstance(structure[2], list) else []
+    charset = "utf-8"
+    for key, value in zip(params[::2], params[1::2]):
+        if (key or "").lower() == "charset" and value:
+            charset = value
+    try:
+        size = int(structure[6])
+    except (TypeError, ValueError):
+        size = None
+    return [(section, f"text/{subtype}", (structure[5] or "7bit").lower(), charset, size)]
+
+
+def decode_transfer_encoding(data: bytes, encoding: str) -> bytes:
+    """
+    Decodifica base64 / quoted-printable (tolerando un corte por rango de bytes).
+    """
+    if encoding == "base64":
+        cleaned = re.sub(rb'[^A-Za-z0-9+/=]', b"", data)
+        cleaned = cleaned[:len(cleaned) // 4 * 4]
+        return binascii.a2b_base64(cleaned)
+    if encoding == "quoted-printable":
+        return quopri.decodestring(data)
+    return data
+
+
+def _fetch_text_part_steps(uid: str, email_type: str):
+    """
+    Lee el BODYSTRUCTURE, elige la parte de texto que necesita el tipo de email
+    y descarga solo esa sección (limitada a IMAP_BODY_MAX_BYTES). Si la parte
+    era más grande y en lo descargado no está el dato, se pide el resto.
+    Devuelve (body_text, body_html) o None si hay que caer al BODY[] completo.
+    """
+    status, data = yield ("uid", ("FETCH", uid, "(BODYSTRUCTURE)"))
+    if status != "OK" or not data:
+        return None
+    flat = flatten_fetch_response(data)
+    start = flat.find(b"BODYSTRUCTURE (")
+    if start < 0:
+        return None
+    structure, _ = parse_imap_list(flat, start + len(b"BODYSTRUCTURE "))
+    parts = find_text_parts(structure or [])
+    if not parts:
+        return None
+
+    rule = email_rules.get(email_type)
+    preferred = rule.bodies if rule else ("text/plain", "text/html")
+    parts.sort(key=lambda p: preferred.index(p[1]) if p[1] in preferred else len(preferred))
+    section, content_type, encoding, charset, size = parts[0]
+
+    def as_bodies(raw: bytes) -> Tuple[str, str]:
+        payload = decode_transfer_encoding(raw, encoding)
+        try:
+            text = payload.decode(charset, errors="ignore")
+        except LookupError:
+            text = payload.decode("utf-8", errors="ignore")
+        logger.debug("✅ %s: %s chars (%s bytes descargados)", content_type, len(text), len(raw))
+        return ("", text) if content_type == "text/html" else (text, "")
+
+    logger.debug("📥 Obteniendo solo la sección %s (%s, %s)", section, content_type, encoding)
+    status, data = yield ("uid", ("FETCH", uid, f"(BODY.PEEK[{section}]<0.{IMAP_BODY_MAX_BYTES}>)"))
+    if status != "OK" or not data:
+        return None
+    raw_part = next((p[1] for p in data if isinstance(p, tuple) and len(p) >= 2), None)
+    if raw_part is None:
+        return None
+
+    bodies = as_bodies(raw_part)
+    truncated = size > len(raw_part) if size is not None else len(raw_part) >= IMAP_BODY_MAX_BYTES
+    if not truncated or rule is None or rule.extract(*bodies):
+        return bodies
+
+    # El dato está más allá del rango descargado: se pide el resto de la sección
+    logger.debug("📥 Sección %s cortada en %s bytes sin %s: pidiendo el resto", section, len(raw_part), rule.field)
+    rest = f"<{len(raw_part)}.{size - len(raw_part)}>" if size is not None else ""
+    fetch = f"(BODY.PEEK[{section}]{rest})"
+    status, data = yield ("uid", ("FETCH", uid, fetch))
+    if status != "OK" or not data:
+        return None
+    raw_rest = next((p[1] for p in data if isinstance(p, tuple) and len(p) >= 2), None)
+    if raw_rest is None:
+        return None
+    return as_bodies(raw_part + raw_rest if rest else raw_rest)
+
+
+def search_in_folder(imap, folder_name: str, target_email: str, limit: int = 1, minutes: int = 10, max_emails_to_check: int = 30) -> List[Message]:
+    """
+    Busca mensajes en una carpeta específica de los últimos N minutos.
+    Solo revisa los últimos max_emails_to_check correos para ser más rápido.
+    """
+    hits = scan_folder(imap, folder_name, target_email, limit, minutes, max_emails_to_check)
+    return [hit.message for hit in hits]
+
+
+def scan_folder(imap, folder_name: str, target_email: Optional[str], limit: int = 1, minutes: int = 10, max_emails_to_check: int = 30, mark_seen: bool = True, known_uids: Optional[Set[str]] = None, cursor: Optional["FolderCursor"] = None) -> List[MailHit]:
+    """
+    Igual que search_in_folder pero devuelve los MailHit (con UID).
+    Con target_email=None acepta cualquier destinatario (lo usa el watcher)
+    y con mark_seen=False no toca los flags del mensaje.
+    Los UIDs de known_uids se saltan sin descargar nada más.
+    """
+    hits, _ = run_imap_steps(imap, _scan_folder_steps(folder_name, target_email, limit, minutes, max_emails_to_check, mark_seen, known_uids, cursor))
+    return hits
+
+
+def _scan_folder_steps(folder_name: str, target_email: Optional[str], limit: int, minutes: int, max_emails_to_check: int, mark_seen: bool, known_uids: Optional[Set[str]], cursor: Optional["FolderCursor"] = None):
+    """
+    Lógica de scan_folder sin I/O: emite comandos (método, args) y recibe
+    (status, data). La ejecutan run_imap_steps (imaplib) y run_imap_steps_async.
+    Con cursor solo se piden los UIDs nuevos; los candidatos ya clasificados
+    salen del cursor (refrescando sus flags).
+    Devuelve (hits, completo): completo es False si algún comando falló o se
+    dejaron mensajes sin revisar, y entonces no se puede dar la carpeta por vista.
+    """
+    found_messages: List[MailHit] = []
+    complete = True
+    target_email_lower = target_email.lower().strip() if target_email else None
     
-    return recipient
+    try:
+        # Seleccionar carpeta
+        status, count = yield ("select", (folder_name,))
+        if status != "OK":
+            logger.warning("⚠️ No se pudo abrir la carpeta %s", folder_name)
+            return [], False
+        
+        logger.debug("📁 Buscando en carpeta: %s", folder_name)
+        
+        # Filtrar en el servidor (UNSEEN, SINCE, remitente/asunto, destinatario);
+        # los filtros del cliente se mantienen igual para afinar.
+        # Con cursor no se filtra por destinatario: lo clasificado vale para todos los alias
+        criteria = build_search_criteria(minutes, None if cursor is not None else target_email)
+        highestmodseq = None
+        if cursor is not None:
+            _, uidvalidity = yield ("response", ("UIDVALIDITY",))
+            _, modseq = yield ("response", ("HIGHESTMODSEQ",))
+            highestmodseq = _first_int(modseq)
+            cursor.check_uidvalidity(_first_int(uidvalidity))
+            if cursor.last_uid:
+                criteria += f" UID {cursor.last_uid + 1}:*"
+        logger.debug("🔍 Buscando correos recientes: %s", criteria)
+        
+        status, data = yield ("uid", ("SEARCH", None, criteria))
+        
+        if status != "OK":
+            logger.warning("⚠️ Error en SEARCH de %s", folder_name)
+            return [], False
+
+        all_uids = [u.decode() for u in (data[0] or b"").split()] if data else []
+        if cursor is not None:
+            # 'UID n:*' siempre devuelve al menos el último mensaje
+            all_uids = [u for u in all_uids if int(u) > cursor.last_uid]
+        total_emails = len(all_uids)
+        logger.debug("📬 Mensajes nuevos candidatos en %s: %s", folder_name, total_emails)
+        
+        # OPTIMIZACIÓN: Solo revisar los últimos N correos
+        uids_to_check = all_uids[-max_emails_to_check:]
+        if known_uids:
+            uids_to_check = [u for u in uids_to_check if u not in known_uids]
+        logger.debug("⚡ Revisando solo los últimos %s correos (de %s totales)", len(uids_to_check), total_emails)
+        
+        # Un solo UID FETCH con FLAGS y solo los headers que usamos, para toda la ventana
+        headers_by_uid: Dict[str, Tuple[bytes, Optional[bytes]]] = {}
+        if uids_to_check:
+            status, header_data = yield ("uid", ("FETCH", ",".join(uids_to_check), HEADER_FETCH_ITEMS))
+            if status != "OK" or not header_data:
+                logger.warning("⚠️ Error fetching headers en %s", folder_name)
+                return [], False
+            headers_by_uid = parse_fetch_response(header_data)
+        
+        if cursor is not None:
+            cached = yield from _refresh_cursor_steps(cursor, minutes, highestmodseq)
+            for uid, header_bytes in cached.items():
+                if not (known_uids and uid in known_uids):
+                    headers_by_uid.setdefault(uid, (b"FLAGS ()", header_bytes))
+            uids_to_check = sorted(set(uids_to_check) | set(headers_by_uid), key=int)
+            logger.debug("🧭 Cursor %s: %s candidatos ya clasificados, último UID %s", folder_name, len(cached), cursor.last_uid)
+        
+        if not uids_to_check:
+            logger.debug("⚠️ No se encontraron mensajes en %s", folder_name)
+            if cursor is not None:
+                cursor.advance(all_uids)
+            return [], True
+        
+        emails_checked = 0
+        
+        # Procesar de atrás hacia adelante (más recientes primero)
+        for uid in reversed(uids_to_check):
+            # Con cursor, pasado el límite se siguen clasificando los headers ya
+            # descargados (sin bajar cuerpos) para no saltarse los de otros alias
+            classify_only = len(found_messages) >= limit
+            if classify_only and cursor is None:
+                complete = False
+                break
+            
+            if not classify_only:
+                emails_checked += 1
+                MESSAGES_SCANNED.inc(folder=folder_name)
+                logger.debug("📩 Procesando mensaje UID: %s (%s/%s)", uid, emails_checked, len(uids_to_check))
+            
+            if uid not in headers_by_uid:
+                logger.warning("⚠️ El servidor no devolvió headers para UID %s", uid)
+                complete = False
+                continue
+            meta, header_bytes = headers_by_uid[uid]
+            
+            if cursor is not None and target_email_lower is not None:
+                cached_recipient = cursor.recipient_of(uid)
+                if cached_recipient is not None and cached_recipient != target_email_lower:
+                    logger.debug("⏭️ Saltando - UID %s es para %s (cursor)", uid, cached_recipient)
+                    continue
+            
+            # Verificar si el mensaje está no leído (UNSEEN)
+            if b'\\Seen' in fetch_flags(meta):
+                logger.debug("⏭️ Saltando - mensaje ya leído")
+                continue
+            
+            if not header_bytes:
+                logger.warning("⚠️ No se pudieron extraer headers")
+                continue
+            
+            try:
+                # Un solo parseo del bloque; Subject/From se decodifican solo si pasa la fecha
+                headers = ParsedHeaders(header_bytes)
+                date_header = headers.raw("date")
+                
+                # VERIFICAR SI EL EMAIL ES DE LOS ÚLTIMOS N MINUTOS
+                if not is_within_last_minutes(date_header, minutes):
+                    logger.debug("⏭️ Saltando - email muy antiguo (más de %s minutos)", minutes)
+                    continue
+                
+                subject = headers.decoded("subject")
+                from_header = headers.decoded("from")
+                
+                logger.debug("📨 Subject: '%s'", subject)
+                logger.debug("📨 From: '%s'", from_header)
+                
+                # Determinar tipo de email (una sola pasada por todas las reglas)
+                rule = email_rules.classify(from_header, subject)
+                
+                if rule is None:
+                    logger.debug("⏭️ Saltando mensaje - no coincide con ninguna regla")
+                    continue
+                email_type = rule.name
+                logger.debug(rule.label)
+                
+                recipient_email = extract_recipient_email(headers)
+                
+                if not recipient_email:
+                    logger.warning("⚠️ No se pudo extraer el email destinatario")
+                    continue
+                
+                if cursor is not None:
+                    cursor.remember(uid, header_bytes, email_type, recipient_email, date_header)
+                if classify_only:
+                    continue
+                
+                if target_email_lower is not None:
+                    logger.debug("🔍 Comparando: '%s' vs '%s'", recipient_email, target_email_lower)
+                    
+                    if recipient_email.lower() != target_email_lower:
+                        logger.debug("⏭️ Saltando - destinatario no coincide")
+                        continue
+                
+                logger.debug("✅ Correo destinado a %s - procesando...", recipient_email)
+                
+            except Exception as e:
+                logger.warning("⚠️ Error parseando headers: %s", e)
+                continue
+            
+            body = None
+            if IMAP_BODY_FETCH_MODE == "partial":
+                # Solo la parte de texto que necesitamos (BODYSTRUCTURE + BODY.PEEK[n]<0.N>)
+                body = yield from _fetch_text_part_steps(uid, email_type)
+            
+            if body is not None:
+                body_text, body_html = body
+                subject_full = subject
+                from_ = from_header
+                to_ = headers.decoded("to")
+                date_ = date_header
+            else:
+                # Obtener mensaje completo (PEEK: el flag \Seen se pone solo si hay código)
+                logger.debug("📥 Obteniendo mensaje completo")
+                section = "BODY.PEEK[]"
+                if IMAP_MIME_STREAMING and IMAP_FULL_MAX_BYTES > 0:
+                    section += f"<0.{IMAP_FULL_MAX_BYTES}>"
+                status, msg_data = yield ("uid", ("FETCH", uid, f"({section})"))
+                
+                if status != "OK" or not msg_data:
+                    logger.warning("⚠️ Error fetching mensaje completo")
+                    complete = False
+                    if cursor is not None:
+                        cursor.forget(uid)
+                    continue
+
+                raw_msg = raw_message_from_fetch(msg_data)
+
+                if not raw_msg:
+                    logger.error("❌ No se pudo extraer raw_msg")
+                    complete = False
+                    if cursor is not None:
+                        # Lo más probable es que el mensaje ya no exista (EXPUNGE)
+                        cursor.forget(uid)
+                    continue
+
+                try:
+                    subject_full, from_, to_, date_, body_text, body_html = yield from _parse_full_message_steps(uid, raw_msg, rule)
+                except (imaplib.IMAP4.abort, OSError):
+                    raise
+                except Exception as e:
+                    logger.error("❌ Error parseando: %s", e)
+                    complete = False
+                    continue
+
+            try:
+                if not body_text and not body_html:
+                    logger.warning("⚠️ No se pudo extraer body")
+                    continue
+
+                # Extraer información según la regla
+                with PHASE_SECONDS.time(phase="extract"):
+                    extracted = rule.extract(body_text, body_html)
+                
+                if extracted:
+                    logger.debug("🎉 %s extraído correctamente", rule.field)
+                else:
+                    logger.debug("⚠️ No se encontró %s", rule.field)
+                
+                # Agregar si encontramos datos
+                if extracted:
+                    if mark_seen:
+                        yield from _mark_uids_seen_steps([uid])
+                        if cursor is not None:
+                            cursor.forget(uid)
+                    
+                    message = Message(
+                        from_=from_,
+                        subject=subject_full or subject,
+                        date=date_,
+                        to=to_ or recipient_email,
+                        email_type=email_type,
+                        **{rule.field: extracted},
+                        folder=folder_name,
+                    )
+                    found_messages.append(MailHit(folder_name, uid, recipient_email, message))
+                    HITS.inc(folder=folder_name, email_type=email_type)
+                    SCAN_DEPTH_AT_HIT.observe(emails_checked, folder=folder_name)
+                    logger.debug("✅ Mensaje %s agregado desde %s", email_type, folder_name)
+                
+            except (imaplib.IMAP4.abort, OSError):
+                raise
+            except Exception as e:
+                logger.error("❌ Error parseando: %s", e)
+                complete = False
+                continue
+        
+        # El cursor avanza al final: si el escaneo se corta (error o cancelación)
+        # los UIDs nuevos se vuelven a pedir la próxima vez
+        if cursor is not None:
+            cursor.advance(all_uids)
+        logger.debug("📊 Revisados %s correos en %s", emails_checked, folder_name)
+        
+    except (imaplib.IMAP4.abort, OSError):
+        # La conexión está rota: que el pool la descarte y se reintente
+        raise
+    except Exception as e:
+        logger.error("❌ Error en carpeta %s: %s", folder_name, e)
+        ERRORS.inc(type=type(e).__name__, where="scan_folder")
+        complete = False
+    
+    return found_messages, complete
+
+
+def mark_uids_seen(imap, uids: List[str]) -> bool:
+    """
+    Marca como leídos los UIDs indicados en la carpeta seleccionada.
+    """
+    return run_imap_steps(imap, _mark_uids_seen_steps(uids))
+
+
+def uid_set(uids) -> str:
+    """
+    Compacta UIDs en un set IMAP con rangos: ['1', '2', '3', '7'] -> '1:3,7'.
+    """
+    ranges: List[str] = []
+    start = prev = None
+    for uid in sorted({int(u) for u in uids}):
+        if prev is not None and uid == prev + 1:
+            prev = uid
+            continue
+        if start is not None:
+            ranges.append(str(start) if start == prev else f"{start}:{prev}")
+        start = prev = uid
+    if start is not None:
+        ranges.append(str(start) if start == prev else f"{start}:{prev}")
+    return ",".join(ranges)
+
+
+def _mark_uids_seen_steps(uids: List[str]):
+    try:
+        # STORE ya persiste el flag; sin EXPUNGE (que solo borra los \Deleted y es caro en carpetas grandes)
+        status, response = yield ("uid", ("STORE", uid_set(uids), '+FLAGS.SILENT', '(\\Seen)'))
+        logger.debug("✅ Mensajes %s marcados como LEÍDOS (%s)", uid_set(uids), status)
+        return status == "OK"
+    except (imaplib.IMAP4.abort, OSError):
+        raise
+    except Exception as e:
+        logger.warning("⚠️ Error marcando como leído: %s", e)
+        return False
+
+
+def mark_hits_seen(icloud_user: str, icloud_pass: str, hits: List[MailHit]) -> None:
+    """
+    Marca como leídos los hits entregados desde el code_store (en segundo plano).
+    Con SEEN_COMMIT_ENABLED se encolan en el seen_committer.
+    """
+    if SEEN_COMMIT_ENABLED:
+        seen_committer.add(icloud_user, icloud_pass, hits)
+        return
+    by_folder: Dict[str, List[str]] = {}
+    for hit in hits:
+        by_folder.setdefault(hit.folder, []).append(hit.uid)
+    try:
+        with imap_pool.session(icloud_user, icloud_pass) as imap:
+            for folder, uids in by_folder.items():
+                status, _ = imap.select(folder)
+                if status == "OK":
+                    mark_uids_seen(imap, uids)
+    except Exception as e:
+        logger.warning("⚠️ Error marcando como leídos los mensajes pre-extraídos: %s", e)
+
+
+def fetch_last_messages(icloud_user: str, icloud_pass: str, target_email: str, limit: int = 1, minutes: int = 10, max_emails_to_check: int = 30) -> List[Message]:
+    """
+    Conecta con iCloud IMAP y devuelve los últimos N mensajes NO LEÍDOS de los últimos X minutos.
+    Busca en INBOX y en Junk/Spam.
+    Solo revisa los últimos max_emails_to_check correos por carpeta para mayor velocidad.
+    Usa una sesión del pool; si la conexión se cae, reconecta y reintenta una vez.
+    """
+    logger.debug("🎯 Buscando correos para: %s", target_email)
+    logger.debug("⏰ Solo emails de los últimos %s minutos", minutes)
+    logger.debug("⚡ Máximo %s correos por carpeta", max_emails_to_check)
+
+    hits = fetch_last_hits(icloud_user, icloud_pass, target_email, limit, minutes, max_emails_to_check)
+    return [hit.message for hit in hits]
+
+
+def fetch_last_hits(icloud_user: str, icloud_pass: str, target_email: str, limit: int = 1, minutes: int = 10, max_emails_to_check: int = 30) -> List[MailHit]:
+    """
+    Igual que fetch_last_messages pero devuelve los MailHit, y los marca como
+    consumidos en el code_store para que el watcher no los vuelva a entregar.
+    """
+    for attempt in range(2):
+        try:
+            with imap_pool.session(icloud_user, icloud_pass) as imap:
+                all_messages = _search_folders(imap, target_email, limit, minutes, max_emails_to_check, icloud_user)
+            break
+        except (imaplib.IMAP4.abort, OSError) as e:
+            if attempt:
+                raise
+            logger.warning("⚠️ Conexión IMAP perdida (%s), reintentando con sesión nueva", e)
+            ERRORS.inc(type=type(e).__name__, where="imap_retry")
+
+    all_messages = all_messages[:limit]  # Asegurar que no devolvemos más del límite
+    code_store.mark_consumed(icloud_user, all_messages)
+    if SEEN_COMMIT_ENABLED:
+        seen_committer.add(icloud_user, icloud_pass, all_messages)
+    logger.debug("📊 Total procesados: %s", len(all_messages))
+    return all_messages
+
+
+async def fetch_last_messages_async(icloud_user: str, icloud_pass: str, target_email: str, limit: int = 1, minutes: int = 10, max_emails_to_check: int = 30) -> List[Message]:
+    """
+    Versión asyncio de fetch_last_messages: la misma búsqueda pero sobre
+    AsyncIMAPClient, sin bloquear un hilo del threadpool mientras iCloud responde.
+    """
+    logger.debug("🎯 Buscando correos para: %s", target_email)
+    logger.debug("⏰ Solo emails de los últimos %s minutos", minutes)
+    logger.debug("⚡ Máximo %s correos por carpeta", max_emails_to_check)
+
+    hits = await fetch_last_hits_async(icloud_user, icloud_pass, target_email, limit, minutes, max_emails_to_check)
+    return [hit.message for hit in hits]
+
+
+async def fetch_last_hits_async(icloud_user: str, icloud_pass: str, target_email: str, limit: int = 1, minutes: int = 10, max_emails_to_check: int = 30) -> List[MailHit]:
+    for attempt in range(2):
+        try:
+            all_messages = await _search_folders_async(icloud_user, icloud_pass, target_email, limit, minutes, max_emails_to_check)
+            break
+        except (imaplib.IMAP4.abort, OSError) as e:
+            if attempt:
+                raise
+            logger.warning("⚠️ Conexión IMAP perdida (%s), reintentando con sesión nueva", e)
+            ERRORS.inc(type=type(e).__name__, where="imap_retry")
+
+    all_messages = all_messages[:limit]
+    code_store.mark_consumed(icloud_user, all_messages)
+    if SEEN_COMMIT_ENABLED:
+        seen_committer.add(icloud_user, icloud_pass, all_messages)
+    logger.debug("📊 Total procesados: %s", len(all_messages))
+    return all_messages
+
+
+def fetch_mailbox_hits(icloud_user: str, icloud_pass: str, minutes: int = 10, max_emails_to_check: int = 30) -> List[MailHit]:
+    """
+    Escanea la cuenta madre para todos sus alias a la vez: clasifica cada
+    FIFA/RUGBY de la ventana sin marcarlo como leído y lo deja en el code_store.
+    """
+    for attempt in range(2):
+        try:
+            with imap_pool.session(icloud_user, icloud_pass) as imap:
+                hits = _search_folders(imap, None, max_emails_to_check, minutes, max_emails_to_check, icloud_user)
+            break
+        except (imaplib.IMAP4.abort, OSError) as e:
+            if attempt:
+                raise
+            logger.warning("⚠️ Conexión IMAP perdida (%s), reintentando con sesión nueva", e)
+            ERRORS.inc(type=type(e).__name__, where="imap_retry")
+
+    added = code_store.put(icloud_user, hits)
+    logger.debug("📊 Escaneo de %s: %s códigos nuevos en memoria", icloud_user, added)
+    return hits
+
+
+async def fetch_mailbox_hits_async(icloud_user: str, icloud_pass: str, minutes: int = 10, max_emails_to_check: int = 30) -> List[MailHit]:
+    for attempt in range(2):
+        try:
+            hits = await _search_folders_async(icloud_user, icloud_pass, None, max_emails_to_check, minutes, max_emails_to_check)
+            break
+        except (imaplib.IMAP4.abort, OSError) as e:
+            if attempt:
+                raise
+            logger.warning("⚠️ Conexión IMAP perdida (%s), reintentando con sesión nueva", e)
+            ERRORS.inc(type=type(e).__name__, where="imap_retry")
+
+    added = code_store.put(icloud_user, hits)
+    logger.debug("📊 Escaneo de %s: %s códigos nuevos en memoria", icloud_user, added)
+    return hits
+
+
+# Carpetas que revisa el webhook, en orden de preferencia
+SEARCH_FOLDERS = ["INBOX", "Junk"]
+
+FolderStatus = Tuple[int, int, int]  # (UIDNEXT, UNSEEN, MESSAGES)
+
+_STATUS_ITEM_RE = re.compile(rb"(UIDNEXT|UNSEEN|MESSAGES) (\d+)", re.IGNORECASE)
+
+
+def parse_folder_status(data) -> Optional[FolderStatus]:
+    """
+    (UIDNEXT, UNSEEN, MESSAGES) de una respuesta STATUS tipo
+    [b'"INBOX" (UIDNEXT 12 UNSEEN 2 MESSAGES 10)'], o None si falta algo.
+    """
+    items: Dict[bytes, int] = {}
+    for line in data or []:
+        if isinstance(line, tuple):
+            line = b" ".join(line)
+        if isinstance(line, bytes):
+            items.update((k.upper(), int(v)) for k, v in _STATUS_ITEM_RE.findall(line))
+    try:
+        return items[b"UIDNEXT"], items[b"UNSEEN"], items[b"MESSAGES"]
+    except KeyError:
+        return None
+
+
+class FolderStatusCache:
+    """
+    STATUS de cada (cuenta, carpeta) tomado justo antes de su último escaneo
+    completo (sin destinatario, el que llena el code_store). Si el STATUS
+    actual es el mismo, no hay nada nuevo que clasificar en la carpeta.
+    Caduca con el code_store, que es donde quedaron los hits de ese escaneo.
+    """
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries: Dict[Tuple[str, str], Tuple[FolderStatus, float]] = {}
+
+    def remember(self, icloud_user: str, folder: str, status: FolderStatus) -> None:
+        with self._lock:
+            self._entries[(icloud_user.lower().strip(), folder)] = (status, time.monotonic())
+
+    def unchanged(self, icloud_user: str, folder: str, status: FolderStatus) -> bool:
+        with self._lock:
+            entry = self._entries.get((icloud_user.lower().strip(), folder))
+        return entry is not None and entry[0] == status and time.monotonic() - entry[1] < self.ttl
+
+
+folder_statuses = FolderStatusCache(CODE_STORE_TTL)
+
+
+def _folder_status_steps(folders: List[str], icloud_user: Optional[str] = None):
+    """
+    STATUS (UIDNEXT UNSEEN MESSAGES) de cada carpeta. Devuelve [(carpeta, status)]
+    de las que hay que escanear: se saltan las que no tienen no leídos y las que
+    no cambiaron desde el último escaneo completo. Si STATUS falla, se escanea.
+    """
+    to_scan: List[Tuple[str, Optional[FolderStatus]]] = []
+    for folder in folders:
+        try:
+            status, data = yield ("status", (folder, "(UIDNEXT UNSEEN MESSAGES)"))
+        except (imaplib.IMAP4.abort, OSError):
+            raise
+        except Exception as e:
+            logger.debug("⚠️ STATUS de %s falló: %s", folder, e)
+            status, data = "NO", []
+        counts = parse_folder_status(data) if status == "OK" else None
+        if counts is not None and counts[1] == 0:
+            logger.debug("⏭️ %s sin no leídos: no se escanea", folder)
+            continue
+        if counts is not None and icloud_user and folder_statuses.unchanged(icloud_user, folder, counts):
+            logger.debug("⏭️ %s sin cambios desde el último escaneo", folder)
+            continue
+        to_scan.append((folder, counts))
+    return to_scan
+
+
+def _search_folders(imap, target_email: Optional[str], limit: int, minutes: int, max_emails_to_check: int, icloud_user: Optional[str] = None) -> List[MailHit]:
+    return run_imap_steps(imap, _search_folders_steps(target_email, limit, minutes, max_emails_to_check, icloud_user))
+
+
+def _search_folders_steps(target_email: Optional[str], limit: int, minutes: int, max_emails_to_check: int, icloud_user: Optional[str] = None, folders: Optional[List[Tuple[str, Optional[FolderStatus]]]] = None, defer_seen: bool = False):
+    """
+    Sin target_email es un escaneo para el code_store: no marca como leído
+    (se hace al entregar) y se salta lo que ya está en memoria.
+    Con SEEN_COMMIT_ENABLED (o defer_seen) el \\Seen no se pone aquí, y se saltan
+    también los UIDs entregados que aún lo tienen pendiente.
+    folders: [(carpeta, status)] ya filtradas por STATUS; si no se pasan se
+    filtran aquí (IMAP_FOLDER_STATUS_ENABLED) o se revisan todas.
+    """
+    all_messages: List[MailHit] = []
+    mark_seen = target_email is not None and not (SEEN_COMMIT_ENABLED or defer_seen)
+    
+    if folders is None:
+        if IMAP_FOLDER_STATUS_ENABLED:
+            folders = yield from _folder_status_steps(SEARCH_FOLDERS, icloud_user)
+        else:
+            folders = [(folder, None) for folder in SEARCH_FOLDERS]
+    
+    for folder, folder_status in folders:
+        logger.debug("🔍 Revisando carpeta: %s", folder)
+        
+        cursor = folder_cursors.get(icloud_user, folder) if icloud_user and IMAP_CURSOR_ENABLED else None
+        known_uids = skip_uids(icloud_user, folder) if not mark_seen and icloud_user else None
+        messages, complete = yield from _scan_folder_steps(folder, target_email, limit, minutes, max_emails_to_check, mark_seen, known_uids, cursor)
+        all_messages.extend(messages)
+        # Solo un escaneo completo y sin errores permite saltarse la carpeta si no cambia
+        if complete and target_email is None and icloud_user and folder_status is not None:
+            folder_statuses.remember(icloud_user, folder, folder_status)
+        
+        # Si ya encontramos el límite, parar
+        if len(all_messages) >= limit:
+            logger.debug("✅ Límite alcanzado (%s mensajes)", limit)
+            break
+
+    return all_messages
+
+
+async def _search_folders_async(icloud_user: str, icloud_pass: str, target_email: Optional[str], limit: int, minutes: int, max_emails_to_check: int) -> List[MailHit]:
+    """
+    _search_folders_steps sobre el pool asyncio. Con IMAP_PARALLEL_FOLDERS cada
+    carpeta que pasa el STATUS se escanea en su propia sesión a la vez, y en
+    cuanto se llega a limit se cancelan las demás (su sesión se descarta).
+    """
+    if not IMAP_PARALLEL_FOLDERS:
+        async with async_imap_pool.session(icloud_user, icloud_pass) as client:
+            return await run_imap_steps_async(
+                client, _search_folders_steps(target_email, limit, minutes, max_emails_to_check, icloud_user)
+            )
+
+    if IMAP_FOLDER_STATUS_ENABLED:
+        async with async_imap_pool.session(icloud_user, icloud_pass) as client:
+            folders = await run_imap_steps_async(client, _folder_status_steps(SEARCH_FOLDERS, icloud_user))
+    else:
+        folders = [(folder, None) for folder in SEARCH_FOLDERS]
+
+    async def scan_one(folder: Tuple[str, Optional[FolderStatus]]) -> List[MailHit]:
+        async with async_imap_pool.session(icloud_user, icloud_pass) as client:
+            # El \\Seen se pone después: una carpeta cancelada no puede dejar un código marcado sin entregar
+            return await run_imap_steps_async(
+                client, _search_folders_steps(target_email, limit, minutes, max_emails_to_check, icloud_user, [folder], defer_seen=True)
+            )
+
+    tasks = [asyncio.ensure_future(scan_one(folder)) for folder in folders]
+    all_messages: List[MailHit] = []
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            all_messages.extend(await next_done)
+            if len(all_messages) >= limit:
+                logger.debug("✅ Límite alcanzado (%s mensajes), cancelando el resto de carpetas", limit)
+                break
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    if target_email is not None and not SEEN_COMMIT_ENABLED:
+        await run_in_threadpool(mark_hits_seen, icloud_user, icloud_pass, all_messages[:limit])
+    return all_messages
+
+
+# ------- \\Seen DIFERIDO -------
+
+class SeenCommitter:
+    """
+    Pone el \\Seen de los mensajes entregados fuera del camino de la petición:
+    acumula UIDs por (cuenta, carpeta) y los aplica en lote con un UID STORE
+    por carpeta. Si falla se reintenta con backoff por cuenta; lo pendiente se
+    apunta en un journal (JSON lines) y se recupera al arrancar, y mientras
+    tanto skip_uids lo excluye de los escaneos.
+    """
+
+    def __init__(self, journal_path: str, delay: float, max_backoff: float):
+        self.journal_path = journal_path
+        self.delay = delay
+        self.max_backoff = max_backoff
+        self._lock = threading.Lock()
+        self._pending: Dict[str, Dict[str, Set[str]]] = {}
+        self._passwords: Dict[str, str] = {}
+        self._failures: Dict[str, int] = {}
+        self._retry_at: Dict[str, float] = {}
+        self._journal = None
+        self._wake = threading.Event()
+        self._stop_event = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def _write(self, op: str, icloud_user: str, folder: str, uids) -> None:
+        if self._journal is None:
+            return
+        # flush sin fsync: sobrevive a la caída del proceso, que es el caso que importa
+        self._journal.write(json.dumps({"op": op, "user": icloud_user, "folder": folder, "uids": sorted(uids, key=int)}) + "\n")
+        self._journal.flush()
+
+    def _load_journal(self) -> None:
+        if not self.journal_path:
+            return
+        try:
+            with open(self.journal_path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue  # línea a medio escribir
+                    uids = self._pending.setdefault(entry["user"], {}).setdefault(entry["folder"], set())
+                    if entry["op"] == "add":
+                        uids.update(entry["uids"])
+                    else:
+                        uids.difference_update(entry["uids"])
+        except FileNotFoundError:
+            pass
+        self._compact()
+        count = sum(len(u) for folders in self._pending.values() for u in folders.values())
+        if count:
+            logger.info("📝 %s mensajes con \\Seen pendiente recuperados del journal", count)
+
+    def _compact(self) -> None:
+        """
+        Reescribe el journal solo con lo pendiente (con el lock tomado).
+        """
+        for user in [u for u, folders in self._pending.items() if not any(folders.values())]:
+            del self._pending[user]
+        if not self.journal_path:
+            return
+        if self._journal is not None:
+            self._journal.close()
+        tmp_path = self.journal_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            for user, folders in self._pending.items():
+                for folder, uids in folders.items():
+                    if uids:
+                        f.write(json.dumps({"op": "add", "user": user, "folder": folder, "uids": sorted(uids, key=int)}) + "\n")
+        os.replace(tmp_path, self.journal_path)
+        self._journal = open(self.journal_path, "a", encoding="utf-8")
+
+    def start(self) -> None:
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._load_journal()
+            self._stop_event.clear()
+            self._thread = threading.Thread(target=self._run, name="seen-committer", daemon=True)
+            self._thread.start()
+        self._wake.set()
+
+    def stop(self) -> None:
+        """
+        Para el hilo tras un último intento de aplicar lo pendiente.
+        """
+        thread = self._thread
+        if thread is None:
+            return
+        self._stop_event.set()
+        self._wake.set()
+        thread.join(timeout=30)
+        with self._lock:
+            self._thread = None
+            if self._journal is not None:
+                self._journal.close()
+                self._journal = None
+
+    def add(self, icloud_user: str, icloud_pass: Optional[str], hits: List[MailHit]) -> None:
+        if not hits:
+            return
+        self.start()
+        by_folder: Dict[str, Set[str]] = {}
+        for hit in hits:
+            by_folder.setdefault(hit.folder, set()).add(hit.uid)
+        with self._lock:
+            if icloud_pass:
+                self._passwords[icloud_user] = icloud_pass
+            for folder, uids in by_folder.items():
+                self._pending.setdefault(icloud_user, {}).setdefault(folder, set()).update(uids)
+                self._write("add", icloud_user, folder, uids)
+        self._wake.set()
+
+    def pending_uids(self, icloud_user: str, folder: str) -> Set[str]:
+        with self._lock:
+            return set(self._pending.get(icloud_user, {}).get(folder, ()))
+
+    def pending_count(self) -> int:
+        with self._lock:
+            return sum(len(u) for folders in self._pending.values() for u in folders.values())
+
+    def _commit_account(self, icloud_user: str, batch: Dict[str, Set[str]]) -> None:
+        icloud_pass = self._passwords.get(icloud_user)
+        if not icloud_pass:
+            # Recuperado del journal: el password no se guarda en disco
+            account = get_account(icloud_user)
+            if not account:
+                logger.warning("⚠️ %s ya no está en icloud_accounts: se descarta su \\Seen pendiente", icloud_user)
+                self._done(icloud_user, batch)
+                return
+            icloud_pass = account["icloud_app_password"]
+
+        with imap_pool.session(icloud_user, icloud_pass) as imap:
+            for folder, uids in batch.items():
+                status, _ = imap.select(folder)
+                if status != "OK" or not mark_uids_seen(imap, sorted(uids, key=int)):
+                    raise imaplib.IMAP4.error(f"no se pudo marcar {folder}")
+                self._done(icloud_user, {folder: uids})
+
+    def _done(self, icloud_user: str, batch: Dict[str, Set[str]]) -> None:
+        with self._lock:
+            folders = self._pending.get(icloud_user, {})
+            for folder, uids in batch.items():
+                if folder in folders:
+                    folders[folder].difference_update(uids)
+                    self._write("done", icloud_user, folder, uids)
+            if not any(any(f.values()) for f in self._pending.values()):
+                self._compact()
+
+    def commit_pending(self, force: bool = False) -> None:
+        now = time.monotonic()
+        with self._lock:
+            batches = {
+                user: {folder: set(uids) for folder, uids in folders.items() if uids}
+                for user, folders in self._pending.items()
+                if any(folders.values()) and (force or self._retry_at.get(user, 0) <= now)
+            }
+        for icloud_user, batch in batches.items():
+            try:
+                self._commit_account(icloud_user, batch)
+                self._failures.pop(icloud_user, None)
+                self._retry_at.pop(icloud_user, None)
+            except Exception as e:
+                failures = self._failures.get(icloud_user, 0) + 1
+                self._failures[icloud_user] = failures
+                backoff = min(self.max_backoff, 2.0 ** failures)
+                self._retry_at[icloud_user] = time.monotonic() + backoff
+                logger.warning("⚠️ Error marcando como leídos en %s (reintento en %ss): %s", icloud_user, backoff, e)
+                ERRORS.inc(type=type(e).__name__, where="seen_commit")
+
+    def _next_timeout(self) -> Optional[float]:
+        with self._lock:
+            waiting = [self._retry_at.get(user, 0) for user, folders in self._pending.items() if any(folders.values())]
+        if not waiting:
+            return None
+        return max(0.0, min(waiting) - time.monotonic())
+
+    def _run(self) -> None:
+        while not self._stop_event.is_set():
+            self._wake.wait(self._next_timeout())
+            self._wake.clear()
+            # Espera corta para juntar en un solo STORE los hits que llegan seguidos
+            self._stop_event.wait(self.delay)
+            self.commit_pending()
+        self.commit_pending(force=True)
+
+
+seen_committer = SeenCommitter(SEEN_JOURNAL_PATH, SEEN_COMMIT_DELAY, SEEN_COMMIT_MAX_BACKOFF)
+
+
+# ------- WATCHER IDLE + CODE STORE -------
+
+class CodeStore:
+    """
+    Códigos ya extraídos por el watcher, indexados por destinatario y con TTL.
+    Guarda también los (cuenta, carpeta, UID) ya entregados para no darlos dos veces.
+    El TTL cuenta desde que se encontró el hit; al sacarlo (take) se vuelve a
+    mirar la fecha del correo contra la ventana de la petición.
+    """
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._by_recipient: Dict[str, Dict[Tuple[str, str, str], MailHit]] = {}
+        self._consumed: Dict[Tuple[str, str, str], float] = {}
+        self._waiters: Dict[str, List[Tuple[asyncio.AbstractEventLoop, asyncio.Event]]] = {}
+
+    @staticmethod
+    def _key(icloud_user: str, hit: MailHit) -> Tuple[str, str, str]:
+        return (icloud_user.lower(), hit.folder, hit.uid)
+
+    def _purge_locked(self) -> None:
+        cutoff = time.monotonic() - self.ttl
+        for recipient in list(self._by_recipient):
+            entries = self._by_recipient[recipient]
+            for key in [k for k, hit in entries.items() if hit.found_at < cutoff]:
+                del entries[key]
+            if not entries:
+                del self._by_recipient[recipient]
+        for key in [k for k, ts in self._consumed.items() if ts < cutoff]:
+            del self._consumed[key]
+
+    def put(self, icloud_user: str, hits: List[MailHit]) -> int:
+        added = 0
+        with self._lock:
+            self._purge_locked()
+            for hit in hits:
+                key = self._key(icloud_user, hit)
+                if key in self._consumed:
+                    continue
+                entries = self._by_recipient.setdefault(hit.recipient.lower(), {})
+                if key not in entries:
+                    entries[key] = hit
+                    added += 1
+                    for loop, event in self._waiters.get(hit.recipient.lower(), []):
+                        loop.call_soon_threadsafe(event.set)
+        return added
 
+    def add_waiter(self, recipient: str) -> asyncio.Event:
+        """
+        Event que se activa cuando entra un hit para el destinatario (long-poll).
+        Hay que llamarlo desde el event loop y soltarlo con remove_waiter.
+        """
+        event = asyncio.Event()
+        with self._lock:
+            self._waiters.setdefault(recipient.lower().strip(), []).append((asyncio.get_running_loop(), event))
+        return event
 
-def search_in_folder(imap, folder_name: str, target_email: str, limit: int = 1, minutes: int = 10, max_emails_to_check: int = 30) -> List[Message]:
+    def remove_waiter(self, recipient: str, event: asyncio.Event) -> None:
+        key = recipient.lower().strip()
+        with self._lock:
+            waiters = [w for w in self._waiters.get(key, []) if w[1] is not event]
+            if waiters:
+                self._waiters[key] = waiters
+            else:
+                self._waiters.pop(key, None)
+
+    def take(self, icloud_user: str, recipient: str, limit: int = 1, minutes: int = WEBHOOK_MINUTES) -> List[MailHit]:
+        """
+        Saca (y marca como consumidos) los hits más recientes del destinatario
+        cuyo correo sigue dentro de los últimos minutes minutos; los que ya se
+        salieron de la ventana se descartan (sin marcarlos como consumidos).
+        """
+        account = icloud_user.lower()
+        now = time.monotonic()
+        with self._lock:
+            self._purge_locked()
+            entries = self._by_recipient.get(recipient.lower().strip())
+            if not entries:
+                return []
+            for key in [k for k, hit in entries.items() if not is_within_last_minutes(hit.message.date, minutes)]:
+                del entries[key]
+            if not entries:
+                del self._by_recipient[recipient.lower().strip()]
+                return []
+            candidates = sorted(
+                (item for item in entries.items() if item[0][0] == account),
+                key=lambda item: item[1].sort_key(),
+                reverse=True,
+            )[:limit]
+            for key, _ in candidates:
+                del entries[key]
+                self._consumed[key] = now
+            return [hit for _, hit in candidates]
+
+    def has_pending(self, icloud_user: str, recipient: str, minutes: int = WEBHOOK_MINUTES) -> bool:
+        """
+        True si hay algún hit sin entregar del destinatario dentro de la ventana
+        (lo entregado ya no está aquí, así que es más nuevo que la última entrega).
+        """
+        account = icloud_user.lower()
+        with self._lock:
+            self._purge_locked()
+            entries = self._by_recipient.get(recipient.lower().strip(), {})
+            return any(k[0] == account and is_within_last_minutes(hit.message.date, minutes) for k, hit in entries.items())
+
+    def mark_consumed(self, icloud_user: str, hits: List[MailHit]) -> None:
+        now = time.monotonic()
+        with self._lock:
+            for hit in hits:
+                key = self._key(icloud_user, hit)
+                self._consumed[key] = now
+                entries = self._by_recipient.get(hit.recipient.lower())
+                if entries:
+                    entries.pop(key, None)
+
+    def known_uids(self, icloud_user: str, folder: str) -> Set[str]:
+        account = icloud_user.lower()
+        with self._lock:
+            known = {k[2] for k in self._consumed if k[0] == account and k[1] == folder}
+            for entries in self._by_recipient.values():
+                known.update(k[2] for k in entries if k[0] == account and k[1] == folder)
+            return known
+
+
+code_store = CodeStore(CODE_STORE_TTL)
+
+
+def skip_uids(icloud_user: str, folder: str) -> Set[str]:
     """
-    Busca mensajes en una carpeta específica de los últimos N minutos.
-    Solo revisa los últimos max_emails_to_check correos para ser más rápido.
+    UIDs que un escaneo no debe volver a entregar: en memoria, ya entregados
+    o con el \\Seen todavía pendiente en el seen_committer.
     """
-    found_messages: List[Message] = []
-    target_email_lower = target_email.lower().strip()
-    
-    try:
-        # Seleccionar carpeta
-        status, count = imap.select(folder_name)
-        if status != "OK":
-            logger.warning(f"⚠️ No se pudo abrir la carpeta {folder_name}")
-            return []
-        
-        logger.info(f"📁 Buscando en carpeta: {folder_name}")
-        
-        # Buscar TODOS los mensajes (no solo UNSEEN, para ser más rápido)
-        # Luego filtraremos por UNSEEN en el procesamiento
-        logger.info(f"🔍 Buscando correos recientes...")
-        
-        status, data = imap.search(None, "ALL")
-        
-        if status != "OK" or not data or not data[0]:
-            logger.info(f"⚠️ No se encontraron mensajes en {folder_name}")
-            return []
+    return code_store.known_uids(icloud_user, folder) | seen_committer.pending_uids(icloud_user, folder)
 
-        all_ids = data[0].split()
-        total_emails = len(all_ids)
-        logger.info(f"📬 Total de mensajes en {folder_name}: {total_emails}")
-        
-        # OPTIMIZACIÓN: Solo revisar los últimos N correos
-        ids_to_check = all_ids[-max_emails_to_check:]
-        logger.info(f"⚡ Revisando solo los últimos {len(ids_to_check)} correos (de {total_emails} totales)")
-        
-        emails_checked = 0
-        
-        # Procesar de atrás hacia adelante (más recientes primero)
-        for msg_id in reversed(ids_to_check):
-            if len(found_messages) >= limit:
-                break
-            
-            emails_checked += 1
-            logger.info(f"📩 Procesando mensaje ID: {msg_id} ({emails_checked}/{len(ids_to_check)})")
-            
-            # Obtener headers con FLAGS para verificar si está leído
-            status, header_data = imap.fetch(msg_id, "(FLAGS BODY.PEEK[HEADER])")
-            
-            if status != "OK" or not header_data:
-                logger.warning(f"⚠️ Error fetching headers del mensaje {msg_id}")
-                continue
-            
-            # Verificar si el mensaje está no leído (UNSEEN)
-            flags_str = str(header_data)
-            if '\\Seen' in flags_str:
-                logger.info(f"⏭️ Saltando - mensaje ya leído")
-                continue
-            
-            header_bytes = None
-            for part in header_data:
-                if isinstance(part, tuple) and len(part) >= 2:
-                    header_bytes = part[1]
-                    break
-                elif isinstance(part, bytes):
-                    header_bytes = part
+
+class MailboxWatcher(threading.Thread):
+    """
+    Mantiene una sesión IDLE abierta sobre una carpeta de una cuenta madre y,
+    cada vez que llega correo, clasifica y extrae los códigos al code_store.
+    """
+
+    def __init__(self, icloud_user: str, icloud_pass: str, folder: str):
+        super().__init__(name=f"watcher-{icloud_user}-{folder}", daemon=True)
+        self.icloud_user = icloud_user
+        self.icloud_pass = icloud_pass
+        self.folder = folder
+        self._stop_event = threading.Event()
+        self._imap = None
+
+    def stop(self) -> None:
+        self._stop_event.set()
+        imap = self._imap
+        if imap is not None:
+            imap.interrupt()
+
+    def _scan(self, imap) -> None:
+        hits = scan_folder(
+            imap,
+            self.folder,
+            None,
+            limit=WEBHOOK_MAX_EMAILS_TO_CHECK,
+            minutes=WEBHOOK_MINUTES,
+            max_emails_to_check=WEBHOOK_MAX_EMAILS_TO_CHECK,
+            mark_seen=False,
+            known_uids=skip_uids(self.icloud_user, self.folder),
+            cursor=folder_cursors.get(self.icloud_user, self.folder) if IMAP_CURSOR_ENABLED else None,
+        )
+        added = code_store.put(self.icloud_user, hits)
+        if added:
+            logger.info("👀 Watcher %s/%s: %s códigos nuevos en memoria", self.icloud_user, self.folder, added)
+
+    def run(self) -> None:
+        backoff = 1.0
+        while not self._stop_event.is_set():
+            try:
+                self._imap = imap_pool.connect_dedicated(self.icloud_user, self.icloud_pass)
+                self._scan(self._imap)
+                backoff = 1.0
+                while not self._stop_event.is_set():
+                    if self._imap.idle_wait(IMAP_IDLE_TIMEOUT):
+                        self._scan(self._imap)
+            except Exception as e:
+                if self._stop_event.is_set():
                     break
-            
-            if not header_bytes:
-                logger.warning(f"⚠️ No se pudieron extraer headers")
-                continue
-            
+                logger.warning("⚠️ Watcher %s/%s caído: %s (reintento en %.0fs)", self.icloud_user, self.folder, e, backoff)
+                self._stop_event.wait(backoff)
+                backoff = min(backoff * 2, 300.0)
+            finally:
+                if self._imap is not None:
+                    imap_pool.close_dedicated(self.icloud_user, self._imap)
+                    self._imap = None
+
+
+class WatcherSupervisor:
+    """
+    Arranca un MailboxWatcher por cada (MAIL_MADRE, carpeta) de icloud_accounts
+    y refresca la lista periódicamente (cuentas nuevas, borradas o con password nuevo).
+    """
+
+    def __init__(self, folders: List[str], refresh_interval: float):
+        self.folders = folders
+        self.refresh_interval = refresh_interval
+        self._watchers: Dict[Tuple[str, str], MailboxWatcher] = {}
+        self._stop_event = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def sync(self) -> None:
+        accounts = {
+            row["icloud_user"]: row["icloud_app_password"]
+            for row in get_parent_accounts()
+            if worker_ring.is_local(row["icloud_user"])  # con varios workers, solo las cuentas propias
+        }
+        wanted = {(user, folder) for user in accounts for folder in self.folders}
+
+        for key in list(self._watchers):
+            watcher = self._watchers[key]
+            if key not in wanted or accounts[key[0]] != watcher.icloud_pass or not watcher.is_alive():
+                watcher.stop()
+                del self._watchers[key]
+
+        for user, folder in wanted - set(self._watchers):
+            watcher = MailboxWatcher(user, accounts[user], folder)
+            watcher.start()
+            self._watchers[(user, folder)] = watcher
+
+        logger.info("👀 Watchers activos: %s", len(self._watchers))
+
+    def is_watching(self, icloud_user: str) -> bool:
+        """
+        True si hay un watcher IDLE vivo en todas las carpetas de la cuenta.
+        """
+        watchers = [self._watchers.get((icloud_user, folder)) for folder in self.folders]
+        return all(w is not None and w.is_alive() for w in watchers)
+
+    def _run(self) -> None:
+        while not self._stop_event.is_set():
             try:
-                header_text = header_bytes.decode('utf-8', errors='ignore')
-                
-                subject = ""
-                from_header = ""
-                date_header = ""
-                
-                for line in header_text.split('\n'):
-                    if line.lower().startswith('subject:'):
-                        subject = line.split(':', 1)[1].strip()
-                        subject = decode_header_part(subject)
-                    elif line.lower().startswith('from:'):
-                        from_header = line.split(':', 1)[1].strip()
-                        from_header = decode_header_part(from_header)
-                    elif line.lower().startswith('date:'):
-                        date_header = line.split(':', 1)[1].strip()
-                
-                # VERIFICAR SI EL EMAIL ES DE LOS ÚLTIMOS N MINUTOS
-                if not is_within_last_minutes(date_header, minutes):
-                    logger.info(f"⏭️ Saltando - email muy antiguo (más de {minutes} minutos)")
-                    continue
-                
-                logger.info(f"📨 Subject: '{subject}'")
-                logger.info(f"📨 From: '{from_header}'")
-                
-                # Determinar tipo de email
-                email_type = None
-                
-                if "fifa id" in subject.lower():
-                    email_type = "FIFA"
-                    logger.info(f"🎯 ¡Encontrado mensaje de FIFA!")
-                elif "noreplyrwc2027@rugbyworldcup.com" in from_header.lower():
-                    subject_lower = subject.lower()
-                    if ("activate" in subject_lower and "rugby world cup" in subject_lower) or \
-                       "ticketing account" in subject_lower:
-                        email_type = "RUGBY"
-                        logger.info(f"🏉 ¡Encontrado mensaje de Rugby World Cup 2027!")
-                
-                if not email_type:
-                    logger.info(f"⏭️ Saltando mensaje - no es de FIFA ni Rugby")
-                    continue
-                
-                recipient_email = extract_recipient_email(header_text)
-                
-                if not recipient_email:
-                    logger.warning(f"⚠️ No se pudo extraer el email destinatario")
-                    continue
-                
-                logger.info(f"🔍 Comparando: '{recipient_email}' vs '{target_email_lower}'")
-                
-                if recipient_email.lower() != target_email_lower:
-                    logger.info(f"⏭️ Saltando - destinatario no coincide")
-                    continue
-                
-                logger.info(f"✅ Correo destinado a {target_email_lower} - procesando...")
-                
+                self.sync()
             except Exception as e:
-                logger.warning(f"⚠️ Error parseando headers: {e}")
-                continue
-            
-            # Obtener mensaje completo
-            logger.info(f"📥 Obteniendo mensaje completo")
-            status, msg_data = imap.fetch(msg_id, "(BODY[])")
-            
-            if status != "OK" or not msg_data:
-                logger.warning(f"⚠️ Error fetching mensaje completo")
-                continue
+                logger.warning("⚠️ Error refrescando watchers: %s", e)
+            self._stop_event.wait(self.refresh_interval)
 
-            raw_msg = None
-            for part in msg_data:
-                if isinstance(part, tuple) and len(part) >= 2:
-                    if isinstance(part[1], (bytes, bytearray)):
-                        raw_msg = part[1]
-                        break
-                elif isinstance(part, (bytes, bytearray)) and len(part) > 100:
-                    raw_msg = part
-                    break
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self._run, name="watcher-supervisor", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop_event.set()
+        for watcher in self._watchers.values():
+            watcher.stop()
+        self._watchers.clear()
+
+
+watcher_supervisor = WatcherSupervisor(IMAP_WATCH_FOLDERS, IMAP_WATCH_REFRESH)
+
+
+# ------- PLANIFICADOR IMAP -------
+
+class Overloaded(Exception):
+    """
+    Cola del planificador llena: la petición se rechaza con 429.
+    """
+
+    def __init__(self, retry_after: int, reason: str):
+        super().__init__(f"cola {reason} llena")
+        self.retry_after = retry_after
+        self.reason = reason
+
+
+class FairIMAPScheduler:
+    """
+    Turnos para el trabajo IMAP (escaneos) en el event loop: como mucho
+    per_account a la vez por MAIL_MADRE y global_limit en total. Lo que no cabe
+    espera en una cola por cuenta y los turnos libres se reparten en round-robin
+    entre las cuentas con cola, así una cuenta muy activa no acapara al resto.
+    Si la cola de la cuenta o la total está llena, Overloaded con un Retry-After
+    estimado a partir de la duración media de los escaneos.
+    """
+
+    def __init__(self, per_account: int, global_limit: int, max_queue: int, max_queue_total: int):
+        self.per_account = max(1, per_account)
+        self.global_limit = max(1, global_limit)
+        self.max_queue = max_queue
+        self.max_queue_total = max_queue_total
+        self._active: Dict[str, int] = {}
+        self._total_active = 0
+        self._queues: "OrderedDict[str, deque]" = OrderedDict()
+        self._total_waiting = 0
+        self._avg_seconds = 1.0
+
+    def _can_start(self, key: str) -> bool:
+        return self._total_active < self.global_limit and self._active.get(key, 0) < self.per_account
 
-            if not raw_msg:
-                logger.error(f"❌ No se pudo extraer raw_msg")
+    def _start(self, key: str) -> None:
+        self._active[key] = self._active.get(key, 0) + 1
+        self._total_active += 1
+
+    def _release(self, key: str, elapsed: float) -> None:
+        self._active[key] -= 1
+        if not self._active[key]:
+            del self._active[key]
+        self._total_active -= 1
+        self._avg_seconds = 0.8 * self._avg_seconds + 0.2 * elapsed
+        self._dispatch()
+
+    def _dispatch(self) -> None:
+        """
+        Reparte los turnos libres: primera cuenta (en orden round-robin) con
+        cola y sitio; después pasa al final de la ronda.
+        """
+        while self._total_waiting and self._total_active < self.global_limit:
+            for key, waiters in self._queues.items():
+                if waiters and self._active.get(key, 0) < self.per_account:
+                    break
+            else:
+                return
+            future = waiters.popleft()
+            self._total_waiting -= 1
+            if not waiters:
+                del self._queues[key]
+            else:
+                self._queues.move_to_end(key)
+            if future.cancelled():
                 continue
+            self._start(key)
+            future.set_result(None)
+
+    def retry_after(self, key: str) -> int:
+        ahead = len(self._queues.get(key, ())) + 1
+        return max(1, min(60, math.ceil(ahead * self._avg_seconds / self.per_account)))
 
+    @asynccontextmanager
+    async def slot(self, icloud_user: str):
+        key = icloud_user.lower().strip()
+        started = time.monotonic()
+        # Siempre por la cola: si hay sitio, _dispatch le da turno en el acto
+        future = asyncio.get_running_loop().create_future()
+        waiters = self._queues.setdefault(key, deque())
+        waiters.append(future)
+        self._total_waiting += 1
+        self._dispatch()
+        if not future.done():
+            if len(waiters) > self.max_queue or self._total_waiting > self.max_queue_total:
+                reason = "account" if len(waiters) > self.max_queue else "global"
+                waiters.remove(future)
+                self._total_waiting -= 1
+                if not waiters:
+                    del self._queues[key]
+                QUEUE_REJECTED.inc(reason=reason)
+                raise Overloaded(self.retry_after(key), reason)
             try:
-                msg = email_lib.message_from_bytes(raw_msg)
+                await future
+            except asyncio.CancelledError:
+                if future.done() and not future.cancelled():
+                    # Ya tenía turno cuando se canceló: devolverlo
+                    self._release(key, time.monotonic() - started)
+                elif future in self._queues.get(key, ()):
+                    self._queues[key].remove(future)
+                    self._total_waiting -= 1
+                    if not self._queues[key]:
+                        del self._queues[key]
+                raise
+        QUEUE_WAIT_SECONDS.observe(time.monotonic() - started)
+        running_since = time.monotonic()
+        try:
+            yield
+        finally:
+            self._release(key, time.monotonic() - running_since)
 
-                subject_full = decode_header_part(msg.get("Subject"))
-                from_ = decode_header_part(msg.get("From"))
-                to_ = decode_header_part(msg.get("To"))
-                date_ = msg.get("Date") or ""
-                
-                logger.info(f"📧 Email parseado completo")
+    async def run(self, icloud_user: str, func, *args, **kwargs):
+        """
+        Espera turno para la cuenta y ejecuta func(*args) (que devuelve un awaitable).
+        """
+        if not IMAP_SCHED_ENABLED:
+            return await func(*args, **kwargs)
+        async with self.slot(icloud_user):
+            return await func(*args, **kwargs)
 
-                # Extraer body
-                body_text = ""
-                body_html = ""
-                
-                if msg.is_multipart():
-                    for part in msg.walk():
-                        content_type = part.get_content_type()
-                        content_disposition = str(part.get("Content-Disposition", ""))
-                        
-                        if content_type == "text/plain" and "attachment" not in content_disposition:
-                            payload = part.get_payload(decode=True)
-                            if payload:
-                                try:
-                                    body_text = payload.decode(errors="ignore")
-                                    logger.info(f"✅ Text/plain: {len(body_text)} chars")
-                                except:
-                                    pass
-                        
-                        elif content_type == "text/html" and "attachment" not in content_disposition:
-                            payload = part.get_payload(decode=True)
-                            if payload:
-                                try:
-                                    body_html = payload.decode(errors="ignore")
-                                    logger.info(f"✅ Text/html: {len(body_html)} chars")
-                                except:
-                                    pass
-                else:
-                    content_type = msg.get_content_type()
-                    payload = msg.get_payload(decode=True)
-                    if payload:
-                        try:
-                            if content_type == "text/plain":
-                                body_text = payload.decode(errors="ignore")
-                            elif content_type == "text/html":
-                                body_html = payload.decode(errors="ignore")
-                        except:
-                            pass
 
-                if not body_text and not body_html:
-                    logger.warning(f"⚠️ No se pudo extraer body")
-                    continue
+imap_scheduler = FairIMAPScheduler(IMAP_SCHED_PER_ACCOUNT, IMAP_SCHED_GLOBAL, IMAP_SCHED_MAX_QUEUE, IMAP_SCHED_MAX_QUEUE_TOTAL)
 
-                # Extraer información
-                otp_code = None
-                activation_url = None
-                
-                if email_type == "FIFA":
-                    otp_code = extract_otp_code(body_text or body_html)
-                    if otp_code:
-                        logger.info(f"🎉 Código OTP: {otp_code}")
-                
-                elif email_type == "RUGBY":
-                    # Intentar con HTML primero, luego texto
-                    if body_html:
-                        activation_url = extract_activation_url(body_html)
-                    if not activation_url and body_text:
-                        activation_url = extract_activation_url(body_text)
-                    
-                    if activation_url:
-                        logger.info(f"🎉 URL extraída correctamente")
-                    else:
-                        logger.warning(f"⚠️ No se encontró URL")
-                
-                # Agregar si encontramos datos
-                if otp_code or activation_url:
+
+# ------- SINGLE-FLIGHT POR CUENTA MADRE -------
+
+class MailboxScanCoalescer:
+    """
+    Un solo escaneo en vuelo por cuenta madre. Los webhooks de sus alias que
+    llegan mientras tanto esperan ese mismo escaneo y recogen lo suyo del
+    code_store por destinatario, en vez de abrir N sesiones IMAP iguales.
+    """
+
+    def __init__(self):
+        self._inflight: Dict[str, asyncio.Task] = {}
+
+    async def scan(self, icloud_user: str, icloud_pass: str, minutes: int, max_emails_to_check: int) -> bool:
+        """
+        Lanza el escaneo o se une al que está en curso. Devuelve True si se unió.
+        """
+        key = icloud_user.lower().strip()
+        task = self._inflight.get(key)
+        joined = task is not None
+        if joined:
+            logger.debug("🤝 Uniéndose al escaneo en curso de %s", icloud_user)
+        else:
+            if IMAP_ASYNC_ENABLED:
+                scan = imap_scheduler.run(icloud_user, fetch_mailbox_hits_async, icloud_user, icloud_pass, minutes, max_emails_to_check)
+            else:
+                scan = imap_scheduler.run(icloud_user, run_in_threadpool, fetch_mailbox_hits, icloud_user, icloud_pass, minutes, max_emails_to_check)
+            task = asyncio.ensure_future(scan)
+            self._inflight[key] = task
+            task.add_done_callback(lambda t: self._done(key, t))
+        # shield: si un cliente se desconecta, el escaneo sigue para los demás
+        await asyncio.shield(task)
+        return joined
+
+    def _done(self, key: str, task: asyncio.Task) -> None:
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        if not task.cancelled():
+            task.exception()  # evitar "exception was never retrieved" si nadie esperaba
+
+    async def collect(self, icloud_user: str, icloud_pass: str, recipient: str, limit: int = 1, minutes: int = 10, max_emails_to_check: int = 30) -> List[MailHit]:
+        """
+        Hits del destinatario tras un escaneo compartido. Si se unió a un escaneo
+        que empezó antes que la petición y no hay nada, espera al siguiente.
+        """
+        for _ in range(2):
+            joined = await self.scan(icloud_user, icloud_pass, minutes, max_emails_to_check)
+            hits = code_store.take(icloud_user, recipient, limit=limit, minutes=minutes)
+            if hits or not joined:
+                return hits
+        return []
+
+
+mailbox_scans = MailboxScanCoalescer()
+
+
+async def wait_for_hits(icloud_user: str, icloud_pass: str, recipient: str, wait_seconds: float, limit: int = 1, minutes: int = WEBHOOK_MINUTES) -> List[MailHit]:
+    """
+    Long-poll: espera a que aparezca un hit para el destinatario o a que pase
+    wait_seconds. Con watcher IDLE solo se espera su aviso; sin él, cada
+    WEBHOOK_WAIT_POLL_INTERVAL se hace un escaneo incremental (cursor)
+    compartido con el resto de alias de la cuenta.
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + min(wait_seconds, WEBHOOK_MAX_WAIT_SECONDS)
+    while True:
+        event = code_store.add_waiter(recipient)
+        try:
+            hits = code_store.take(icloud_user, recipient, limit=limit, minutes=minutes)
+            remaining = deadline - loop.time()
+            if hits or remaining <= 0:
+                return hits
+            watching = IMAP_WATCHER_ENABLED and watcher_supervisor.is_watching(icloud_user)
+            try:
+                await asyncio.wait_for(event.wait(), remaining if watching else min(remaining, WEBHOOK_WAIT_POLL_INTERVAL))
+            except asyncio.TimeoutError:
+                if not watching and loop.time() < deadline:
                     try:
-                        # Marcar como leído
-                        status, response = imap.store(msg_id, '+FLAGS', '\\Seen')
-                        logger.info(f"📝 Store status: {status}")
-                        
-                        # CRÍTICO: Expunge para persistir cambios en iCloud
-                        imap.expunge()
-                        logger.info(f"✅ Mensaje {msg_id} marcado como LEÍDO y persistido")
-                    except Exception as e:
-                        logger.warning(f"⚠️ Error marcando como leído: {e}")
-                    
-                    found_messages.append(
-                        Message(
-                            from_=from_,
-                            subject=subject_full or subject,
-                            date=date_,
-                            to=to_ or recipient_email,
-                            otp_code=otp_code,
-                            activation_url=activation_url,
-                            email_type=email_type,
-                            folder=folder_name,
-                        )
-                    )
-                    logger.info(f"✅ Mensaje {email_type} agregado desde {folder_name}")
-                
-            except Exception as e:
-                logger.error(f"❌ Error parseando: {e}")
-                continue
-        
-        logger.info(f"📊 Revisados {emails_checked} correos en {folder_name}")
-        
-    except Exception as e:
-        logger.error(f"❌ Error en carpeta {folder_name}: {e}")
-    
-    return found_messages
+                        await mailbox_scans.scan(icloud_user, icloud_pass, minutes, WEBHOOK_MAX_EMAILS_TO_CHECK)
+                    except Overloaded:
+                        pass  # cola llena: se salta esta vuelta y se sigue esperando
+        finally:
+            code_store.remove_waiter(recipient, event)
 
 
-def fetch_last_messages(icloud_user: str, icloud_pass: str, target_email: str, limit: int = 1, minutes: int = 10, max_emails_to_check: int = 30) -> List[Message]:
+# ------- MULTI-WORKER -------
+
+class WorkerRing:
     """
-    Conecta con iCloud IMAP y devuelve los últimos N mensajes NO LEÍDOS de los últimos X minutos.
-    Busca en INBOX y en Junk/Spam.
-    Solo revisa los últimos max_emails_to_check correos por carpeta para mayor velocidad.
+    Hash consistente MAIL_MADRE -> worker (con nodos virtuales): al cambiar el
+    número de workers solo se mueve la parte proporcional de las cuentas.
     """
-    imap = imaplib.IMAP4_SSL(IMAP_HOST, IMAP_PORT)
-    try:
-        imap.login(icloud_user, icloud_pass)
-        logger.info(f"✅ Login exitoso para {icloud_user}")
-    except imaplib.IMAP4.error as e:
-        raise Exception(f"Error autenticando en iCloud: {e}")
-
-    logger.info(f"🎯 Buscando correos para: {target_email}")
-    logger.info(f"⏰ Solo emails de los últimos {minutes} minutos")
-    logger.info(f"⚡ Máximo {max_emails_to_check} correos por carpeta")
-    
-    all_messages: List[Message] = []
-    
-    # Lista de carpetas a revisar
-    folders_to_check = ["INBOX", "Junk"]
-    
-    for folder in folders_to_check:
-        logger.info(f"\n{'='*60}")
-        logger.info(f"🔍 Revisando carpeta: {folder}")
-        logger.info(f"{'='*60}")
-        
-        messages = search_in_folder(imap, folder, target_email, limit, minutes, max_emails_to_check)
-        all_messages.extend(messages)
-        
-        # Si ya encontramos el límite, parar
-        if len(all_messages) >= limit:
-            logger.info(f"✅ Límite alcanzado ({limit} mensajes)")
+
+    REPLICAS = 100
+
+    def __init__(self, workers: int):
+        self.workers = workers
+        points = [(self._hash(f"worker-{i}-{r}"), i) for i in range(workers) for r in range(self.REPLICAS)]
+        points.sort()
+        self._hashes = [h for h, _ in points]
+        self._owners = [i for _, i in points]
+
+    @staticmethod
+    def _hash(key: str) -> int:
+        return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], "big")
+
+    def owner(self, icloud_user: str) -> int:
+        if self.workers <= 1:
+            return 0
+        pos = bisect.bisect(self._hashes, self._hash(icloud_user.lower().strip()))
+        return self._owners[pos % len(self._owners)]
+
+    def is_local(self, icloud_user: str) -> bool:
+        return self.owner(icloud_user) == WORKER_INDEX
+
+
+worker_ring = WorkerRing(WEB_WORKERS)
+
+
+def worker_socket_path(index: int) -> str:
+    return os.path.join(WORKER_SOCKET_DIR, f"fastapi_webhook-{PORT}-{index}.sock")
+
+
+def is_worker_forward(header_value: Optional[str]) -> bool:
+    """
+    True solo si la petición la reenvió otro worker (X-Worker-Forwarded con el
+    secreto de este despliegue). Un cliente del puerto público que ponga la
+    cabecera no se salta la afinidad: se le trata como a cualquier otro.
+    """
+    if not header_value or not WORKER_FORWARD_SECRET:
+        return False
+    return hmac.compare_digest(header_value.encode(), WORKER_FORWARD_SECRET.encode())
+
+
+def _dechunk(data: bytes) -> bytes:
+    body = b""
+    while data:
+        size_line, _, data = data.partition(b"\r\n")
+        size = int(size_line.split(b";")[0], 16)
+        if size == 0:
             break
-    
-    # Cerrar carpeta antes de logout
+        body += data[:size]
+        data = data[size + 2:]
+    return body
+
+
+async def forward_to_worker(index: int, path: str, body: bytes, method: str = "POST") -> Tuple[int, Dict[str, str], bytes]:
+    """
+    Petición (POST por defecto) al worker por su socket Unix (HTTP/1.1, una
+    conexión por petición). Devuelve (status, headers, body).
+    """
+    reader, writer = await asyncio.wait_for(asyncio.open_unix_connection(worker_socket_path(index)), 5)
     try:
-        imap.close()
-        logger.info("✅ Carpeta cerrada correctamente")
-    except Exception as e:
-        logger.warning(f"⚠️ Error cerrando carpeta: {e}")
-    
-    imap.logout()
-    logger.info(f"📊 Total procesados: {len(all_messages)}")
-    return all_messages[:limit]  # Asegurar que no devolvemos más del límite
+        writer.write(
+            (
+                f"{method} {path} HTTP/1.1\r\n"
+                f"Host: worker-{index}\r\n"
+                "Content-Type: application/json\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                f"X-Worker-Forwarded: {WORKER_FORWARD_SECRET}\r\n"
+                "Connection: close\r\n\r\n"
+            ).encode()
+            + body
+        )
+        await writer.drain()
+        raw = await asyncio.wait_for(reader.read(), WORKER_FORWARD_TIMEOUT)
+    finally:
+        writer.close()
+
+    head, _, payload = raw.partition(b"\r\n\r\n")
+    lines = head.decode("latin-1").split("\r\n")
+    status = int(lines[0].split()[1])
+    headers = {}
+    for line in lines[1:]:
+        name, _, value = line.partition(":")
+        headers[name.strip().lower()] = value.strip()
+    if headers.get("transfer-encoding", "").lower() == "chunked":
+        payload = _dechunk(payload)
+    return status, headers, payload
 
 
 # ------- RUTAS -------
@@ -550,33 +4553,411 @@ def home():
     return {"status": "ok", "mensaje": "FastAPI + Supabase + iCloud listo"}
 
 
+@app.get("/metrics")
+async def get_metrics(x_worker_forwarded: Optional[str] = Header(None)):
+    """
+    Con WEB_WORKERS > 1 cada scrape cae en un worker cualquiera (SO_REUSEPORT):
+    ese worker pide sus métricas a los demás por los sockets Unix y devuelve
+    todas juntas, cada serie con su label worker. Un worker que no contesta
+    simplemente falta en esa respuesta.
+    """
+    if WEB_WORKERS <= 1:
+        return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+    text = metrics.render(worker=str(WORKER_INDEX))
+    if not is_worker_forward(x_worker_forwarded):
+        others = [index for index in range(WEB_WORKERS) if index != WORKER_INDEX]
+        results = await asyncio.gather(
+            *(asyncio.wait_for(forward_to_worker(index, "/metrics", b"", method="GET"), 5) for index in others),
+            return_exceptions=True,
+        )
+        texts = [text]
+        for index, result in zip(others, results):
+            if isinstance(result, BaseException) or result[0] != 200:
+                logger.warning("⚠️ Worker %s no devolvió sus métricas: %s", index, result if isinstance(result, BaseException) else result[0])
+                continue
+            texts.append(result[2].decode("utf-8", errors="replace"))
+        text = merge_metrics_text(texts)
+    return PlainTextResponse(text, media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
 @app.post("/webhook", response_model=WebhookResponse)
-def handle_webhook(payload: WebhookInput):
-    logger.info(f"🎯 Webhook recibido para: {payload.email}")
+async def handle_webhook(payload: WebhookInput, background_tasks: BackgroundTasks, x_worker_forwarded: Optional[str] = Header(None)):
+    # Un solo evento por petición; el detalle por mensaje va a DEBUG
+    summary = {"email": payload.email, "source": None, "messages": 0}
+    started = time.perf_counter()
+    status = 500
+    try:
+        response = await _handle_webhook(payload, background_tasks, summary, forwarded=is_worker_forward(x_worker_forwarded))
+        status = 200
+        summary["messages"] = len(response.messages)
+        return response
+    except HTTPException as e:
+        status = e.status_code
+        raise
+    finally:
+        elapsed = time.perf_counter() - started
+        REQUEST_SECONDS.observe(elapsed, endpoint="/webhook", status=status)
+        if status >= 500:
+            ERRORS.inc(type="http_%d" % status, where="webhook")
+        log_event(
+            "webhook",
+            level=logging.INFO if status == 200 else logging.WARNING,
+            sample=status == 200,
+            status=status,
+            ms=round(elapsed * 1000, 1),
+            **summary,
+        )
+
+
+async def _handle_webhook(payload: WebhookInput, background_tasks: BackgroundTasks, summary: dict, forwarded: bool = False) -> WebhookResponse:
+    logger.debug("🎯 Webhook recibido para: %s", payload.email)
     
-    account = get_account(payload.email)
+    with PHASE_SECONDS.time(phase="get_account"):
+        account = await run_in_threadpool(get_account, payload.email)
     if not account:
-        logger.error(f"❌ Cuenta no encontrada")
+        logger.error("❌ Cuenta no encontrada")
         raise HTTPException(status_code=404, detail="Cuenta no encontrada")
 
     icloud_user = account["icloud_user"]
     icloud_pass = account["icloud_app_password"]
-    logger.info(f"🔑 Credenciales encontradas")
+    logger.debug("🔑 Credenciales encontradas")
+
+    # Con varios workers, la cuenta madre la atiende siempre el mismo (sesiones y cachés)
+    if not forwarded and not worker_ring.is_local(icloud_user):
+        owner = worker_ring.owner(icloud_user)
+        try:
+            status, headers, body = await forward_to_worker(owner, "/webhook", json.dumps(jsonable_encoder(payload)).encode())
+        except (OSError, asyncio.TimeoutError) as e:
+            logger.warning("⚠️ Worker %s no responde (%s), se atiende aquí", owner, e)
+            ERRORS.inc(type=type(e).__name__, where="forward")
+        else:
+            summary["source"] = f"worker-{owner}"
+            data = json.loads(body or b"{}")
+            if status != 200:
+                extra = {"Retry-After": headers["retry-after"]} if "retry-after" in headers else None
+                raise HTTPException(status_code=status, detail=data.get("detail"), headers=extra)
+            return WebhookResponse(**data)
+
+    # Reintento de algo ya entregado: la misma respuesta, sin IMAP
+    # (salvo que ya haya en memoria un código sin entregar para el alias: ese es más nuevo)
+    replayed = await run_in_threadpool(code_log.recent, payload.email)
+    if replayed and not code_store.has_pending(icloud_user, payload.email, WEBHOOK_MINUTES):
+        logger.debug("🔁 Código ya entregado, se repite la respuesta")
+        summary["source"] = "replay"
+        return WebhookResponse(email=payload.email, messages=replayed, replayed=True)
+
+    # Primero mirar lo que ya extrajo el watcher; el \Seen se pone después de responder
+    hits = code_store.take(icloud_user, payload.email, limit=1, minutes=WEBHOOK_MINUTES)
+    if hits:
+        logger.debug("⚡ Código servido desde memoria")
+        summary["source"] = "memory"
+        await run_in_threadpool(code_log.record, icloud_user, payload.email, hits)
+        background_tasks.add_task(mark_hits_seen, icloud_user, icloud_pass, hits)
+        return WebhookResponse(email=payload.email, messages=[hit.message for hit in hits])
 
     try:
         # Buscar emails de los últimos 10 minutos
-        # Solo revisar los últimos 30 correos por carpeta para ser más rápido
-        messages = fetch_last_messages(
-            icloud_user, 
-            icloud_pass, 
-            payload.email, 
-            limit=1, 
-            minutes=10, 
-            max_emails_to_check=15
+        # Solo revisar los últimos 15 correos por carpeta para ser más rápido
+        summary["source"] = "scan"
+        if WEBHOOK_COALESCE_ENABLED:
+            hits = await mailbox_scans.collect(
+                icloud_user,
+                icloud_pass,
+                payload.email,
+                limit=1,
+                minutes=WEBHOOK_MINUTES,
+                max_emails_to_check=WEBHOOK_MAX_EMAILS_TO_CHECK,
+            )
+            if hits:
+                background_tasks.add_task(mark_hits_seen, icloud_user, icloud_pass, hits)
+        elif IMAP_ASYNC_ENABLED:
+            hits = await imap_scheduler.run(
+                icloud_user,
+                fetch_last_hits_async,
+                icloud_user,
+                icloud_pass,
+                payload.email,
+                limit=1,
+                minutes=WEBHOOK_MINUTES,
+                max_emails_to_check=WEBHOOK_MAX_EMAILS_TO_CHECK,
+            )
+        else:
+            # Fallback: imaplib síncrono en el threadpool
+            hits = await imap_scheduler.run(
+                icloud_user,
+                run_in_threadpool,
+                fetch_last_hits,
+                icloud_user, 
+                icloud_pass, 
+                payload.email, 
+                limit=1, 
+                minutes=WEBHOOK_MINUTES, 
+                max_emails_to_check=WEBHOOK_MAX_EMAILS_TO_CHECK
+            )
+
+        if not hits and payload.wait_seconds > 0:
+            logger.debug("⏳ Esperando hasta %ss a que llegue el código", payload.wait_seconds)
+            summary["source"] = "wait"
+            hits = await wait_for_hits(icloud_user, icloud_pass, payload.email, payload.wait_seconds)
+            if hits:
+                background_tasks.add_task(mark_hits_seen, icloud_user, icloud_pass, hits)
+        await run_in_threadpool(code_log.record, icloud_user, payload.email, hits)
+        messages = [hit.message for hit in hits]
+        logger.debug("✅ Mensajes obtenidos: %s", len(messages))
+    except Overloaded as e:
+        logger.warning("🚦 %s: cola IMAP %s llena, reintentar en %ss", icloud_user, e.reason, e.retry_after)
+        summary["error"] = str(e)
+        raise HTTPException(
+            status_code=429,
+            detail="Demasiadas peticiones para esta cuenta, reintenta más tarde",
+            headers={"Retry-After": str(e.retry_after)},
+        )
+    except CircuitOpen as e:
+        logger.warning("🔌 %s", e)
+        summary["error"] = str(e)
+        raise HTTPException(
+            status_code=503,
+            detail="Login de iCloud fallando para esta cuenta, reintenta más tarde",
+            headers={"Retry-After": str(e.retry_after)},
         )
-        logger.info(f"✅ Mensajes obtenidos: {len(messages)}")
     except Exception as e:
-        logger.error(f"❌ Error: {e}")
+        logger.error("❌ Error: %s", e)
+        summary["error"] = str(e)
         raise HTTPException(status_code=500, detail=str(e))
 
     return WebhookResponse(email=payload.email, messages=messages)
+
+
+@app.post("/webhook/batch", response_model=WebhookBatchResponse)
+async def handle_webhook_batch(payload: WebhookBatchInput, background_tasks: BackgroundTasks, x_worker_forwarded: Optional[str] = Header(None)):
+    """
+    Resuelve muchos alias en una llamada: una query para todas las cuentas,
+    un escaneo por cuenta madre y los resultados repartidos por alias.
+    Los alias sin código todavía vuelven como "pending".
+    """
+    started = time.perf_counter()
+    emails = list(dict.fromkeys(e.strip() for e in payload.emails if e.strip()))
+    if len(emails) > WEBHOOK_BATCH_MAX:
+        raise HTTPException(status_code=400, detail=f"Máximo {WEBHOOK_BATCH_MAX} emails por llamada")
+    logger.debug("🎯 Webhook batch recibido: %s emails", len(emails))
+
+    try:
+        with PHASE_SECONDS.time(phase="get_account"):
+            accounts = await run_in_threadpool(get_accounts, emails)
+    except Exception as e:
+        logger.error("❌ Error: %s", e)
+        raise HTTPException(status_code=500, detail=str(e))
+
+    results: Dict[str, WebhookBatchResult] = {}
+
+    # Con varios workers, cada grupo de alias va al worker dueño de su cuenta madre
+    remote: Dict[int, List[str]] = {}
+    if WEB_WORKERS > 1 and not is_worker_forward(x_worker_forwarded):
+        for email_in in emails:
+            account = accounts.get(email_in)
+            if account and not worker_ring.is_local(account["icloud_user"]):
+                remote.setdefault(worker_ring.owner(account["icloud_user"]), []).append(email_in)
+
+    async def forward_batch(owner: int, aliases: List[str]) -> None:
+        try:
+            status, _, body = await forward_to_worker(owner, "/webhook/batch", json.dumps({"emails": aliases}).encode())
+            if status != 200:
+                raise OSError(f"status {status}")
+        except (OSError, asyncio.TimeoutError) as e:
+            logger.warning("⚠️ Worker %s no responde (%s), se atiende aquí", owner, e)
+            ERRORS.inc(type=type(e).__name__, where="forward")
+            return
+        for item in json.loads(body)["results"]:
+            results[item["email"]] = WebhookBatchResult(**item)
+
+    await asyncio.gather(*(forward_batch(owner, aliases) for owner, aliases in remote.items()))
+    local_emails = [e for e in emails if e not in results]
+
+    replayed = await run_in_threadpool(code_log.recent_many, [e for e in local_emails if accounts.get(e)])
+
+    by_mailbox: Dict[str, List[str]] = {}
+    passwords: Dict[str, str] = {}
+    delivered: Dict[str, List[MailHit]] = {}
+    delivered_to: Dict[str, List[MailHit]] = {}
+    for email_in in local_emails:
+        account = accounts.get(email_in)
+        if not account:
+            results[email_in] = WebhookBatchResult(email=email_in, status="not_found")
+            continue
+        icloud_user = account["icloud_user"]
+        if email_in in replayed and not code_store.has_pending(icloud_user, email_in, WEBHOOK_MINUTES):
+            results[email_in] = WebhookBatchResult(email=email_in, status="found", messages=replayed[email_in], replayed=True)
+            continue
+        passwords[icloud_user] = account["icloud_app_password"]
+        # Lo que ya está en memoria no necesita escaneo
+        hits = code_store.take(icloud_user, email_in, limit=1, minutes=WEBHOOK_MINUTES)
+        if hits:
+            delivered.setdefault(icloud_user, []).extend(hits)
+            delivered_to[email_in] = hits
+            results[email_in] = WebhookBatchResult(email=email_in, status="found", messages=[h.message for h in hits])
+        else:
+            by_mailbox.setdefault(icloud_user, []).append(email_in)
+
+    logger.debug("📬 %s cuentas madre a escanear", len(by_mailbox))
+
+    async def scan_mailbox(icloud_user: str, aliases: List[str]) -> None:
+        try:
+            await mailbox_scans.scan(
+                icloud_user,
+                passwords[icloud_user],
+                minutes=WEBHOOK_MINUTES,
+                max_emails_to_check=WEBHOOK_MAX_EMAILS_TO_CHECK,
+            )
+        except (Overloaded, CircuitOpen) as e:
+            for email_in in aliases:
+                results[email_in] = WebhookBatchResult(email=email_in, status="pending", detail=f"Retry-After: {e.retry_after}")
+            return
+        except Exception as e:
+            logger.error("❌ Error escaneando %s: %s", icloud_user, e)
+            for email_in in aliases:
+                results[email_in] = WebhookBatchResult(email=email_in, status="error", detail=str(e))
+            return
+        for email_in in aliases:
+            hits = code_store.take(icloud_user, email_in, limit=1, minutes=WEBHOOK_MINUTES)
+            if hits:
+                delivered.setdefault(icloud_user, []).extend(hits)
+                delivered_to[email_in] = hits
+                results[email_in] = WebhookBatchResult(email=email_in, status="found", messages=[h.message for h in hits])
+            else:
+                results[email_in] = WebhookBatchResult(email=email_in, status="pending")
+
+    await asyncio.gather(*(scan_mailbox(user, aliases) for user, aliases in by_mailbox.items()))
+
+    await run_in_threadpool(
+        code_log.record_many,
+        [(accounts[email_in]["icloud_user"], email_in, hits) for email_in, hits in delivered_to.items()],
+    )
+
+    for icloud_user, hits in delivered.items():
+        background_tasks.add_task(mark_hits_seen, icloud_user, passwords[icloud_user], hits)
+
+    counts: Dict[str, int] = {}
+    for r in results.values():
+        counts[r.status] = counts.get(r.status, 0) + 1
+    elapsed = time.perf_counter() - started
+    REQUEST_SECONDS.observe(elapsed, endpoint="/webhook/batch", status=200)
+    for email_status, count in counts.items():
+        if email_status == "error":
+            ERRORS.inc(count, type="scan", where="webhook_batch")
+    log_event("webhook_batch", emails=len(emails), mailboxes=len(by_mailbox), ms=round(elapsed * 1000, 1), **counts)
+    return WebhookBatchResponse(results=[results[e] for e in emails])
+
+
+@app.on_event("startup")
+def start_background_services():
+    if ACCOUNTS_INSTALL_NOTIFY_TRIGGER:
+        install_accounts_notify_trigger()
+    if ACCOUNT_INDEX_ENABLED:
+        try:
+            account_index.load()
+        except Exception as e:
+            logger.warning("⚠️ No se pudo precargar el índice de cuentas (se reintenta en segundo plano): %s", e)
+        account_index.start()
+    if ACCOUNTS_LISTEN_ENABLED:
+        accounts_listener.start()
+    if CODE_LOG_ENABLED:
+        try:
+            code_log.persist = check_code_log_table()
+        except Exception as e:
+            logger.warning("⚠️ No se pudo comprobar extracted_codes: %s", e)
+    if SEEN_COMMIT_ENABLED:
+        seen_committer.start()
+    if IMAP_WATCHER_ENABLED:
+        watcher_supervisor.start()
+
+
+@app.on_event("shutdown")
+async def close_connections():
+    watcher_supervisor.stop()
+    accounts_listener.stop()
+    account_index.stop()
+    await run_in_threadpool(seen_committer.stop)
+    imap_pool.close_all()
+    await async_imap_pool.close_all()
+    close_db_pool()
+    stop_logging()
+
+
+# ------- ARRANQUE -------
+
+def _run_worker() -> None:
+    """
+    Un worker: uvicorn sobre el puerto público (SO_REUSEPORT, el kernel reparte
+    las conexiones) y sobre su socket Unix, por donde le llegan los reenvíos.
+    """
+    import uvicorn
+
+    if not WORKER_FORWARD_SECRET:
+        raise RuntimeError("WORKER_FORWARD_SECRET vacío: los workers se lanzan con serve() (python app.py)")
+
+    public = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    public.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    public.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    public.bind((HOST, PORT))
+
+    path = worker_socket_path(WORKER_INDEX)
+    if os.path.exists(path):
+        os.unlink(path)
+    local = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    local.bind(path)
+    os.chmod(path, 0o600)  # solo el usuario del servicio
+
+    logger.info("🚀 Worker %s/%s escuchando en %s:%s y %s", WORKER_INDEX, WEB_WORKERS, HOST, PORT, path)
+    try:
+        uvicorn.Server(uvicorn.Config(app)).run(sockets=[public, local])
+    finally:
+        if os.path.exists(path):
+            os.unlink(path)
+
+
+def serve() -> None:
+    """
+    Punto de entrada (python app.py). Con WEB_WORKERS=1 es el uvicorn de siempre;
+    con más, lanza un proceso por worker y los vuelve a lanzar si se caen.
+    """
+    import uvicorn
+
+    if WEB_WORKERS <= 1:
+        uvicorn.run(app, host=HOST, port=PORT)
+        return
+
+    context = multiprocessing.get_context("spawn")
+    workers: Dict[int, multiprocessing.Process] = {}
+    stop_event = threading.Event()
+
+    def start_worker(index: int) -> None:
+        # El worker es un proceso nuevo que importa app.py: el índice va por entorno
+        os.environ["WORKER_INDEX"] = str(index)
+        process = context.Process(target=_run_worker, name=f"worker-{index}")
+        process.start()
+        workers[index] = process
+
+    signal.signal(signal.SIGTERM, lambda *_: stop_event.set())
+    signal.signal(signal.SIGINT, lambda *_: stop_event.set())
+
+    # Secreto de los reenvíos entre workers: nuevo en cada arranque, solo lo conocen los procesos hijos
+    os.environ["WORKER_FORWARD_SECRET"] = secrets.token_hex(32)
+    for index in range(WEB_WORKERS):
+        start_worker(index)
+    logger.info("🚀 %s workers en %s:%s", WEB_WORKERS, HOST, PORT)
+
+    while not stop_event.wait(1.0):
+        for index, process in list(workers.items()):
+            if not process.is_alive():
+                logger.warning("⚠️ Worker %s terminó (código %s), relanzando", index, process.exitcode)
+                start_worker(index)
+
+    for process in workers.values():
+        process.terminate()
+    for process in workers.values():
+        process.join(timeout=30)
+    stop_logging()
+
+
+if __name__ == "__main__":
+    serve()
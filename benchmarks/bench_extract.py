@@ -0,0 +1,146 @@
+"""
+Benchmark y comprobación de extract_activation_url (cada regla primero en los
+href con iter_hrefs y luego en todo el texto) frente a la función original
+(legacy_extract_activation_url de bench_rules.py: findall por patrón).
+
+Comprueba que ambas dan la misma URL en el corpus (correos RUGBY de mailgen,
+HTML de ticketing con muchos enlaces, ruido sin URL de activación) y el valor
+esperado en los casos de entidades/comillas donde el recorrido de href
+corrige a la original. Si algo no cuadra termina con código 1.
+
+Uso:
+    python benchmarks/bench_extract.py --repeat 200
+"""
+import argparse
+import email
+import os
+import random
+import sys
+import time
+from typing import List, Optional, Tuple
+
+os.environ.setdefault("DATABASE_URL", "postgresql://benchmark")
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, ".."))
+sys.path.insert(0, BENCH_DIR)
+
+import app  # noqa: E402
+import mailgen  # noqa: E402
+from bench_rules import legacy_extract_activation_url  # noqa: E402
+
+ACTIVATE = "https://rwc2027.tmtickets.co.uk/Authentication/ActivateAccount/"
+
+
+def html_part(raw: bytes) -> str:
+    msg = email.message_from_bytes(raw)
+    for part in msg.walk():
+        if part.get_content_type() == "text/html":
+            return part.get_payload(decode=True).decode("utf-8", errors="ignore")
+    return ""
+
+
+def ticketing_html(token: str, links: int, rng: random.Random) -> str:
+    """
+    Plantilla tipo ticketing: cabecera, muchos enlaces de navegación y redes,
+    píxeles de tracking, el botón de activación y el pie con la baja.
+    """
+    rows = []
+    for i in range(links):
+        host = rng.choice(["www.rugbyworldcup.com", "rwc2027.rugbyworldcup.com", "t.example-mail.com", "www.facebook.com"])
+        rows.append(
+            f'<tr><td style="padding:4px"><a href="https://{host}/en/page/{i}?utm_source=email&amp;utm_medium=nav&amp;id={rng.getrandbits(32):x}" '
+            f'target="_blank" style="color:#0b3d91">Enlace {i}</a>{mailgen.FILLER}</td></tr>'
+        )
+        if i % 10 == 0:
+            rows.append(f'<img src="https://t.example-mail.com/open/{rng.getrandbits(64):x}.gif" width="1" height="1" alt="">')
+    middle = len(rows) // 2
+    rows.insert(middle, f'<tr><td><a class="btn" href="{ACTIVATE}{token}?lang=en&amp;src=email">Activate your account</a></td></tr>')
+    return (
+        '<html><head><style>a{color:#0b3d91}</style></head><body><table>'
+        + "".join(rows)
+        + '<tr><td><a href="https://rwc2027.rugbyworldcup.com/en/unsubscribe?list=ticketing">Unsubscribe</a></td></tr>'
+        + "</table></body></html>"
+    )
+
+
+def corpus(rng: random.Random) -> List[Tuple[str, str]]:
+    cases = []
+    for size in (5000, 60000, 250000):
+        token = "%016x" % rng.getrandbits(64)
+        cases.append((f"mailgen rugby {size // 1000}KB", html_part(mailgen.rugby_email("a@icloud.com", token, html_size=size))))
+    for links in (20, 200):
+        cases.append((f"ticketing {links} enlaces", ticketing_html("%016x" % rng.getrandbits(64), links, rng)))
+    cases.append(("ruido sin activación", html_part(mailgen.noise_email("a@icloud.com", rng, html_size=60000))))
+    cases.append(("solo rugbyworldcup", '<p><a href="https://rwc2027.rugbyworldcup.com/en/tickets/activate?token=abcdefghijklmnopqrstuvwxyz">x</a></p>'))
+    cases.append(("URL en texto plano", f"Activa tu cuenta: {ACTIVATE}abc123?lang=en\n"))
+    cases.append(("HREF en mayúsculas", f'<A HREF="{ACTIVATE}up123?x=1&amp;y=2">x</A>'))
+    unsubscribe = "https://mail.example-esp.com/unsubscribe?list=ticketing&amp;u=" + "a1b2c3d4" * 16
+    cases.append(("texto + href largo", f'<p>Copia este enlace: {ACTIVATE}txt123?lang=en</p><a href="{unsubscribe}">Baja</a>'))
+    cases.append((
+        "texto + href rugbyworldcup",
+        f'<p>{ACTIVATE}txt456</p><a href="https://rwc2027.rugbyworldcup.com/en/unsubscribe?list=ticketing&amp;id=123">Baja</a>',
+    ))
+    return cases
+
+
+# Casos en los que el valor correcto no es el que daba la regex sobre el texto
+EXPECTED = [
+    ("entidad numérica", f'<a href="{ACTIVATE}t1?a=1&#38;b=2">x</a>', f"{ACTIVATE}t1?a=1&b=2"),
+    ("entidad hexadecimal", f'<a href="{ACTIVATE}t2?next=%2F&#x26;c=3">x</a>', f"{ACTIVATE}t2?next=%2F&c=3"),
+    ("comillas simples", f"<a href='{ACTIVATE}t3?a=1&amp;b=2'>x</a>", f"{ACTIVATE}t3?a=1&b=2"),
+    ("sin comillas", f"<a href={ACTIVATE}t4?a=1>x</a>", f"{ACTIVATE}t4?a=1"),
+]
+
+
+def old_extract(text: str) -> Optional[str]:
+    return legacy_extract_activation_url(text)
+
+
+def new_extract(text: str) -> Optional[str]:
+    return app.extract_activation_url(text)
+
+
+def timed(fn, text: str, repeat: int) -> float:
+    started = time.perf_counter()
+    for _ in range(repeat):
+        fn(text)
+    return (time.perf_counter() - started) / repeat
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=200, help="repeticiones por caso")
+    parser.add_argument("--seed", type=int, default=2027)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    failures = 0
+
+    print(f"{'caso':<26} {'KB':>6} {'antes µs':>10} {'ahora µs':>10} {'x':>6}  resultado")
+    for name, text in corpus(rng):
+        old, new = old_extract(text), new_extract(text)
+        ok = old == new
+        failures += not ok
+        before = timed(old_extract, text, args.repeat) * 1e6
+        after = timed(new_extract, text, args.repeat) * 1e6
+        print(f"{name:<26} {len(text) / 1024:>6.1f} {before:>10.1f} {after:>10.1f} {before / after:>6.2f}  {'ok' if ok else 'DISTINTO'}")
+        if not ok:
+            print(f"    antes: {old}\n    ahora: {new}")
+
+    for name, text, expected in EXPECTED:
+        new = new_extract(text)
+        ok = new == expected
+        failures += not ok
+        print(f"{name:<26} {'':>6} {'':>10} {'':>10} {'':>6}  {'ok' if ok else 'MAL'} (antes: {old_extract(text)})")
+        if not ok:
+            print(f"    esperado: {expected}\n    ahora:    {new}")
+
+    if failures:
+        print(f"❌ {failures} casos no coinciden")
+        sys.exit(1)
+    print("✅ Todos los casos coinciden")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,153 @@
+"""
+Micro-benchmark: clasificación + extracción con el registro de reglas
+(email_rules) frente a la lógica anterior (ifs + re.search/re.findall sin compilar).
+
+Uso:
+    python benchmarks/bench_rules.py --number 2000
+
+Comprueba además que las dos versiones dan el mismo resultado en todo el corpus.
+"""
+import argparse
+import logging
+import os
+import re
+import sys
+import timeit
+
+os.environ.setdefault("DATABASE_URL", "postgresql://benchmark")
+os.environ.setdefault("ACCOUNTS_LISTEN_ENABLED", "false")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import app  # noqa: E402
+
+logging.disable(logging.CRITICAL)
+
+
+# ------- VERSIÓN ANTERIOR (referencia) -------
+
+def legacy_classify(from_header: str, subject: str):
+    if "fifa id" in subject.lower():
+        return "FIFA"
+    if "noreplyrwc2027@rugbyworldcup.com" in from_header.lower():
+        subject_lower = subject.lower()
+        if ("activate" in subject_lower and "rugby world cup" in subject_lower) or \
+           "ticketing account" in subject_lower:
+            return "RUGBY"
+    return None
+
+
+def legacy_extract_otp_code(text):
+    if not text:
+        return None
+    patterns = [
+        r'código[:\s]+(\d{6})',
+        r'code[:\s]+(\d{6})',
+        r'verification[:\s]+(\d{6})',
+        r'\b(\d{6})\b',
+    ]
+    for pattern in patterns:
+        match = re.search(pattern, text, re.IGNORECASE)
+        if match:
+            return match.group(1)
+    return None
+
+
+def legacy_extract_activation_url(text):
+    if not text:
+        return None
+    patterns = [
+        r'(https://rwc2027\.tmtickets\.co\.uk/Authentication/ActivateAccount/[^\s<>"\']+)',
+        r'(https://[^\s<>"\']*tmtickets\.co\.uk[^\s<>"\']*)',
+        r'(https://rwc2027\.rugbyworldcup\.com/[^\s<>"\']{20,})',
+    ]
+    for pattern in patterns:
+        matches = re.findall(pattern, text, re.IGNORECASE)
+        if matches:
+            url = max(matches, key=len)
+            url = url.rstrip('.,;)\'"')
+            url = url.replace('&amp;', '&')
+            url = url.replace('&quot;', '"')
+            url = url.replace('&#39;', "'")
+            url = url.replace('&lt;', '<')
+            url = url.replace('&gt;', '>')
+            return url
+    all_urls = re.findall(r'https://[^\s<>"\']+', text)
+    if all_urls:
+        long_urls = [url for url in all_urls if len(url) > 100]
+        if long_urls:
+            url = max(long_urls, key=len)
+            url = url.rstrip('.,;)\'"')
+            url = url.replace('&amp;', '&')
+            return url
+    return None
+
+
+def legacy_process(from_header, subject, body_text, body_html):
+    email_type = legacy_classify(from_header, subject)
+    if email_type == "FIFA":
+        return email_type, legacy_extract_otp_code(body_text or body_html)
+    if email_type == "RUGBY":
+        url = legacy_extract_activation_url(body_html) if body_html else None
+        if not url and body_text:
+            url = legacy_extract_activation_url(body_text)
+        return email_type, url
+    return None, None
+
+
+def rules_process(from_header, subject, body_text, body_html):
+    rule = app.email_rules.classify(from_header, subject)
+    if rule is None:
+        return None, None
+    return rule.name, rule.extract(body_text, body_html)
+
+
+# ------- CORPUS -------
+
+FILLER = "Lorem ipsum dolor sit amet, consectetur adipiscing elit. " * 40
+TRACKING = "https://click.example.com/track?id=" + "x" * 140
+ACTIVATION = "https://rwc2027.tmtickets.co.uk/Authentication/ActivateAccount/abc123DEF456?token=zz&amp;lang=en"
+
+CORPUS = [
+    ("FIFA <noreply@fifa.com>", "Your FIFA ID verification code",
+     f"{FILLER}\nYour verification code: 482913\n{FILLER}", ""),
+    ("FIFA <noreply@fifa.com>", "FIFA ID - código",
+     "", f"<html><body><p>{FILLER}</p><p>Tu código: 771204</p></body></html>"),
+    ("Rugby World Cup 2027 <noreplyrwc2027@rugbyworldcup.com>", "Activate your Rugby World Cup 2027 ticketing account",
+     "", f'<html><body>{FILLER}<a href="{TRACKING}">x</a><a href="{ACTIVATION}">Activate</a>{FILLER}</body></html>'),
+    ("Rugby World Cup 2027 <noreplyrwc2027@rugbyworldcup.com>", "Your ticketing account",
+     f"{FILLER}\nActivate here: {TRACKING}\n", ""),
+    ("Newsletter <news@example.com>", "Weekly digest 123456", FILLER, f"<p>{FILLER}</p>"),
+    ("Rugby World Cup 2027 <noreplyrwc2027@rugbyworldcup.com>", "Match schedule", FILLER, ""),
+]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--number", type=int, default=2000, help="repeticiones por medición")
+    number = parser.parse_args().number
+
+    for sample in CORPUS:
+        legacy, rules = legacy_process(*sample), rules_process(*sample)
+        assert legacy == rules, f"Resultado distinto para {sample[1]!r}: {legacy} != {rules}"
+    print(f"✅ Mismo resultado en los {len(CORPUS)} correos del corpus")
+
+    def run(process):
+        for sample in CORPUS:
+            process(*sample)
+
+    for name, process in (("anterior", legacy_process), ("reglas", rules_process)):
+        seconds = min(timeit.repeat(lambda: run(process), number=number, repeat=3))
+        per_message = seconds / (number * len(CORPUS)) * 1e6
+        print(f"{name:>9}: {per_message:8.2f} µs/correo")
+
+    print("\nPor correo (µs): anterior / reglas")
+    for sample in CORPUS:
+        times = [
+            min(timeit.repeat(lambda: process(*sample), number=number, repeat=3)) / number * 1e6
+            for process in (legacy_process, rules_process)
+        ]
+        print(f"  {sample[1][:45]:<45} {times[0]:8.2f} / {times[1]:8.2f}")
+
+
+if __name__ == "__main__":
+    main()
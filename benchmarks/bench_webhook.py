@@ -0,0 +1,235 @@
+"""
+Benchmark de punta a punta de POST /webhook contra un IMAP falso.
+
+Levanta en proceso un servidor IMAP con TLS (fake_imap.py), llena INBOX/Junk
+con una mezcla configurable de correos FIFA/RUGBY/ruido (mailgen.py) y sustituye
+la tabla icloud_accounts de Postgres por una SQLite en memoria. Después lanza
+peticiones contra la app (ASGI, sin red) con la concurrencia indicada y reporta
+latencias p50/p95/p99, peticiones por segundo y comandos IMAP por petición.
+
+Uso:
+    python benchmarks/bench_webhook.py --accounts 4 --aliases 25 --concurrency 16
+
+Las variables de entorno de app.py (IMAP_POOL_MAX_PER_ACCOUNT, WEBHOOK_COALESCE_ENABLED,
+IMAP_CURSOR_ENABLED, ...) se respetan, así que sirve para comparar configuraciones.
+"""
+import argparse
+import asyncio
+import logging
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from typing import Dict, List, Optional
+
+os.environ.setdefault("DATABASE_URL", "postgresql://benchmark")
+os.environ.setdefault("ACCOUNTS_LISTEN_ENABLED", "false")
+os.environ.setdefault("IMAP_TLS_VERIFY", "false")
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+os.environ.setdefault("CODE_LOG_ENABLED", "false")  # sin Postgres: la repetición sale de la caché local
+os.environ.setdefault("SEEN_JOURNAL_PATH", os.path.join(tempfile.gettempdir(), "bench_seen_pending.jsonl"))
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, ".."))
+sys.path.insert(0, BENCH_DIR)
+
+import httpx  # noqa: E402
+
+import app  # noqa: E402
+import fake_imap  # noqa: E402
+import mailgen  # noqa: E402
+
+
+# ------- ICLOUD_ACCOUNTS EN SQLITE -------
+
+class SQLiteAccounts:
+    """
+    Sustituto de la tabla icloud_accounts: mismas columnas y mismas consultas
+    que get_account/get_accounts/get_parent_accounts, pero en SQLite en memoria.
+    Respeta account_cache igual que las funciones originales.
+    """
+
+    def __init__(self):
+        self.conn = sqlite3.connect(":memory:", check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.lock = threading.Lock()
+        self.queries = 0
+        self.conn.execute('CREATE TABLE icloud_accounts ("MAIL_MADRE" TEXT, "ALIAS" TEXT, "PASSWORD" TEXT)')
+        self.conn.execute('CREATE INDEX idx_madre ON icloud_accounts ("MAIL_MADRE")')
+        self.conn.execute('CREATE INDEX idx_alias ON icloud_accounts ("ALIAS")')
+
+    def insert(self, mail_madre: str, alias: Optional[str], password: str) -> None:
+        with self.lock:
+            self.conn.execute("INSERT INTO icloud_accounts VALUES (?, ?, ?)", (mail_madre, alias, password))
+
+    def _query(self, sql: str, params=()) -> List[dict]:
+        with self.lock:
+            self.queries += 1
+            return [dict(row) for row in self.conn.execute(sql, params).fetchall()]
+
+    def get_parent_accounts(self) -> List[dict]:
+        return self._query(
+            'SELECT "MAIL_MADRE" AS icloud_user, MIN("PASSWORD") AS icloud_app_password '
+            'FROM icloud_accounts GROUP BY "MAIL_MADRE" ORDER BY "MAIL_MADRE"'
+        )
+
+    def get_account(self, email_in: str) -> Optional[dict]:
+        cached = app.account_cache.get(email_in)
+        if cached is not app.AccountCache._MISSING:
+            return cached
+        rows = self._query(
+            'SELECT "MAIL_MADRE" AS icloud_user, "PASSWORD" AS icloud_app_password '
+            'FROM icloud_accounts WHERE "MAIL_MADRE" = ? OR "ALIAS" = ? LIMIT 1',
+            (email_in, email_in),
+        )
+        row = rows[0] if rows else None
+        app.account_cache.put(email_in, row)
+        return row
+
+    def get_accounts(self, emails: List[str]) -> Dict[str, Optional[dict]]:
+        return {email_in: self.get_account(email_in) for email_in in emails}
+
+    def install(self) -> None:
+        app.get_account = self.get_account
+        app.get_accounts = self.get_accounts
+        app.get_parent_accounts = self.get_parent_accounts
+
+
+# ------- CARGA -------
+
+def percentile(values: List[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100.0 * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+def build_world(args, server: fake_imap.FakeIMAPServer, accounts: SQLiteAccounts) -> Dict[str, tuple]:
+    """
+    Crea las cuentas madre con sus alias y llena los buzones.
+    Devuelve alias -> (tipo, valor esperado).
+    """
+    rng = random.Random(args.seed)
+    mix = mailgen.MailboxMix(
+        fifa_ratio=args.fifa_ratio,
+        noise_per_account=args.noise,
+        junk_ratio=args.junk_ratio,
+        noise_html_size=args.noise_kb * 1024,
+        noise_image_size=args.image_kb * 1024,
+        rugby_html_size=args.rugby_kb * 1024,
+    )
+    expected: Dict[str, tuple] = {}
+    for i in range(args.accounts):
+        user = f"madre{i}@icloud.com"
+        password = f"app-password-{i}"
+        account = server.add_account(user, password)
+        aliases = [f"alias{i}.{j}@icloud.com" for j in range(args.aliases)]
+        for alias in aliases:
+            accounts.insert(user, alias, password)
+        expected.update(mailgen.populate(account, aliases, mix, rng))
+    return expected
+
+
+async def run_load(targets: List[str], concurrency: int, wait_seconds: float) -> tuple:
+    latencies: List[float] = []
+    statuses: Counter = Counter()
+    payloads: Dict[str, dict] = {}
+    queue: asyncio.Queue = asyncio.Queue()
+    for target in targets:
+        queue.put_nowait(target)
+
+    transport = httpx.ASGITransport(app=app.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=300) as client:
+        async def worker():
+            while True:
+                try:
+                    target = queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    return
+                body = {"email": target}
+                if wait_seconds:
+                    body["wait_seconds"] = wait_seconds
+                started = time.perf_counter()
+                response = await client.post("/webhook", json=body)
+                latencies.append(time.perf_counter() - started)
+                statuses[response.status_code] += 1
+                if response.status_code == 200:
+                    data = response.json()
+                    # Con --requests los alias se repiten: no pisar la respuesta que trajo el código
+                    if data.get("messages") or target not in payloads:
+                        payloads[target] = data
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - started
+    return latencies, statuses, payloads, elapsed
+
+
+def count_found(expected: Dict[str, tuple], payloads: Dict[str, dict]) -> int:
+    found = 0
+    for target, (_, value) in expected.items():
+        messages = (payloads.get(target) or {}).get("messages") or []
+        if any(value in (m.get("otp_code") or "") or value in (m.get("activation_url") or "") for m in messages):
+            found += 1
+    return found
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--accounts", type=int, default=4, help="cuentas madre (MAIL_MADRE)")
+    parser.add_argument("--aliases", type=int, default=25, help="alias por cuenta (uno con código cada uno)")
+    parser.add_argument("--noise", type=int, default=40, help="correos de ruido por cuenta")
+    parser.add_argument("--fifa-ratio", type=float, default=0.5, help="fracción FIFA (el resto RUGBY)")
+    parser.add_argument("--junk-ratio", type=float, default=0.2, help="fracción de correos que van a Junk")
+    parser.add_argument("--noise-kb", type=int, default=40, help="tamaño HTML del ruido (KB)")
+    parser.add_argument("--image-kb", type=int, default=20, help="adjunto imagen del ruido (KB, 0 = sin)")
+    parser.add_argument("--rugby-kb", type=int, default=60, help="tamaño HTML de los correos RUGBY (KB)")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--requests", type=int, default=0, help="total de peticiones (0 = una por alias)")
+    parser.add_argument("--wait-seconds", type=float, default=0, help="wait_seconds de cada petición")
+    parser.add_argument("--imap-latency-ms", type=float, default=0, help="latencia simulada por comando IMAP")
+    parser.add_argument("--seed", type=int, default=2027)
+    args = parser.parse_args()
+
+    logging.disable(logging.WARNING)
+
+    server = fake_imap.FakeIMAPServer(ssl_context=fake_imap.self_signed_context(), latency=args.imap_latency_ms / 1000.0).start()
+    accounts = SQLiteAccounts()
+    accounts.install()
+    app.IMAP_HOST = "127.0.0.1"
+    app.IMAP_PORT = server.port
+
+    expected = build_world(args, server, accounts)
+    targets = list(expected)
+    random.Random(args.seed).shuffle(targets)
+    if args.requests:
+        targets = [targets[i % len(targets)] for i in range(args.requests)]
+
+    server.commands.clear()
+    latencies, statuses, payloads, elapsed = asyncio.run(run_load(targets, args.concurrency, args.wait_seconds))
+    asyncio.run(app.close_connections())
+    server.stop()
+
+    total = len(latencies)
+    imap_total = sum(server.commands.values())
+    print(f"peticiones       {total}  (concurrencia {args.concurrency}, {elapsed:.2f}s)")
+    print(f"rps              {total / elapsed:.1f}")
+    print(
+        f"latencia ms      p50={percentile(latencies, 50) * 1000:.1f}  "
+        f"p95={percentile(latencies, 95) * 1000:.1f}  p99={percentile(latencies, 99) * 1000:.1f}  "
+        f"max={max(latencies) * 1000:.1f}"
+    )
+    print(f"status           {dict(statuses)}")
+    print(f"códigos hallados {count_found(expected, payloads)}/{len(expected)}")
+    print(f"consultas cuenta {accounts.queries}")
+    print(f"comandos IMAP    {imap_total}  ({imap_total / max(total, 1):.2f} por petición)")
+    for name, count in server.commands.most_common():
+        print(f"  {name:<14} {count:>7}  ({count / max(total, 1):.2f}/pet)")
+
+
+if __name__ == "__main__":
+    main()
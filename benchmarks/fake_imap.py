@@ -0,0 +1,617 @@
+"""
+Servidor IMAP4rev1 en proceso (con TLS) que imita lo que usa app.py de iCloud:
+LOGIN, SELECT/EXAMINE, STATUS, (UID) SEARCH/FETCH/STORE, EXPUNGE, IDLE, ENABLE.
+Pensado solo para benchmarks: nada de persistencia ni de seguridad.
+"""
+import email as email_lib
+import email.utils
+import re
+import socketserver
+import ssl
+import subprocess
+import tempfile
+import threading
+import time
+import os
+from collections import Counter
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Tuple
+
+
+class FakeMessage:
+    def __init__(self, uid: int, raw: bytes, flags=None, internaldate: Optional[datetime] = None):
+        self.uid = uid
+        self.raw = raw
+        self.flags = set(flags or ())
+        self.modseq = 1
+        self.internaldate = internaldate or datetime.now(timezone.utc)
+        self._parsed = None
+
+    @property
+    def parsed(self):
+        if self._parsed is None:
+            self._parsed = email_lib.message_from_bytes(self.raw)
+        return self._parsed
+
+    @property
+    def header_bytes(self) -> bytes:
+        end = self.raw.find(b"\r\n\r\n")
+        sep = 4
+        if end < 0:
+            end = self.raw.find(b"\n\n")
+            sep = 2
+        if end < 0:
+            return self.raw
+        return self.raw[:end + sep]
+
+
+class FakeMailbox:
+    def __init__(self, name: str, uidvalidity: int = 1):
+        self.name = name
+        self.uidvalidity = uidvalidity
+        self.uidnext = 1
+        self.highestmodseq = 1
+        self.messages: List[FakeMessage] = []
+
+    def append(self, raw: bytes, flags=None, internaldate=None) -> FakeMessage:
+        msg = FakeMessage(self.uidnext, raw, flags, internaldate)
+        self.uidnext += 1
+        self.highestmodseq += 1
+        msg.modseq = self.highestmodseq
+        self.messages.append(msg)
+        return msg
+
+
+class FakeAccount:
+    def __init__(self, user: str, password: str, folders=("INBOX", "Junk")):
+        self.user = user
+        self.password = password
+        self.mailboxes: Dict[str, FakeMailbox] = {name: FakeMailbox(name) for name in folders}
+        self.lock = threading.RLock()
+        self.idlers: List["FakeIMAPHandler"] = []
+
+    def deliver(self, folder: str, raw: bytes, flags=None, internaldate=None) -> FakeMessage:
+        with self.lock:
+            box = self.mailboxes[folder]
+            msg = box.append(raw, flags, internaldate)
+            count = len(box.messages)
+            idlers = [h for h in self.idlers if h.selected is box]
+        for handler in idlers:
+            handler.push(f"* {count} EXISTS\r\n".encode())
+        return msg
+
+
+# ------- PARSER DE COMANDOS -------
+
+_TOKEN_RE = re.compile(rb'\(|\)|"(?:[^"\\]|\\.)*"|\[[^\]]*\]|[^\s()"\[]+(?:\[[^\]]*\](?:<[\d.]+>)?)?')
+
+
+def tokenize(data: bytes) -> list:
+    """
+    Convierte 'A (B "c d") E' en ['A', ['B', 'c d'], 'E'].
+    """
+    stack: list = [[]]
+    for match in _TOKEN_RE.finditer(data):
+        tok = match.group(0)
+        if tok == b"(":
+            stack.append([])
+        elif tok == b")":
+            inner = stack.pop()
+            stack[-1].append(inner)
+        elif tok.startswith(b'"'):
+            stack[-1].append(re.sub(rb'\\(.)', rb'\1', tok[1:-1]).decode("utf-8", "replace"))
+        else:
+            stack[-1].append(tok.decode("utf-8", "replace"))
+    while len(stack) > 1:
+        inner = stack.pop()
+        stack[-1].append(inner)
+    return stack[0]
+
+
+def parse_set(spec: str, max_value: int) -> set:
+    result = set()
+    for piece in spec.split(","):
+        if ":" in piece:
+            a, b = piece.split(":", 1)
+            a = max_value if a == "*" else int(a)
+            b = max_value if b == "*" else int(b)
+            lo, hi = min(a, b), max(a, b)
+            result.update(range(lo, hi + 1))
+        else:
+            result.add(max_value if piece == "*" else int(piece))
+    return result
+
+
+def header_values(msg: FakeMessage, name: str) -> List[str]:
+    return [str(v) for v in (msg.parsed.get_all(name) or [])]
+
+
+def header_fields(msg: FakeMessage, names: List[str]) -> bytes:
+    wanted = {n.lower() for n in names}
+    out = []
+    keep = False
+    for line in msg.header_bytes.splitlines(keepends=True):
+        if line in (b"\r\n", b"\n"):
+            break
+        if line[:1] in (b" ", b"\t"):
+            if keep:
+                out.append(line)
+            continue
+        name = line.split(b":", 1)[0].strip().decode("ascii", "replace").lower()
+        keep = name in wanted
+        if keep:
+            out.append(line)
+    out.append(b"\r\n")
+    return b"".join(out)
+
+
+def _imap_date(value: str) -> datetime:
+    return datetime.strptime(value, "%d-%b-%Y").replace(tzinfo=timezone.utc)
+
+
+def _nstring(value: Optional[str]) -> str:
+    if value is None:
+        return "NIL"
+    return '"' + value.replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+
+def bodystructure(part) -> str:
+    if part.is_multipart():
+        subs = "".join(bodystructure(p) for p in part.get_payload())
+        return f'({subs} "{part.get_content_subtype().upper()}")'
+    maintype = part.get_content_maintype().upper()
+    subtype = part.get_content_subtype().upper()
+    params = []
+    charset = part.get_param("charset")
+    if charset:
+        params.append(f'"CHARSET" {_nstring(str(charset))}')
+    name = part.get_param("name")
+    if name:
+        params.append(f'"NAME" {_nstring(str(name))}')
+    params_s = f'({" ".join(params)})' if params else "NIL"
+    encoding = (part.get("Content-Transfer-Encoding") or "7BIT").upper()
+    body = _part_body(part)
+    size = len(body)
+    base = f'("{maintype}" "{subtype}" {params_s} NIL NIL "{encoding}" {size}'
+    if maintype == "TEXT":
+        base += " %d" % body.count(b"\n")
+    disposition = part.get("Content-Disposition")
+    if disposition:
+        base += f' NIL ("{disposition.split(";")[0].strip().upper()}" NIL)'
+    return base + ")"
+
+
+def _part_body(part) -> bytes:
+    payload = part.get_payload(decode=False)
+    if isinstance(payload, str):
+        return payload.encode("ascii", "surrogateescape")
+    return b""
+
+
+def find_section(msg: FakeMessage, section: str):
+    part = msg.parsed
+    for index in section.split("."):
+        i = int(index)
+        if part.is_multipart():
+            part = part.get_payload()[i - 1]
+        elif i != 1:
+            return None
+    return part
+
+
+# ------- HANDLER -------
+
+class FakeIMAPHandler(socketserver.StreamRequestHandler):
+    server: "FakeIMAPServer"
+
+    def setup(self):
+        super().setup()
+        self.account: Optional[FakeAccount] = None
+        self.selected: Optional[FakeMailbox] = None
+        self.readonly = False
+        self._write_lock = threading.Lock()
+        self.condstore = False
+
+    def push(self, data: bytes) -> None:
+        with self._write_lock:
+            try:
+                self.wfile.write(data)
+                self.wfile.flush()
+            except OSError:
+                pass
+
+    def handle(self):
+        self.push(b"* OK [CAPABILITY IMAP4rev1 IDLE CONDSTORE ENABLE UIDPLUS] Fake IMAP listo\r\n")
+        while True:
+            try:
+                line = self._read_command()
+            except (OSError, ValueError):
+                return
+            if line is None:
+                return
+            parts = line.split(b" ", 2)
+            if len(parts) < 2:
+                self.push(b"* BAD comando vacio\r\n")
+                continue
+            tag = parts[0].decode()
+            command = parts[1].decode().upper()
+            rest = parts[2] if len(parts) > 2 else b""
+            self.server.count_command(command if command != "UID" else "UID " + rest.split(b" ", 1)[0].decode().upper())
+            try:
+                done = self.dispatch(tag, command, rest)
+            except Exception as e:  # pragma: no cover - errores del fake
+                self.push(f"{tag} BAD {type(e).__name__}: {e}\r\n".encode())
+                continue
+            if done:
+                return
+
+    def _read_command(self) -> Optional[bytes]:
+        """
+        Lee una línea de comando completa, incluyendo literales {n}.
+        """
+        chunks = []
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return None
+            line = line.rstrip(b"\r\n")
+            literal = re.search(rb"\{(\d+)\+?\}$", line)
+            if not literal:
+                chunks.append(line)
+                return b"".join(chunks)
+            if not line.endswith(b"+}"):
+                self.push(b"+ OK\r\n")
+            size = int(literal.group(1))
+            data = self.rfile.read(size)
+            chunks.append(line[:literal.start()] + b'"' + data.replace(b'"', b'\\"') + b'"')
+
+    # --- comandos ---
+
+    def dispatch(self, tag: str, command: str, rest: bytes) -> bool:
+        if command == "LOGOUT":
+            self.push(b"* BYE adios\r\n")
+            self.push(f"{tag} OK LOGOUT completado\r\n".encode())
+            return True
+        if command == "CAPABILITY":
+            self.push(b"* CAPABILITY IMAP4rev1 IDLE CONDSTORE ENABLE UIDPLUS\r\n")
+        elif command == "NOOP":
+            pass
+        elif command == "LOGIN":
+            user, password = tokenize(rest)[:2]
+            account = self.server.accounts.get(user.lower())
+            if not account or account.password != password:
+                self.server.count_command("LOGIN_FAILED")
+                self.push(f"{tag} NO [AUTHENTICATIONFAILED] credenciales invalidas\r\n".encode())
+                return False
+            self.account = account
+        elif command == "ENABLE":
+            if "CONDSTORE" in rest.decode().upper():
+                self.condstore = True
+                self.push(b"* ENABLED CONDSTORE\r\n")
+            else:
+                self.push(b"* ENABLED\r\n")
+        elif self.account is None:
+            self.push(f"{tag} NO no autenticado\r\n".encode())
+            return False
+        elif command in ("SELECT", "EXAMINE"):
+            name = tokenize(rest)[0]
+            box = self.account.mailboxes.get(name)
+            if box is None:
+                self.push(f"{tag} NO no existe la carpeta\r\n".encode())
+                return False
+            self.selected = box
+            self.readonly = command == "EXAMINE"
+            with self.account.lock:
+                unseen = sum(1 for m in box.messages if "\\Seen" not in m.flags)
+                self.push(
+                    f"* {len(box.messages)} EXISTS\r\n* 0 RECENT\r\n"
+                    f"* OK [UNSEEN {unseen}] mensajes sin leer\r\n"
+                    f"* OK [UIDVALIDITY {box.uidvalidity}] UIDs validos\r\n"
+                    f"* OK [UIDNEXT {box.uidnext}] siguiente UID\r\n"
+                    f"* OK [HIGHESTMODSEQ {box.highestmodseq}] modseq\r\n"
+                    "* FLAGS (\\Seen \\Deleted \\Flagged)\r\n".encode()
+                )
+            mode = "READ-ONLY" if self.readonly else "READ-WRITE"
+            self.push(f"{tag} OK [{mode}] {command} completado\r\n".encode())
+            return False
+        elif command == "STATUS":
+            tokens = tokenize(rest)
+            box = self.account.mailboxes.get(tokens[0])
+            if box is None:
+                self.push(f"{tag} NO no existe la carpeta\r\n".encode())
+                return False
+            items = []
+            with self.account.lock:
+                for item in tokens[1]:
+                    item = item.upper()
+                    if item == "MESSAGES":
+                        items.append(f"MESSAGES {len(box.messages)}")
+                    elif item == "UNSEEN":
+                        items.append(f"UNSEEN {sum(1 for m in box.messages if chr(92) + 'Seen' not in m.flags)}")
+                    elif item == "UIDNEXT":
+                        items.append(f"UIDNEXT {box.uidnext}")
+                    elif item == "UIDVALIDITY":
+                        items.append(f"UIDVALIDITY {box.uidvalidity}")
+                    elif item == "HIGHESTMODSEQ":
+                        items.append(f"HIGHESTMODSEQ {box.highestmodseq}")
+            self.push(f'* STATUS "{box.name}" ({" ".join(items)})\r\n'.encode())
+        elif command == "IDLE":
+            return self._idle(tag)
+        elif self.selected is None:
+            self.push(f"{tag} NO ninguna carpeta seleccionada\r\n".encode())
+            return False
+        elif command == "CLOSE":
+            self._expunge(silent=True)
+            self.selected = None
+        elif command == "EXPUNGE":
+            self._expunge(silent=False)
+        elif command == "SEARCH":
+            self._search(tokenize(rest), use_uid=False)
+        elif command == "FETCH":
+            self._fetch(rest, use_uid=False)
+        elif command == "STORE":
+            self._store(rest, use_uid=False)
+        elif command == "UID":
+            sub, _, args = rest.partition(b" ")
+            sub = sub.decode().upper()
+            if sub == "SEARCH":
+                self._search(tokenize(args), use_uid=True)
+            elif sub == "FETCH":
+                self._fetch(args, use_uid=True)
+            elif sub == "STORE":
+                self._store(args, use_uid=True)
+            else:
+                self.push(f"{tag} BAD UID {sub} no soportado\r\n".encode())
+                return False
+        else:
+            self.push(f"{tag} BAD comando {command} no soportado\r\n".encode())
+            return False
+        self.push(f"{tag} OK {command} completado\r\n".encode())
+        return False
+
+    def _idle(self, tag: str) -> bool:
+        with self.account.lock:
+            self.account.idlers.append(self)
+        self.push(b"+ idling\r\n")
+        try:
+            line = self.rfile.readline()
+        finally:
+            with self.account.lock:
+                if self in self.account.idlers:
+                    self.account.idlers.remove(self)
+        if not line:
+            return True
+        self.push(f"{tag} OK IDLE terminado\r\n".encode())
+        return False
+
+    def _expunge(self, silent: bool) -> None:
+        box = self.selected
+        with self.account.lock:
+            seq = 1
+            remaining = []
+            for msg in box.messages:
+                if "\\Deleted" in msg.flags:
+                    if not silent:
+                        self.push(f"* {seq} EXPUNGE\r\n".encode())
+                    continue
+                remaining.append(msg)
+                seq += 1
+            box.messages = remaining
+
+    def _targets(self, spec: str, use_uid: bool) -> List[Tuple[int, FakeMessage]]:
+        box = self.selected
+        msgs = list(enumerate(box.messages, start=1))
+        if not msgs:
+            return []
+        if use_uid:
+            wanted = parse_set(spec, msgs[-1][1].uid)
+            return [(seq, m) for seq, m in msgs if m.uid in wanted]
+        wanted = parse_set(spec, len(msgs))
+        return [(seq, m) for seq, m in msgs if seq in wanted]
+
+    # SEARCH
+    def _search(self, tokens: list, use_uid: bool) -> None:
+        with self.account.lock:
+            msgs = list(enumerate(self.selected.messages, start=1))
+            result = []
+            for seq, msg in msgs:
+                it = iter(tokens)
+                if all(self._match(key, it, seq, msg, msgs) for key in it):
+                    result.append(str(msg.uid if use_uid else seq))
+        self.push(("* SEARCH " + " ".join(result)).rstrip().encode() + b"\r\n")
+
+    def _match(self, key, it, seq, msg, msgs) -> bool:
+        if isinstance(key, list):
+            sub = iter(key)
+            return all(self._match(k, sub, seq, msg, msgs) for k in sub)
+        k = key.upper()
+        if k == "ALL":
+            return True
+        if k == "UNSEEN":
+            return "\\Seen" not in msg.flags
+        if k == "SEEN":
+            return "\\Seen" in msg.flags
+        if k == "NOT":
+            return not self._match(next(it), it, seq, msg, msgs)
+        if k == "OR":
+            a = self._match(next(it), it, seq, msg, msgs)
+            b = self._match(next(it), it, seq, msg, msgs)
+            return a or b
+        if k == "SINCE":
+            return msg.internaldate.date() >= _imap_date(next(it)).date()
+        if k == "FROM":
+            needle = next(it).lower()
+            return any(needle in v.lower() for v in header_values(msg, "From"))
+        if k == "TO":
+            needle = next(it).lower()
+            return any(needle in v.lower() for v in header_values(msg, "To"))
+        if k == "SUBJECT":
+            needle = next(it).lower()
+            subject = str(email_lib.header.make_header(email_lib.header.decode_header(msg.parsed.get("Subject", ""))))
+            return needle in subject.lower()
+        if k == "HEADER":
+            name = next(it)
+            needle = next(it).lower()
+            return any(needle in v.lower() for v in header_values(msg, name))
+        if k == "UID":
+            return msg.uid in parse_set(next(it), msgs[-1][1].uid if msgs else 0)
+        if k == "MODSEQ":
+            return msg.modseq > int(next(it))
+        if re.fullmatch(r"[\d:*,]+", k):
+            return seq in parse_set(k, len(msgs))
+        raise ValueError(f"criterio SEARCH no soportado: {key}")
+
+    # FETCH
+    def _fetch(self, args: bytes, use_uid: bool) -> None:
+        spec, _, items_raw = args.partition(b" ")
+        tokens = tokenize(items_raw)
+        changedsince = None
+        items = tokens[0] if tokens and isinstance(tokens[0], list) else tokens[:1]
+        for extra in tokens[1:]:
+            if isinstance(extra, list) and extra and str(extra[0]).upper() == "CHANGEDSINCE":
+                changedsince = int(extra[1])
+        if use_uid and "UID" not in [str(i).upper() for i in items]:
+            items.insert(0, "UID")
+        with self.account.lock:
+            for seq, msg in self._targets(spec.decode(), use_uid):
+                if changedsince is not None and msg.modseq <= changedsince:
+                    continue
+                out = [f"* {seq} FETCH (".encode()]
+                first = True
+                for item in items:
+                    chunk = self._fetch_item(item, msg)
+                    if chunk is None:
+                        continue
+                    if not first:
+                        out.append(b" ")
+                    out.append(chunk)
+                    first = False
+                out.append(b")\r\n")
+                self.push(b"".join(out))
+
+    def _fetch_item(self, item, msg: FakeMessage) -> Optional[bytes]:
+        name = str(item).upper()
+        fields = re.fullmatch(r"BODY(?:\.PEEK)?\[HEADER\.FIELDS \(([^)]*)\)\]", name)
+        if fields:
+            data = header_fields(msg, fields.group(1).split())
+            return f"BODY[HEADER.FIELDS ({fields.group(1)})] {{{len(data)}}}\r\n".encode() + data
+        if name == "UID":
+            return f"UID {msg.uid}".encode()
+        if name == "FLAGS":
+            return f"FLAGS ({' '.join(sorted(msg.flags))})".encode()
+        if name == "MODSEQ":
+            return f"MODSEQ ({msg.modseq})".encode()
+        if name == "RFC822.SIZE":
+            return f"RFC822.SIZE {len(msg.raw)}".encode()
+        if name == "INTERNALDATE":
+            return f'INTERNALDATE "{msg.internaldate.strftime("%d-%b-%Y %H:%M:%S +0000")}"'.encode()
+        if name == "BODYSTRUCTURE":
+            return b"BODYSTRUCTURE " + bodystructure(msg.parsed).encode()
+        m = re.fullmatch(r"(BODY(?:\.PEEK)?|RFC822)(?:\[([^\]]*)\])?(?:<(\d+)\.(\d+)>)?", name)
+        if not m:
+            return None
+        kind, section, start, length = m.groups()
+        section = section or ""
+        if kind == "RFC822" or section == "":
+            data = msg.raw
+        elif section == "HEADER":
+            data = msg.header_bytes
+        elif section == "TEXT":
+            data = msg.raw[len(msg.header_bytes):]
+        else:
+            part = find_section(msg, section)
+            data = _part_body(part) if part is not None else b""
+        origin = ""
+        if start is not None:
+            data = data[int(start):int(start) + int(length)]
+            origin = f"<{start}>"
+        if kind == "BODY" and not self.readonly and "\\Seen" not in msg.flags:
+            msg.flags.add("\\Seen")
+            self._bump(msg)
+        label = f"BODY[{section}]{origin}" if kind != "RFC822" else "RFC822"
+        return label.encode() + f" {{{len(data)}}}\r\n".encode() + data
+
+    def _bump(self, msg: FakeMessage) -> None:
+        self.selected.highestmodseq += 1
+        msg.modseq = self.selected.highestmodseq
+
+    # STORE
+    def _store(self, args: bytes, use_uid: bool) -> None:
+        tokens = tokenize(args)
+        spec, action = tokens[0], tokens[1].upper()
+        flags = tokens[2] if isinstance(tokens[2], list) else tokens[2:]
+        silent = action.endswith(".SILENT")
+        with self.account.lock:
+            for seq, msg in self._targets(spec, use_uid):
+                if action.startswith("+"):
+                    msg.flags.update(flags)
+                elif action.startswith("-"):
+                    msg.flags.difference_update(flags)
+                else:
+                    msg.flags = set(flags)
+                self._bump(msg)
+                if not silent:
+                    uid_part = f"UID {msg.uid} " if use_uid else ""
+                    self.push(f"* {seq} FETCH ({uid_part}FLAGS ({' '.join(sorted(msg.flags))}))\r\n".encode())
+
+
+class FakeIMAPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, ssl_context: Optional[ssl.SSLContext] = None, latency: float = 0.0):
+        super().__init__((host, port), FakeIMAPHandler)
+        self.accounts: Dict[str, FakeAccount] = {}
+        self.ssl_context = ssl_context
+        self.latency = latency  # segundos por comando, para simular la ida y vuelta a iCloud
+        self.commands: Counter = Counter()
+        self._counter_lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+
+    def get_request(self):
+        sock, addr = super().get_request()
+        if self.ssl_context is not None:
+            sock = self.ssl_context.wrap_socket(sock, server_side=True)
+        return sock, addr
+
+    def count_command(self, name: str) -> None:
+        with self._counter_lock:
+            self.commands[name] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def add_account(self, user: str, password: str, folders=("INBOX", "Junk")) -> FakeAccount:
+        account = FakeAccount(user, password, folders)
+        self.accounts[user.lower()] = account
+        return account
+
+    @property
+    def port(self) -> int:
+        return self.server_address[1]
+
+    def start(self) -> "FakeIMAPServer":
+        self._thread = threading.Thread(target=self.serve_forever, name="fake-imap", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.shutdown()
+        self.server_close()
+
+
+def self_signed_context() -> ssl.SSLContext:
+    """
+    Genera un certificado autofirmado con openssl para el TLS del servidor.
+    """
+    workdir = tempfile.mkdtemp(prefix="fake-imap-")
+    cert = os.path.join(workdir, "cert.pem")
+    key = os.path.join(workdir, "key.pem")
+    subprocess.run(
+        ["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1",
+         "-subj", "/CN=localhost", "-keyout", key, "-out", cert],
+        check=True,
+        capture_output=True,
+    )
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(cert, key)
+    return context
@@ -0,0 +1,139 @@
+"""
+Generador de buzones sintéticos para los benchmarks: correos FIFA, RUGBY y
+ruido (newsletters, notificaciones) con tamaños parecidos a los reales.
+"""
+import email.utils
+import random
+from datetime import datetime, timedelta, timezone
+from email.mime.image import MIMEImage
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from typing import Dict, List, Optional, Tuple
+
+FILLER = (
+    "Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do eiusmod tempor "
+    "incididunt ut labore et dolore magna aliqua. Ut enim ad minim veniam, quis nostrud "
+)
+
+
+def _date(age_minutes: float = 0) -> str:
+    return email.utils.format_datetime(datetime.now(timezone.utc) - timedelta(minutes=age_minutes))
+
+
+def _html_padding(size: int) -> str:
+    chunks = []
+    total = 0
+    while total < size:
+        chunk = f"<tr><td style=\"padding:8px;font-family:Arial\">{FILLER}</td></tr>\n"
+        chunks.append(chunk)
+        total += len(chunk)
+    return "<table>" + "".join(chunks) + "</table>"
+
+
+def _image(size: int, rng: random.Random) -> MIMEImage:
+    image = MIMEImage(rng.randbytes(size), "png")
+    image.add_header("Content-Disposition", "inline", filename="banner.png")
+    return image
+
+
+def fifa_email(to: str, code: str, age_minutes: float = 0, html_size: int = 15000) -> bytes:
+    msg = MIMEMultipart("alternative")
+    msg["Subject"] = "Your FIFA ID verification code"
+    msg["From"] = "FIFA <noreply@fifa.com>"
+    msg["To"] = to
+    msg["Date"] = _date(age_minutes)
+    msg["Message-ID"] = email.utils.make_msgid(domain="fifa.com")
+    msg.attach(MIMEText(f"Hola,\n\nTu código de verificación: {code}\n\n{FILLER * 4}", "plain", "utf-8"))
+    msg.attach(MIMEText(
+        f"<html><body><h1>FIFA ID</h1><p>Tu c&oacute;digo: <b>{code}</b></p>{_html_padding(html_size)}</body></html>",
+        "html",
+        "utf-8",
+    ))
+    return msg.as_bytes()
+
+
+def rugby_email(to: str, token: str, age_minutes: float = 0, html_size: int = 60000, image_size: int = 0, rng: Optional[random.Random] = None) -> bytes:
+    msg = MIMEMultipart("related" if image_size else "alternative")
+    msg["Subject"] = "Activate your Rugby World Cup 2027 ticketing account"
+    msg["From"] = "Rugby World Cup 2027 <noreplyrwc2027@rugbyworldcup.com>"
+    msg["To"] = to
+    msg["Date"] = _date(age_minutes)
+    msg["Message-ID"] = email.utils.make_msgid(domain="rugbyworldcup.com")
+    url = f"https://rwc2027.tmtickets.co.uk/Authentication/ActivateAccount/{token}?lang=en&amp;src=email"
+    html = (
+        '<html><body><a href="https://rwc2027.rugbyworldcup.com/en/home">Rugby World Cup 2027</a>'
+        f'{_html_padding(html_size // 2)}<p><a href="{url}">Activate your account</a></p>'
+        f'{_html_padding(html_size // 2)}</body></html>'
+    )
+    msg.attach(MIMEText(html, "html", "utf-8"))
+    if image_size:
+        msg.attach(_image(image_size, rng or random.Random()))
+    return msg.as_bytes()
+
+
+def noise_email(to: str, rng: random.Random, age_minutes: float = 0, html_size: int = 40000, image_size: int = 0) -> bytes:
+    sender, subject = rng.choice([
+        ("Newsletter <news@example.com>", "Your weekly digest"),
+        ("Shop <offers@shop.example>", "Ofertas de la semana 123456"),
+        ("Rugby World Cup 2027 <noreplyrwc2027@rugbyworldcup.com>", "Match schedule update"),
+        ("Bank <alerts@bank.example>", "Security notification"),
+    ])
+    msg = MIMEMultipart("mixed")
+    msg["Subject"] = subject
+    msg["From"] = sender
+    msg["To"] = to
+    msg["Date"] = _date(age_minutes)
+    msg["Message-ID"] = email.utils.make_msgid(domain="example.com")
+    msg.attach(MIMEText(f"<html><body>{_html_padding(html_size)}</body></html>", "html", "utf-8"))
+    if image_size:
+        msg.attach(_image(image_size, rng))
+    return msg.as_bytes()
+
+
+class MailboxMix:
+    """
+    Reparto de correos por cuenta madre: cuántos FIFA/RUGBY (uno por alias
+    objetivo), cuánto ruido, qué fracción va a Junk y tamaños.
+    """
+
+    def __init__(self, fifa_ratio: float = 0.5, noise_per_account: int = 30, junk_ratio: float = 0.2,
+                 noise_html_size: int = 40000, noise_image_size: int = 20000, rugby_html_size: int = 60000,
+                 rugby_image_size: int = 0, max_age_minutes: float = 8):
+        self.fifa_ratio = fifa_ratio
+        self.noise_per_account = noise_per_account
+        self.junk_ratio = junk_ratio
+        self.noise_html_size = noise_html_size
+        self.noise_image_size = noise_image_size
+        self.rugby_html_size = rugby_html_size
+        self.rugby_image_size = rugby_image_size
+        self.max_age_minutes = max_age_minutes
+
+
+def populate(account, aliases: List[str], mix: MailboxMix, rng: random.Random) -> Dict[str, Tuple[str, str]]:
+    """
+    Llena INBOX/Junk de una cuenta del servidor fake: un FIFA o RUGBY por
+    alias, mezclado con ruido. Devuelve alias -> (tipo, código/token esperado).
+    """
+    items = []
+    expected: Dict[str, Tuple[str, str]] = {}
+    for alias in aliases:
+        age = rng.uniform(0, mix.max_age_minutes)
+        if rng.random() < mix.fifa_ratio:
+            code = "%06d" % rng.randrange(10 ** 6)
+            expected[alias] = ("FIFA", code)
+            items.append((age, fifa_email(alias, code, age)))
+        else:
+            token = "%016x" % rng.getrandbits(64)
+            expected[alias] = ("RUGBY", token)
+            items.append((age, rugby_email(alias, token, age, mix.rugby_html_size, mix.rugby_image_size, rng)))
+    for _ in range(mix.noise_per_account):
+        age = rng.uniform(0, mix.max_age_minutes * 2)
+        to = rng.choice(aliases) if aliases else account.user
+        items.append((age, noise_email(to, rng, age, mix.noise_html_size, mix.noise_image_size)))
+
+    # Los más viejos primero, como llegarían al buzón
+    items.sort(key=lambda item: -item[0])
+    for _, raw in items:
+        folder = "Junk" if rng.random() < mix.junk_ratio else "INBOX"
+        account.deliver(folder, raw)
+    return expected
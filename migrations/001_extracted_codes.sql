@@ -0,0 +1,20 @@
+-- Códigos entregados por alias (DeliveredCodeLog, CODE_LOG_ENABLED).
+-- La app solo comprueba al arrancar que la tabla existe; se aplica a mano:
+--   psql "$DATABASE_URL" -f migrations/001_extracted_codes.sql
+CREATE TABLE IF NOT EXISTS "extracted_codes" (
+    id             BIGSERIAL PRIMARY KEY,
+    alias          TEXT NOT NULL,
+    icloud_user    TEXT NOT NULL,
+    email_type     TEXT NOT NULL,
+    otp_code       TEXT,
+    activation_url TEXT,
+    from_header    TEXT,
+    subject        TEXT,
+    date_header    TEXT,
+    to_header      TEXT,
+    folder         TEXT NOT NULL,
+    uid            TEXT NOT NULL,
+    extracted_at   TIMESTAMPTZ NOT NULL DEFAULT now(),
+    UNIQUE (icloud_user, folder, uid)
+);
+CREATE INDEX IF NOT EXISTS extracted_codes_alias_idx ON "extracted_codes" (alias, extracted_at DESC);
@@ -0,0 +1,82 @@
+import os
+import sys
+import tempfile
+
+os.environ.setdefault("DATABASE_URL", "postgresql://tests")
+# Journal de \Seen propio de cada ejecución (el de disco haría que unos tests dependan de otros)
+os.environ.setdefault("SEEN_JOURNAL_PATH", os.path.join(tempfile.mkdtemp(prefix="tests-"), "seen_pending.jsonl"))
+os.environ.setdefault("ACCOUNTS_LISTEN_ENABLED", "false")
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "benchmarks"))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import threading  # noqa: E402
+
+import pytest  # noqa: E402
+
+
+class CountingIMAPServer:
+    """
+    FakeIMAPServer que además cuenta las sesiones con LOGIN hechas a la vez por
+    cuenta (max_logged_in), para comprobar los topes de conexiones.
+    """
+
+    def __init__(self):
+        import fake_imap
+
+        self.lock = threading.Lock()
+        self.logged_in = {}
+        self.max_logged_in = {}
+        counter = self
+
+        class Handler(fake_imap.FakeIMAPHandler):
+            def dispatch(self, tag, command, rest):
+                if command == "LOGOUT" and getattr(self, "counted", False):
+                    # Antes de contestar: el cliente solo libera su hueco tras la respuesta
+                    self.counted = False
+                    counter._change(self.account.user, -1)
+                done = super().dispatch(tag, command, rest)
+                if command == "LOGIN" and self.account is not None and not getattr(self, "counted", False):
+                    self.counted = True
+                    counter._change(self.account.user, 1)
+                return done
+
+            def finish(self):
+                if getattr(self, "counted", False):
+                    counter._change(self.account.user, -1)
+                super().finish()
+
+        self.server = fake_imap.FakeIMAPServer(ssl_context=fake_imap.self_signed_context())
+        self.server.RequestHandlerClass = Handler
+        self.server.start()
+
+    def _change(self, user, delta):
+        with self.lock:
+            self.logged_in[user] = self.logged_in.get(user, 0) + delta
+            self.max_logged_in[user] = max(self.max_logged_in.get(user, 0), self.logged_in[user])
+
+
+@pytest.fixture(scope="session")
+def imap_server():
+    server = CountingIMAPServer()
+    yield server
+    server.server.stop()
+
+
+@pytest.fixture
+def fake_imap(imap_server, monkeypatch):
+    """
+    Apunta app a imap_server (TLS sin verificar) y deja el login breaker y los contadores limpios.
+    """
+    import app
+
+    monkeypatch.setattr(app, "IMAP_HOST", "127.0.0.1")
+    monkeypatch.setattr(app, "IMAP_PORT", imap_server.server.port)
+    monkeypatch.setattr(app, "IMAP_TLS_VERIFY", False)
+    app.login_breaker.reset(set())
+    with imap_server.lock:
+        imap_server.max_logged_in.clear()
+    return imap_server
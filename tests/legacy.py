@@ -0,0 +1,51 @@
+"""
+Copia de extract_otp_code y extract_activation_url tal como estaban antes del
+registro de reglas (sin los logs). Los tests comparan contra estas salidas.
+"""
+import re
+
+
+def extract_otp_code(text):
+    if not text:
+        return None
+    patterns = [
+        r'código[:\s]+(\d{6})',
+        r'code[:\s]+(\d{6})',
+        r'verification[:\s]+(\d{6})',
+        r'\b(\d{6})\b',
+    ]
+    for pattern in patterns:
+        match = re.search(pattern, text, re.IGNORECASE)
+        if match:
+            return match.group(1)
+    return None
+
+
+def extract_activation_url(text):
+    if not text:
+        return None
+    patterns = [
+        r'(https://rwc2027\.tmtickets\.co\.uk/Authentication/ActivateAccount/[^\s<>"\']+)',
+        r'(https://[^\s<>"\']*tmtickets\.co\.uk[^\s<>"\']*)',
+        r'(https://rwc2027\.rugbyworldcup\.com/[^\s<>"\']{20,})',
+    ]
+    for pattern in patterns:
+        matches = re.findall(pattern, text, re.IGNORECASE)
+        if matches:
+            url = max(matches, key=len)
+            url = url.rstrip('.,;)\'"')
+            url = url.replace('&amp;', '&')
+            url = url.replace('&quot;', '"')
+            url = url.replace('&#39;', "'")
+            url = url.replace('&lt;', '<')
+            url = url.replace('&gt;', '>')
+            return url
+    all_urls = re.findall(r'https://[^\s<>"\']+', text)
+    if all_urls:
+        long_urls = [url for url in all_urls if len(url) > 100]
+        if long_urls:
+            url = max(long_urls, key=len)
+            url = url.rstrip('.,;)\'"')
+            url = url.replace('&amp;', '&')
+            return url
+    return None
@@ -0,0 +1,54 @@
+import app
+
+MULTIPART = (
+    b'1 (UID 7 BODYSTRUCTURE ((("text" "plain" ("charset" "iso-8859-1") NIL NIL "quoted-printable" 120 4 NIL NIL NIL)'
+    b'("text" "html" ("charset" "utf-8") NIL NIL "base64" 5400 70 NIL NIL NIL) "alternative" ("boundary" "b1") NIL NIL)'
+    b'("application" "pdf" ("name" "a.pdf") NIL NIL "base64" 9000 NIL ("attachment" ("filename" "a.pdf")) NIL)'
+    b'("text" "plain" NIL NIL NIL "7bit" 10 1 NIL ("attachment" ("filename" "notes.txt")) NIL) "mixed" ("boundary" "b0") NIL NIL))'
+)
+
+
+def structure_of(flat):
+    start = flat.find(b"BODYSTRUCTURE (")
+    structure, _ = app.parse_imap_list(flat, start + len(b"BODYSTRUCTURE "))
+    return structure
+
+
+def test_parse_imap_list_nesting_strings_and_nil():
+    parsed, pos = app.parse_imap_list(b'(a "b c" NIL ("d\\"e" (f)) "") tail')
+    assert parsed == ["a", "b c", None, ['d"e', ["f"]], ""]
+    assert pos == len(b'(a "b c" NIL ("d\\"e" (f)) "")')
+
+
+def test_parse_imap_list_from_offset():
+    data = b'* 1 FETCH (UID 3 FLAGS (\\Seen))'
+    assert app.parse_imap_list(data, data.index(b"(")) == (["UID", "3", "FLAGS", ["\\Seen"]], len(data))
+
+
+def test_flatten_fetch_response_quotes_literals():
+    data = [
+        (b'1 (UID 9 BODYSTRUCTURE ("text" "plain" ("name" {7}', b'a"b\\c.t'),
+        b') NIL NIL "7bit" 3 1 NIL NIL NIL))',
+    ]
+    flat = app.flatten_fetch_response(data)
+    assert flat == b'1 (UID 9 BODYSTRUCTURE ("text" "plain" ("name" "a\\"b\\\\c.t") NIL NIL "7bit" 3 1 NIL NIL NIL))'
+    assert structure_of(flat)[2] == ["name", 'a"b\\c.t']
+
+
+def test_find_text_parts_skips_attachments_and_reads_params():
+    parts = app.find_text_parts(structure_of(MULTIPART))
+    assert parts == [
+        ("1.1", "text/plain", "quoted-printable", "iso-8859-1", 120),
+        ("1.2", "text/html", "base64", "utf-8", 5400),
+    ]
+
+
+def test_find_text_parts_single_part_is_section_1():
+    flat = b'1 (BODYSTRUCTURE ("TEXT" "HTML" NIL NIL NIL "7BIT" NIL 1 NIL NIL NIL))'
+    assert app.find_text_parts(structure_of(flat)) == [("1", "text/html", "7bit", "utf-8", None)]
+
+
+def test_decode_transfer_encoding_tolerates_a_cut():
+    assert app.decode_transfer_encoding(b"aG9s\r\nYSBtdW5kbw", "base64") == b"hola mund"
+    assert app.decode_transfer_encoding(b"c=C3=B3digo=\r\n 1", "quoted-printable") == "código 1".encode()
+    assert app.decode_transfer_encoding(b"raw", "8bit") == b"raw"
@@ -0,0 +1,87 @@
+from contextlib import contextmanager
+
+from fastapi.testclient import TestClient
+
+import app
+from test_code_store import USER, hit
+
+
+class FakeCursor:
+    def __init__(self, db):
+        self.db = db
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, sql, params=None):
+        self.db.queries.append(sql)
+
+    def fetchone(self):
+        return {"present": self.db.table_present}
+
+    def fetchall(self):
+        return []
+
+
+class FakeDB:
+    def __init__(self, table_present=True):
+        self.table_present = table_present
+        self.queries = []
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    @contextmanager
+    def connection(self):
+        yield self
+
+
+def test_startup_check_never_creates_the_table(monkeypatch):
+    for present in (True, False):
+        db = FakeDB(table_present=present)
+        monkeypatch.setattr(app, "db_connection", db.connection)
+        assert app.check_code_log_table() is present
+        assert not any("CREATE" in q.upper() for q in db.queries)
+
+
+def test_miss_is_cached_and_local_delivery_is_seen_at_once(monkeypatch):
+    db = FakeDB()
+    monkeypatch.setattr(app, "db_connection", db.connection)
+    log = app.DeliveredCodeLog(window=120, max_size=10, persist=True, miss_ttl=60)
+    assert log.recent("alias@icloud.com") == []
+    assert log.recent("alias@icloud.com") == []
+    assert len(db.queries) == 1
+    log.record_many([(USER, "alias@icloud.com", [hit(1, code="424242")])])
+    assert [m.otp_code for m in log.recent("Alias@icloud.com")] == ["424242"]
+
+
+def _client(monkeypatch):
+    monkeypatch.setattr(app, "get_account", lambda email: {"icloud_user": USER, "icloud_app_password": "x"})
+    monkeypatch.setattr(app, "code_log", app.DeliveredCodeLog(window=120, max_size=10, persist=False, miss_ttl=0))
+    monkeypatch.setattr(app, "code_store", app.CodeStore(ttl=600))
+    monkeypatch.setattr(app, "mark_hits_seen", lambda *args: None)
+    monkeypatch.setattr(app, "WEB_WORKERS", 1)
+    return TestClient(app.app)
+
+
+def test_retry_is_flagged_as_replayed(monkeypatch):
+    client = _client(monkeypatch)
+    app.code_store.put(USER, [hit(1, code="111111")])
+    first = client.post("/webhook", json={"email": "alias@icloud.com"}).json()
+    assert first["replayed"] is False
+    retry = client.post("/webhook", json={"email": "alias@icloud.com"}).json()
+    assert retry["replayed"] is True
+    assert [m["otp_code"] for m in retry["messages"]] == ["111111"]
+
+
+def test_newer_pending_code_is_served_instead_of_the_replay(monkeypatch):
+    client = _client(monkeypatch)
+    app.code_store.put(USER, [hit(1, code="111111")])
+    client.post("/webhook", json={"email": "alias@icloud.com"})
+    app.code_store.put(USER, [hit(2, code="222222")])
+    response = client.post("/webhook", json={"email": "alias@icloud.com"}).json()
+    assert response["replayed"] is False
+    assert [m["otp_code"] for m in response["messages"]] == ["222222"]
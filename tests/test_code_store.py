@@ -0,0 +1,46 @@
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+
+import app
+
+USER = "madre@icloud.com"
+
+
+def hit(uid, recipient="alias@icloud.com", age_minutes=0.0, code="123456", folder="INBOX"):
+    date = format_datetime(datetime.now(timezone.utc) - timedelta(minutes=age_minutes))
+    message = app.Message(from_="FIFA <noreply@fifa.com>", subject="FIFA ID", date=date, to=recipient, otp_code=code, email_type="FIFA", folder=folder)
+    return app.MailHit(folder, str(uid), recipient, message)
+
+
+def test_take_returns_newest_hit_once():
+    store = app.CodeStore(ttl=600)
+    store.put(USER, [hit(1, age_minutes=3, code="111111"), hit(2, age_minutes=1, code="222222")])
+    assert [h.message.otp_code for h in store.take(USER, "Alias@icloud.com")] == ["222222"]
+    assert [h.message.otp_code for h in store.take(USER, "alias@icloud.com")] == ["111111"]
+    assert store.take(USER, "alias@icloud.com") == []
+
+
+def test_take_drops_hits_outside_the_request_window():
+    store = app.CodeStore(ttl=3600)
+    store.put(USER, [hit(1, age_minutes=15)])
+    assert store.take(USER, "alias@icloud.com", minutes=10) == []
+    # Descartado, no consumido: un escaneo con ventana mayor lo puede volver a encontrar
+    assert "alias@icloud.com" not in store._by_recipient
+    assert store.known_uids(USER, "INBOX") == set()
+    assert store.put(USER, [hit(1, age_minutes=15)]) == 1
+    assert [h.uid for h in store.take(USER, "alias@icloud.com", minutes=30)] == ["1"]
+
+
+def test_consumed_hits_are_not_stored_again():
+    store = app.CodeStore(ttl=600)
+    store.put(USER, [hit(7)])
+    assert store.take(USER, "alias@icloud.com")
+    assert store.put(USER, [hit(7)]) == 0
+    assert store.known_uids(USER, "INBOX") == {"7"}
+
+
+def test_take_only_returns_hits_of_the_same_account():
+    store = app.CodeStore(ttl=600)
+    store.put("otra@icloud.com", [hit(1)])
+    assert store.take(USER, "alias@icloud.com") == []
+    assert len(store.take("otra@icloud.com", "alias@icloud.com")) == 1
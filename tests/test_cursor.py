@@ -0,0 +1,85 @@
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+
+import app
+import mailgen
+
+PASSWORD = "pw"
+
+
+def date(minutes_ago):
+    return format_datetime(datetime.now(timezone.utc) - timedelta(minutes=minutes_ago))
+
+
+def test_uidvalidity_change_resets_the_cursor():
+    cursor = app.FolderCursor()
+    cursor.check_uidvalidity(5)
+    cursor.advance(["3", "10", "7"])
+    cursor.remember("10", b"h", "FIFA", "Alias@icloud.com", date(1))
+    cursor.highestmodseq = 40
+    cursor.check_uidvalidity(5)
+    assert (cursor.last_uid, cursor.recipient_of("10")) == (10, "alias@icloud.com")
+    cursor.check_uidvalidity(6)
+    assert (cursor.uidvalidity, cursor.last_uid, cursor.highestmodseq, cursor.entries) == (6, 0, None, {})
+
+
+def test_candidates_drop_entries_outside_the_window():
+    cursor = app.FolderCursor()
+    cursor.remember("1", b"h1", "FIFA", "a@icloud.com", date(30))
+    cursor.remember("2", b"h2", "FIFA", "a@icloud.com", date(1))
+    cursor.remember("3", b"h3", "FIFA", "a@icloud.com", "no es una fecha")
+    assert set(cursor.candidates(10)) == {"2", "3"}
+    assert "1" not in cursor.entries
+
+
+def test_cursor_keeps_only_the_newest_entries(monkeypatch):
+    monkeypatch.setattr(app.FolderCursor, "MAX_ENTRIES", 3)
+    cursor = app.FolderCursor()
+    for uid in ("9", "10", "2", "11"):
+        cursor.remember(uid, b"h", "FIFA", "a@icloud.com", date(1))
+    assert sorted(cursor.entries, key=int) == ["9", "10", "11"]
+
+
+def test_second_scan_only_asks_for_new_uids(fake_imap, monkeypatch):
+    monkeypatch.setattr(app, "IMAP_CURSOR_ENABLED", True)
+    user = "madre-cursor@icloud.com"
+    account = fake_imap.server.add_account(user, PASSWORD)
+    account.deliver("INBOX", mailgen.fifa_email("a1@icloud.com", "111111"))
+    account.deliver("INBOX", mailgen.fifa_email("a2@icloud.com", "222222"))
+
+    assert [h.message.otp_code for h in app.fetch_last_hits(user, PASSWORD, "a1@icloud.com")] == ["111111"]
+    cursor = app.folder_cursors.get(user, "INBOX")
+    assert cursor.last_uid == 2
+    assert cursor.recipient_of("2") == "a2@icloud.com"
+
+    # a2 sale de lo ya clasificado; lo nuevo (a3) se pide con UID 3:*
+    account.deliver("INBOX", mailgen.fifa_email("a3@icloud.com", "333333"))
+    assert [h.message.otp_code for h in app.fetch_last_hits(user, PASSWORD, "a2@icloud.com")] == ["222222"]
+    assert cursor.last_uid == 3
+    assert cursor.recipient_of("3") == "a3@icloud.com"
+
+    # Leído desde otro cliente: sale del cursor al refrescar flags
+    box = account.mailboxes["INBOX"]
+    box.highestmodseq += 1
+    box.messages[2].flags.add("\\Seen")
+    box.messages[2].modseq = box.highestmodseq
+    assert app.fetch_last_hits(user, PASSWORD, "a3@icloud.com") == []
+    assert cursor.recipient_of("3") is None
+
+
+def test_uidvalidity_change_on_the_server_rescans(fake_imap, monkeypatch):
+    monkeypatch.setattr(app, "IMAP_CURSOR_ENABLED", True)
+    user = "madre-cursor-uv@icloud.com"
+    account = fake_imap.server.add_account(user, PASSWORD)
+    account.deliver("INBOX", mailgen.fifa_email("b1@icloud.com", "444444"))
+    assert app.fetch_last_hits(user, PASSWORD, "nadie@icloud.com") == []
+    cursor = app.folder_cursors.get(user, "INBOX")
+    assert cursor.last_uid == 1
+
+    # Buzón recreado: UIDs desde 1 otra vez con otro UIDVALIDITY
+    box = account.mailboxes["INBOX"]
+    box.messages.clear()
+    box.uidvalidity, box.uidnext = 2, 1
+    account.deliver("INBOX", mailgen.fifa_email("b2@icloud.com", "555555"))
+    assert [h.message.otp_code for h in app.fetch_last_hits(user, PASSWORD, "b2@icloud.com")] == ["555555"]
+    assert cursor.uidvalidity == 2
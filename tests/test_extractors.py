@@ -0,0 +1,138 @@
+import random
+
+import pytest
+
+import app
+import legacy
+import mailgen
+
+ACTIVATE = "https://rwc2027.tmtickets.co.uk/Authentication/ActivateAccount/"
+LONG = "https://click.example.com/track?id=" + "x" * 140
+
+
+def activation_corpus():
+    rng = random.Random(2027)
+    cases = [
+        ("URL envuelta en otra", f"https://t.example.com/r?u={ACTIVATE}abc123"),
+        ("esquema en mayúsculas", "HTTPS://rwc2027.tmtickets.co.uk/Authentication/ActivateAccount/XYZ"),
+        ("href envuelto", f'<a href="https://t.example.com/r?u={ACTIVATE}abc123&amp;x=1">x</a>'),
+        ("la más larga de la regla", f"{ACTIVATE}a1 y {ACTIVATE}a1?lang=en&amp;src=mail."),
+        ("tmtickets genérico", "Ver https://shop.tmtickets.co.uk/rwc/basket?id=9 y https://www.rugbyworldcup.com/x"),
+        ("ActivateAccount gana a tmtickets", f"https://shop.tmtickets.co.uk/a/b/c/d/e/f/g/h/i {ACTIVATE}z"),
+        ("rugbyworldcup corta", "https://rwc2027.rugbyworldcup.com/en/short"),
+        ("rugbyworldcup larga", "https://rwc2027.rugbyworldcup.com/en/tickets/activate?token=abcdefghijklmnop"),
+        ("fallback URL larga", f"Pulsa {LONG}."),
+        ("fallback distingue mayúsculas", "HTTPS://click.example.com/" + "y" * 120),
+        ("fallback corta", "https://click.example.com/short"),
+        ("entidades", f"<a href='{ACTIVATE}t?a=1&amp;b=&quot;2&quot;&lt;&gt;&#39;'>x</a>"),
+        ("texto + href largo", f'<p>{ACTIVATE}txt123?lang=en</p><a href="https://mail.example.com/unsub?u={"a1" * 60}">Baja</a>'),
+        ("sin URL", "Hola, nada que ver aquí"),
+        ("vacío", ""),
+    ]
+    for size in (5000, 60000):
+        cases.append((f"mailgen rugby {size}", mailgen.rugby_email("a@icloud.com", "%016x" % rng.getrandbits(64), html_size=size).decode()))
+        cases.append((f"mailgen ruido {size}", mailgen.noise_email("a@icloud.com", rng, html_size=size).decode()))
+    return cases
+
+
+def otp_corpus():
+    return [
+        ("verification code", "Your verification code: 482913"),
+        ("código", "Tu código: 771204 (ref 123456)"),
+        ("prioridad sobre un número anterior", "Pedido 555555. Code: 123456"),
+        ("verification sin code", "Verification 654321"),
+        ("seis dígitos sueltos", "Introduce 909090 en la web"),
+        ("siete dígitos no valen", "1234567"),
+        ("mayúsculas", "CÓDIGO: 111222"),
+        ("sin código", "Nada"),
+        ("mailgen fifa", mailgen.fifa_email("a@icloud.com", "246810").decode()),
+    ]
+
+
+@pytest.mark.parametrize("name,text", activation_corpus())
+def test_activation_url_extractor_matches_legacy(name, text):
+    assert app.ACTIVATION_URL_EXTRACTOR.extract(text) == legacy.extract_activation_url(text)
+
+
+@pytest.mark.parametrize("name,text", otp_corpus())
+def test_otp_extractor_matches_legacy(name, text):
+    assert app.OTP_EXTRACTOR.extract(text) == legacy.extract_otp_code(text)
+
+
+@pytest.mark.parametrize("text,expected", [
+    (f"https://t.example.com/r?u={ACTIVATE}abc123", f"{ACTIVATE}abc123"),
+    ("HTTPS://rwc2027.tmtickets.co.uk/Authentication/ActivateAccount/XYZ",
+     "HTTPS://rwc2027.tmtickets.co.uk/Authentication/ActivateAccount/XYZ"),
+    ("HTTPS://click.example.com/" + "y" * 120, None),
+    (f"Pulsa {LONG}.", LONG),
+])
+def test_activation_url_pinned_outputs(text, expected):
+    assert app.ACTIVATION_URL_EXTRACTOR.extract(text) == expected
+
+
+def test_prefix_anchor_keeps_scheme_case_insensitive():
+    extractor = app.PatternExtractor([r"(a\.com/\w+)"], prefix="https://", pick="longest")
+    assert extractor.extract("x HtTpS://A.com/Path y") == "HtTpS://A.com/Path"
+    assert extractor.extract("http://a.com/path") is None
+
+
+def test_pattern_extractor_requires_one_group():
+    with pytest.raises(ValueError):
+        app.PatternExtractor([r"\d{6}"])
+
+
+def test_extract_from_prefers_chunks_within_each_pattern():
+    extractor = app.PatternExtractor([r"high=(\w+)", r"low=(\w+)"], pick="longest")
+    assert extractor.extract_from(["high=text"], preferred=["low=href"]) == "text"
+    assert extractor.extract_from(["high=textlonger"], preferred=["high=href"]) == "href"
+
+
+def ticketing_html(token, links, rng):
+    rows = [
+        f'<a href="https://www.rugbyworldcup.com/en/page/{i}?utm_source=email&amp;id={rng.getrandbits(32):x}">Enlace {i}</a>'
+        for i in range(links)
+    ]
+    rows.insert(links // 2, f'<a class="btn" href="{ACTIVATE}{token}?lang=en&amp;src=email">Activate</a>')
+    return "<html><body>" + "".join(rows) + '<a href="https://rwc2027.rugbyworldcup.com/en/unsubscribe?list=ticketing">Baja</a></body></html>'
+
+
+def golden_corpus():
+    rng = random.Random(25)
+    rwc = "https://rwc2027.rugbyworldcup.com/en/unsubscribe?list=ticketing&amp;id=123"
+    return activation_corpus() + [
+        ("ticketing 20 enlaces", ticketing_html("tok20", 20, rng)),
+        ("ticketing 200 enlaces", ticketing_html("tok200", 200, rng)),
+        ("texto + href rugbyworldcup", f'<p>{ACTIVATE}txt456</p><a href="{rwc}">Baja</a>'),
+        ("href tmtickets + texto rugbyworldcup", f'<p>{rwc}</p><a href="https://shop.tmtickets.co.uk/rwc?x=1">x</a>'),
+        ("href rugbyworldcup + texto tmtickets", f'<p>https://shop.tmtickets.co.uk/rwc?x=1</p><a href="{rwc}">x</a>'),
+        ("HREF en mayúsculas", f'<A HREF="{ACTIVATE}up123?x=1&amp;y=2">x</A>'),
+        ("href con esquema en mayúsculas", f'<a href="HTTPS://rwc2027.tmtickets.co.uk/Authentication/ActivateAccount/Q">x</a>'),
+    ]
+
+
+@pytest.mark.parametrize("name,text", golden_corpus())
+@pytest.mark.parametrize("from_href", [True, False])
+def test_extract_activation_url_matches_legacy(name, text, from_href, monkeypatch):
+    monkeypatch.setattr(app, "ACTIVATION_URL_FROM_HREF", from_href)
+    assert app.extract_activation_url(text) == legacy.extract_activation_url(text)
+
+
+@pytest.mark.parametrize("text,expected", [
+    # Entidades y comillas que el recorrido de texto deja mal
+    (f'<a href="{ACTIVATE}t1?a=1&#38;b=2">x</a>', f"{ACTIVATE}t1?a=1&b=2"),
+    (f'<a href="{ACTIVATE}t2?next=%2F&#x26;c=3">x</a>', f"{ACTIVATE}t2?next=%2F&c=3"),
+    (f"<a href='{ACTIVATE}t3?a=1&amp;b=2'>x</a>", f"{ACTIVATE}t3?a=1&b=2"),
+    (f"<a href={ACTIVATE}t4?a=1>x</a>", f"{ACTIVATE}t4?a=1"),
+    # Sin ; no es una entidad: "&para" de una query se queda como está
+    (f'<a href="{ACTIVATE}t5?x=1&para=2&amp;y=3">x</a>', f"{ACTIVATE}t5?x=1&para=2&y=3"),
+])
+def test_extract_activation_url_from_href_fixes_entities(text, expected):
+    assert app.ACTIVATION_URL_FROM_HREF
+    assert app.extract_activation_url(text) == expected
+
+
+def test_iter_hrefs_unescapes_only_complete_entities():
+    html = '<a href="/a?x=1&amp;y=2">a</a><a href=\'/b?c=&copy=1\'>b</a><a href=/c>c</a>'
+    assert list(app.iter_hrefs(html)) == ["/a?x=1&y=2", "/b?c=&copy=1", "/c"]
+    assert list(app.iter_hrefs(html, unescape=False))[0] == "/a?x=1&amp;y=2"
+    assert list(app.iter_hrefs(html, keep=lambda href: href.startswith("/c"))) == ["/c"]
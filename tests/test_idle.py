@@ -0,0 +1,60 @@
+import threading
+import time
+
+import app
+import mailgen
+
+USER = "madre-idle@icloud.com"
+PASSWORD = "pw"
+
+
+def connect(fake_imap):
+    account = fake_imap.server.add_account(USER, PASSWORD)
+    imap = app.imap_pool.connect_dedicated(USER, PASSWORD)
+    assert isinstance(imap, app.IdleIMAP4_SSL)
+    imap.select("INBOX")
+    return account, imap
+
+
+def test_idle_wait_returns_on_new_mail(fake_imap):
+    account, imap = connect(fake_imap)
+    try:
+        timer = threading.Timer(0.2, account.deliver, ("INBOX", mailgen.fifa_email("a@icloud.com", "123456")))
+        timer.start()
+        started = time.monotonic()
+        assert imap.idle_wait(10) is True
+        assert time.monotonic() - started < 5
+        # Tras DONE la sesión sigue siendo una sesión imaplib normal
+        assert imap.uid("SEARCH", None, "ALL")[0] == "OK"
+    finally:
+        app.imap_pool.close_dedicated(USER, imap)
+
+
+def test_idle_wait_timeout_keeps_the_session_usable(fake_imap):
+    _, imap = connect(fake_imap)
+    try:
+        assert imap.idle_wait(0.2) is False
+        assert imap.idle_wait(0.2) is False
+        assert imap.noop()[0] == "OK"
+    finally:
+        app.imap_pool.close_dedicated(USER, imap)
+
+
+def test_interrupt_unblocks_idle_wait(fake_imap):
+    _, imap = connect(fake_imap)
+    errors = []
+
+    def idle():
+        try:
+            imap.idle_wait(30)
+        except Exception as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=idle)
+    thread.start()
+    time.sleep(0.2)
+    imap.interrupt()
+    thread.join(5)
+    app.imap_pool.close_dedicated(USER, imap)
+    assert not thread.is_alive()
+    assert errors
@@ -0,0 +1,111 @@
+import asyncio
+import threading
+import time
+
+import app
+
+USER = "madre-pool@icloud.com"
+PASSWORD = "pw"
+
+
+def make_pools(limit, acquire_timeout=10.0):
+    budget = app.IMAPConnectionBudget(limit)
+    sync_pool = app.IMAPSessionPool(budget, idle_timeout=300, noop_after=30, acquire_timeout=acquire_timeout)
+    async_pool = app.AsyncIMAPSessionPool(budget, idle_timeout=300, noop_after=30, acquire_timeout=acquire_timeout)
+    return budget, sync_pool, async_pool
+
+
+def test_sync_async_and_dedicated_share_one_budget(fake_imap):
+    fake_imap.server.add_account(USER, PASSWORD)
+    budget, sync_pool, async_pool = make_pools(2)
+    errors = []
+
+    def sync_worker():
+        try:
+            for _ in range(3):
+                with sync_pool.session(USER, PASSWORD) as imap:
+                    imap.noop()
+                    time.sleep(0.05)
+        except Exception as e:  # pragma: no cover - se comprueba abajo
+            errors.append(e)
+
+    def watcher():
+        try:
+            imap = sync_pool.connect_dedicated(USER, PASSWORD)
+            time.sleep(0.2)
+            sync_pool.close_dedicated(USER, imap)
+        except Exception as e:  # pragma: no cover
+            errors.append(e)
+
+    async def async_worker():
+        for _ in range(3):
+            async with async_pool.session(USER, PASSWORD) as client:
+                await client.noop()
+                await asyncio.sleep(0.05)
+
+    async def main():
+        threads = [threading.Thread(target=sync_worker) for _ in range(3)] + [threading.Thread(target=watcher)]
+        for thread in threads:
+            thread.start()
+        await asyncio.gather(*(async_worker() for _ in range(3)))
+        await asyncio.get_running_loop().run_in_executor(None, lambda: [t.join() for t in threads])
+        sync_pool.close_all()
+        await async_pool.close_all()
+
+    asyncio.run(main())
+    assert errors == []
+    assert fake_imap.max_logged_in[USER] <= 2
+    assert budget.open_count(budget.key(USER)) == 0
+
+
+def test_idle_session_of_other_pool_is_reclaimed(fake_imap):
+    fake_imap.server.add_account(USER, PASSWORD)
+    budget, sync_pool, async_pool = make_pools(1, acquire_timeout=5.0)
+
+    with sync_pool.session(USER, PASSWORD) as imap:
+        imap.noop()
+    assert budget.open_count(budget.key(USER)) == 1  # ociosa en el pool síncrono
+
+    async def main():
+        started = time.monotonic()
+        async with async_pool.session(USER, PASSWORD) as client:
+            await client.noop()
+        elapsed = time.monotonic() - started
+        await async_pool.close_all()
+        return elapsed
+
+    elapsed = asyncio.run(main())
+    assert elapsed < 2.0  # no esperó al acquire_timeout
+    assert sync_pool._idle.get(budget.key(USER)) == []
+    assert fake_imap.max_logged_in[USER] == 1
+    assert budget.open_count(budget.key(USER)) == 0
+
+
+def test_acquire_times_out_when_budget_is_busy(fake_imap):
+    fake_imap.server.add_account(USER, PASSWORD)
+    budget, sync_pool, _ = make_pools(1, acquire_timeout=0.3)
+    imap = sync_pool.connect_dedicated(USER, PASSWORD)
+    try:
+        started = time.monotonic()
+        try:
+            with sync_pool.session(USER, PASSWORD):
+                raise AssertionError("no debería haber sesión libre")
+        except TimeoutError:
+            pass
+        assert 0.25 <= time.monotonic() - started < 2.0
+    finally:
+        sync_pool.close_dedicated(USER, imap)
+    assert budget.open_count(budget.key(USER)) == 0
+
+
+def test_changed_password_closes_old_session_and_frees_its_slot(fake_imap):
+    account = fake_imap.server.add_account(USER, PASSWORD)
+    budget, sync_pool, _ = make_pools(1, acquire_timeout=5.0)
+    with sync_pool.session(USER, PASSWORD) as imap:
+        imap.noop()
+    account.password = "nueva"
+    with sync_pool.session(USER, "nueva") as imap:
+        assert imap.noop()[0] == "OK"
+    sync_pool.close_all()
+    assert fake_imap.max_logged_in[USER] == 1
+    assert budget.open_count(budget.key(USER)) == 0
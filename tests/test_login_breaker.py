@@ -0,0 +1,101 @@
+import time
+
+import pytest
+
+import app
+
+USER = "Madre@icloud.com"
+
+
+def breaker(threshold=2, cooldown=0.05, max_cooldown=0.15):
+    return app.LoginCircuitBreaker(threshold, cooldown, max_cooldown)
+
+
+def fail(b, times, password="pw"):
+    for _ in range(times):
+        b.before_connect(USER, password)
+        b.record_failure(USER, password, "login")
+
+
+def test_opens_after_threshold_consecutive_failures():
+    b = breaker()
+    fail(b, 1)
+    b.before_connect(USER, "pw")  # aún cerrado
+    fail(b, 1)
+    with pytest.raises(app.CircuitOpen) as excinfo:
+        b.before_connect("madre@icloud.com ", "pw")
+    assert excinfo.value.retry_after >= 1
+
+
+def test_success_resets_the_failure_count():
+    b = breaker()
+    fail(b, 1)
+    b.record_success(USER)
+    fail(b, 1)
+    b.before_connect(USER, "pw")
+
+
+def test_half_open_allows_a_single_probe_and_doubles_the_cooldown():
+    b = breaker()
+    fail(b, 2)
+    time.sleep(0.06)
+    b.before_connect(USER, "pw")  # la prueba
+    with pytest.raises(app.CircuitOpen):
+        b.before_connect(USER, "pw")  # mientras la prueba sigue en curso
+    b.record_failure(USER, "pw", "login")
+    assert b._states["madre@icloud.com"]["cooldown"] == pytest.approx(0.1)
+    time.sleep(0.06)
+    with pytest.raises(app.CircuitOpen):
+        b.before_connect(USER, "pw")
+    time.sleep(0.05)
+    b.before_connect(USER, "pw")
+    b.record_failure(USER, "pw", "login")
+    assert b._states["madre@icloud.com"]["cooldown"] == pytest.approx(0.15)  # tope max_cooldown
+    time.sleep(0.16)
+    b.before_connect(USER, "pw")
+    b.record_success(USER)
+    b.before_connect(USER, "pw")
+    assert not b._states
+
+
+def test_hung_probe_does_not_block_forever(monkeypatch):
+    monkeypatch.setattr(app, "IMAP_TIMEOUT", 0.05)
+    b = breaker()
+    fail(b, 2)
+    time.sleep(0.06)
+    b.before_connect(USER, "pw")
+    time.sleep(0.11)
+    b.before_connect(USER, "pw")
+
+
+def test_new_password_or_reset_closes_the_breaker():
+    b = breaker(cooldown=60)
+    fail(b, 2)
+    b.before_connect(USER, "nuevo")
+    fail(b, 2)
+    b.reset({"madre@icloud.com"})
+    b.before_connect(USER, "pw")
+    fail(b, 2)
+    b.reset(set())
+    b.before_connect(USER, "pw")
+
+
+def test_disabled_breaker_never_opens(monkeypatch):
+    monkeypatch.setattr(app, "LOGIN_BREAKER_ENABLED", False)
+    b = breaker()
+    fail(b, 5)
+    b.before_connect(USER, "pw")
+
+
+def test_bad_password_stops_hitting_the_server(fake_imap):
+    user = "madre-breaker@icloud.com"
+    fake_imap.server.add_account(user, "bueno")
+    before = fake_imap.server.commands["LOGIN"]
+    for _ in range(app.LOGIN_BREAKER_THRESHOLD):
+        with pytest.raises(Exception, match="autenticando"):
+            app.IMAPSessionPool._connect(user, "malo")
+    with pytest.raises(app.CircuitOpen):
+        app.IMAPSessionPool._connect(user, "malo")
+    assert fake_imap.server.commands["LOGIN"] - before == app.LOGIN_BREAKER_THRESHOLD
+    # Con el password corregido se intenta en el acto
+    app.IMAPSessionPool._connect(user, "bueno").logout()
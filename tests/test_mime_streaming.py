@@ -0,0 +1,85 @@
+import random
+from email.mime.application import MIMEApplication
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+
+import pytest
+
+import app
+import mailgen
+
+
+def corpus():
+    rng = random.Random(24)
+    return [
+        ("fifa", mailgen.fifa_email("a@icloud.com", "135790")),
+        ("rugby con imagen", mailgen.rugby_email("a@icloud.com", "tok", image_size=200000, rng=rng)),
+        ("ruido", mailgen.noise_email("a@icloud.com", rng, image_size=50000)),
+        ("solo texto", b"Subject: Hola\r\nFrom: x@y.com\r\nTo: a@icloud.com\r\nDate: Fri, 16 Oct 2026 10:00:00 +0000\r\n\r\nCode: 246810\r\n"),
+    ]
+
+
+@pytest.mark.parametrize("name,raw", corpus())
+def test_streaming_matches_full_parse(name, raw):
+    *parsed, truncated = app.parse_message_streaming(raw, max_body_bytes=0)
+    assert tuple(parsed) == app.parse_full_message(raw)
+    assert truncated is False
+
+
+def attachment_first_email():
+    msg = MIMEMultipart("mixed")
+    msg["Subject"] = "Factura"
+    notes = MIMEText("Adjunto 999999", "plain", "utf-8")
+    notes.add_header("Content-Disposition", "attachment", filename="notas.txt")
+    msg.attach(notes)
+    msg.attach(MIMEText("Tu código: 123456", "plain", "iso-8859-1"))
+    msg.attach(MIMEText("<p>HTML</p>", "html", "utf-8"))
+    msg.attach(MIMEApplication(b"\0" * 300000, Name="big.bin"))
+    return msg.as_bytes()
+
+
+def test_skips_text_attachments_and_uses_the_part_charset():
+    *_, text, html, truncated = app.parse_message_streaming(attachment_first_email(), max_body_bytes=0)
+    assert text.strip() == "Tu código: 123456"
+    assert html.strip() == "<p>HTML</p>"
+    assert not truncated
+
+
+def test_stops_feeding_once_the_wanted_part_is_closed(monkeypatch):
+    monkeypatch.setattr(app, "MIME_FEED_CHUNK", 4096)
+    fed = []
+    original = app.email_lib.feedparser.FeedParser.feed
+    monkeypatch.setattr(app.email_lib.feedparser.FeedParser, "feed", lambda self, data: (fed.append(len(data)), original(self, data))[1])
+    raw = attachment_first_email()
+    *_, text, _, _ = app.parse_message_streaming(raw, bodies=("text/plain", "text/html"))
+    assert text.strip() == "Tu código: 123456"
+    # El adjunto grande va detrás: no se llega a leer
+    assert sum(fed) < len(raw) / 10
+
+    fed.clear()
+    app.parse_message_streaming(raw, bodies=("text/html", "text/plain"))
+    assert sum(fed) < len(raw) / 10
+
+
+def test_text_parts_are_capped_at_max_body_bytes():
+    raw = mailgen.fifa_email("a@icloud.com", "135790", html_size=200000)
+    *_, text, html, truncated = app.parse_message_streaming(raw, bodies=("text/html", "text/plain"), max_body_bytes=4000)
+    assert truncated
+    assert "135790" in text
+    assert 0 < len(html) <= 4000
+
+
+def test_truncated_parse_retries_without_limits_when_the_value_is_missing():
+    rule = app.email_rules.get("FIFA")
+    code = "864209"
+    msg = MIMEMultipart("alternative")
+    msg["Subject"] = "Your FIFA ID verification code"
+    msg.attach(MIMEText("x " * app.MIME_BODY_MAX_BYTES + f"Código: {code}", "plain", "utf-8"))
+    raw = msg.as_bytes()
+    key = (("type", "mime_truncated"), ("where", "mime_parse"))
+    before = app.ERRORS._values.get(key, 0)
+    steps = app._parse_full_message_steps("1", raw, rule)
+    with pytest.raises(StopIteration) as stop:
+        next(steps)
+    assert rule.extract(stop.value.value[4], stop.value.value[5]) == code
+    assert app.ERRORS._values.get(key, 0) == before + 1
@@ -0,0 +1,122 @@
+import asyncio
+
+import pytest
+
+import app
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+async def job(scheduler, user, name, order, gate, running):
+    async with scheduler.slot(user):
+        order.append(name)
+        running[user] = running.get(user, 0) + 1
+        running["max_" + user] = max(running.get("max_" + user, 0), running[user])
+        await gate.wait()
+        running[user] -= 1
+
+
+def test_per_account_limit():
+    async def main():
+        scheduler = app.FairIMAPScheduler(per_account=2, global_limit=10, max_queue=10, max_queue_total=10)
+        gate, order, running = asyncio.Event(), [], {}
+        tasks = [asyncio.create_task(job(scheduler, "a@icloud.com", i, order, gate, running)) for i in range(4)]
+        await asyncio.sleep(0.01)
+        assert order == [0, 1]
+        gate.set()
+        await asyncio.gather(*tasks)
+        assert running["max_a@icloud.com"] == 2
+        assert scheduler._total_active == 0 and not scheduler._queues
+
+    run(main())
+
+
+def test_free_slots_go_round_robin_between_accounts():
+    async def main():
+        scheduler = app.FairIMAPScheduler(per_account=5, global_limit=1, max_queue=10, max_queue_total=10)
+        order = []
+
+        async def quick(user, name):
+            async with scheduler.slot(user):
+                order.append(name)
+                await asyncio.sleep(0.01)
+
+        tasks = []
+        for user, name in [("a", "a1"), ("a", "a2"), ("a", "a3"), ("b", "b1"), ("b", "b2")]:
+            tasks.append(asyncio.create_task(quick(user, name)))
+            await asyncio.sleep(0)
+        await asyncio.gather(*tasks)
+        # a1 entra directo; después se alternan las cuentas con cola
+        assert order == ["a1", "a2", "b1", "a3", "b2"]
+
+    run(main())
+
+
+def test_full_queue_raises_overloaded_with_retry_after():
+    async def main():
+        scheduler = app.FairIMAPScheduler(per_account=1, global_limit=10, max_queue=1, max_queue_total=10)
+        gate, order, running = asyncio.Event(), [], {}
+        first = asyncio.create_task(job(scheduler, "a", 1, order, gate, running))
+        queued = asyncio.create_task(job(scheduler, "a", 2, order, gate, running))
+        await asyncio.sleep(0.01)
+        with pytest.raises(app.Overloaded) as excinfo:
+            async with scheduler.slot("A "):
+                pass
+        assert excinfo.value.reason == "account"
+        assert 1 <= excinfo.value.retry_after <= 60
+        # Otra cuenta sí entra
+        async with scheduler.slot("b"):
+            pass
+        gate.set()
+        await asyncio.gather(first, queued)
+        assert order == [1, 2]
+
+    run(main())
+
+
+def test_global_queue_limit():
+    async def main():
+        scheduler = app.FairIMAPScheduler(per_account=1, global_limit=1, max_queue=10, max_queue_total=1)
+        gate, order, running = asyncio.Event(), [], {}
+        tasks = [asyncio.create_task(job(scheduler, user, user, order, gate, running)) for user in ("a", "b")]
+        await asyncio.sleep(0.01)
+        with pytest.raises(app.Overloaded) as excinfo:
+            async with scheduler.slot("c"):
+                pass
+        assert excinfo.value.reason == "global"
+        gate.set()
+        await asyncio.gather(*tasks)
+
+    run(main())
+
+
+def test_cancelled_waiter_leaves_the_queue():
+    async def main():
+        scheduler = app.FairIMAPScheduler(per_account=1, global_limit=10, max_queue=10, max_queue_total=10)
+        gate, order, running = asyncio.Event(), [], {}
+        first = asyncio.create_task(job(scheduler, "a", 1, order, gate, running))
+        waiting = asyncio.create_task(job(scheduler, "a", 2, order, gate, running))
+        await asyncio.sleep(0.01)
+        waiting.cancel()
+        await asyncio.sleep(0)
+        assert scheduler._total_waiting == 0 and "a" not in scheduler._queues
+        gate.set()
+        await first
+        with pytest.raises(asyncio.CancelledError):
+            await waiting
+        assert order == [1]
+        assert scheduler._total_active == 0
+
+    run(main())
+
+
+def test_run_bypasses_the_queue_when_disabled(monkeypatch):
+    monkeypatch.setattr(app, "IMAP_SCHED_ENABLED", False)
+    scheduler = app.FairIMAPScheduler(per_account=1, global_limit=1, max_queue=0, max_queue_total=0)
+
+    async def echo(value):
+        return value
+
+    assert run(scheduler.run("a", echo, 7)) == 7
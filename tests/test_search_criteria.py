@@ -0,0 +1,57 @@
+import re
+
+import pytest
+
+import app
+import mailgen
+
+
+@pytest.fixture
+def search_config(monkeypatch):
+    monkeypatch.setattr(app, "IMAP_SEARCH_MODE", "server")
+    monkeypatch.setattr(app, "EMAIL_TYPE_SEARCH", {"FIFA": {"from": "fifa.com"}, "RUGBY": {"from": "tmtickets", "subject": "activate"}})
+    monkeypatch.setattr(app, "IMAP_SEARCH_RECIPIENT_HEADERS", ["DELIVERED-TO", "TO", "X-ORIGINAL-TO"])
+
+
+def test_types_and_recipient_headers_are_or_ed(search_config):
+    criteria = app.build_search_criteria(10, "Alias@icloud.com ")
+    assert re.fullmatch(r"UNSEEN SINCE \d{2}-[A-Z][a-z]{2}-\d{4} .*", criteria)
+    assert 'OR (FROM "fifa.com") (FROM "tmtickets" SUBJECT "activate")' in criteria
+    assert criteria.endswith(
+        'OR (HEADER DELIVERED-TO "Alias@icloud.com") '
+        'OR (HEADER TO "Alias@icloud.com") (HEADER X-ORIGINAL-TO "Alias@icloud.com")'
+    )
+
+
+def test_single_type_and_no_recipient(search_config, monkeypatch):
+    criteria = app.build_search_criteria(10, None, ["FIFA"])
+    assert criteria.endswith(' (FROM "fifa.com")')
+    assert "HEADER" not in criteria
+    monkeypatch.setattr(app, "IMAP_SEARCH_RECIPIENT_HEADERS", [])
+    assert "HEADER" not in app.build_search_criteria(10, "alias@icloud.com")
+
+
+def test_search_values_are_quoted(search_config):
+    assert '(HEADER TO "a\\"b\\\\c@icloud.com")' in app.build_search_criteria(10, 'a"b\\c@icloud.com')
+
+
+def test_all_mode(search_config, monkeypatch):
+    monkeypatch.setattr(app, "IMAP_SEARCH_MODE", "all")
+    assert app.build_search_criteria(10, "alias@icloud.com") == "ALL"
+
+
+def test_imap_date_does_not_depend_on_locale():
+    from datetime import datetime
+
+    assert app.imap_date(datetime(2026, 3, 5)) == "05-Mar-2026"
+
+
+def test_alias_only_in_delivered_to_is_found(fake_imap, monkeypatch):
+    # Con cursor no se filtra por destinatario en el servidor; sin él sí
+    monkeypatch.setattr(app, "IMAP_CURSOR_ENABLED", False)
+    user, alias = "madre-search@icloud.com", "solo-delivered@icloud.com"
+    account = fake_imap.server.add_account(user, "pw")
+    raw = mailgen.fifa_email(user, "314159")
+    account.deliver("INBOX", b"Delivered-To: " + alias.encode() + b"\r\n" + raw)
+    hits = app.fetch_last_hits(user, "pw", alias)
+    assert [hit.message.otp_code for hit in hits] == ["314159"]
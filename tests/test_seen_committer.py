@@ -0,0 +1,73 @@
+import json
+
+import pytest
+
+import app
+import mailgen
+from test_code_store import hit
+
+USER = "madre-seen@icloud.com"
+
+
+@pytest.mark.parametrize("uids,expected", [
+    (["1", "2", "3", "7"], "1:3,7"),
+    (["9", "3", "4", "4", "10", "1"], "1,3:4,9:10"),
+    (["5"], "5"),
+    ([], ""),
+])
+def test_uid_set(uids, expected):
+    assert app.uid_set(uids) == expected
+
+
+def journal_lines(path):
+    return [json.loads(line) for line in path.read_text().splitlines()]
+
+
+def test_journal_replay_applies_done_entries_and_skips_torn_lines(tmp_path):
+    path = tmp_path / "seen.jsonl"
+    path.write_text(
+        '{"op": "add", "user": "a", "folder": "INBOX", "uids": ["1", "2", "3"]}\n'
+        '{"op": "add", "user": "a", "folder": "Junk", "uids": ["8"]}\n'
+        '{"op": "done", "user": "a", "folder": "INBOX", "uids": ["1", "3"]}\n'
+        '{"op": "add", "user": "b", "folder": "INBOX", "uids": ["4"]}\n'
+        '{"op": "done", "user": "b", "folder": "INBOX", "uids": ["4"]}\n'
+        '{"op": "add", "user": "a", "fol'
+    )
+    committer = app.SeenCommitter(str(path), delay=0, max_backoff=1)
+    committer._load_journal()
+    assert committer.pending_uids("a", "INBOX") == {"2"}
+    assert committer.pending_uids("a", "Junk") == {"8"}
+    assert committer.pending_count() == 2
+    # Compactado: solo lo pendiente
+    assert sorted(journal_lines(path), key=lambda e: e["folder"]) == [
+        {"op": "add", "user": "a", "folder": "INBOX", "uids": ["2"]},
+        {"op": "add", "user": "a", "folder": "Junk", "uids": ["8"]},
+    ]
+    committer._journal.close()
+
+
+def test_pending_uids_survive_a_crash(tmp_path):
+    path = tmp_path / "seen.jsonl"
+    committer = app.SeenCommitter(str(path), delay=0, max_backoff=1)
+    committer.commit_pending = lambda force=False: None  # el proceso muere antes del STORE
+    committer.add(USER, "pw", [hit(11), hit(12), hit(40, folder="Junk")])
+    committer.stop()
+
+    recovered = app.SeenCommitter(str(path), delay=0, max_backoff=1)
+    recovered._load_journal()
+    assert recovered.pending_uids(USER, "INBOX") == {"11", "12"}
+    assert recovered.pending_uids(USER, "Junk") == {"40"}
+    recovered._journal.close()
+
+
+def test_commit_marks_seen_and_empties_the_journal(fake_imap, tmp_path):
+    account = fake_imap.server.add_account(USER, "pw")
+    for code in ("111111", "222222", "333333"):
+        account.deliver("INBOX", mailgen.fifa_email("a@icloud.com", code))
+    path = tmp_path / "seen.jsonl"
+    committer = app.SeenCommitter(str(path), delay=0, max_backoff=1)
+    committer.add(USER, "pw", [hit(1), hit(3)])
+    committer.stop()
+    assert committer.pending_count() == 0
+    assert [("\\Seen" in m.flags) for m in account.mailboxes["INBOX"].messages] == [True, False, True]
+    assert path.read_text() == ""
@@ -0,0 +1,80 @@
+from fastapi.testclient import TestClient
+
+import app
+
+
+def test_worker_forward_needs_the_deployment_secret(monkeypatch):
+    monkeypatch.setattr(app, "WORKER_FORWARD_SECRET", "s3cr3t")
+    assert app.is_worker_forward("s3cr3t")
+    assert not app.is_worker_forward("1")
+    assert not app.is_worker_forward("")
+    assert not app.is_worker_forward(None)
+    monkeypatch.setattr(app, "WORKER_FORWARD_SECRET", "")
+    assert not app.is_worker_forward("")
+    assert not app.is_worker_forward("anything")
+
+
+def _metrics_with_fake_workers(monkeypatch, header):
+    calls = []
+
+    async def fake_forward(index, path, body, method="POST"):
+        calls.append((index, path, method))
+        return 200, {}, f'# HELP x_total X\n# TYPE x_total counter\nx_total{{worker="{index}"}} 1\n'.encode()
+
+    monkeypatch.setattr(app, "WEB_WORKERS", 2)
+    monkeypatch.setattr(app, "WORKER_INDEX", 0)
+    monkeypatch.setattr(app, "WORKER_FORWARD_SECRET", "s3cr3t")
+    monkeypatch.setattr(app, "forward_to_worker", fake_forward)
+    client = TestClient(app.app)
+    response = client.get("/metrics", headers={"X-Worker-Forwarded": header} if header else {})
+    assert response.status_code == 200
+    return calls, response.text
+
+
+def test_public_metrics_scrape_with_forged_header_still_aggregates(monkeypatch):
+    calls, text = _metrics_with_fake_workers(monkeypatch, "1")
+    assert calls == [(1, "/metrics", "GET")]
+    assert 'x_total{worker="1"} 1' in text
+
+
+def test_forwarded_metrics_scrape_returns_only_local_series(monkeypatch):
+    app.ERRORS.inc(type="test", where="test_workers")
+    calls, text = _metrics_with_fake_workers(monkeypatch, "s3cr3t")
+    assert calls == []
+    assert 'worker="1"' not in text
+    assert 'worker="0"' in text
+
+
+ACCOUNTS = [f"madre{i}@icloud.com" for i in range(2000)]
+
+
+def test_worker_ring_is_stable_and_normalises_the_account():
+    ring = app.WorkerRing(4)
+    assert [ring.owner(a) for a in ACCOUNTS] == [app.WorkerRing(4).owner(a) for a in ACCOUNTS]
+    assert ring.owner(" Madre7@iCloud.com ") == ring.owner("madre7@icloud.com")
+    assert app.WorkerRing(1).owner("x@icloud.com") == 0
+
+
+def test_worker_ring_spreads_accounts():
+    ring = app.WorkerRing(4)
+    counts = [0] * 4
+    for account in ACCOUNTS:
+        counts[ring.owner(account)] += 1
+    assert min(counts) > len(ACCOUNTS) / 4 * 0.6
+
+
+def test_adding_a_worker_only_moves_its_share():
+    before, after = app.WorkerRing(4), app.WorkerRing(5)
+    moved = [a for a in ACCOUNTS if before.owner(a) != after.owner(a)]
+    # Solo se mueven cuentas hacia el worker nuevo, y más o menos 1/5 de ellas
+    assert all(after.owner(a) == 4 for a in moved)
+    assert len(moved) < len(ACCOUNTS) * 0.35
+
+
+def test_is_local_uses_the_worker_index(monkeypatch):
+    ring = app.WorkerRing(3)
+    account = ACCOUNTS[0]
+    monkeypatch.setattr(app, "WORKER_INDEX", ring.owner(account))
+    assert ring.is_local(account)
+    monkeypatch.setattr(app, "WORKER_INDEX", (ring.owner(account) + 1) % 3)
+    assert not ring.is_local(account)